@@ -0,0 +1,297 @@
+"""
+    Script execution benchmarks
+
+    Replays the .sams files in scripts/ and some big synthetic scripts against the simulator on a pseudo terminal,
+    once for every executor strategy, and reports end to end time, send to ack latency percentiles, bytes on the wire
+    and host CPU time. Times are robot seconds, so they don't depend on --speed.
+
+    Results can be saved as JSON and compared against an earlier run. Anything that got worse by more than the
+    tolerances in benchmark_thresholds.json fails the run with exit code 1.
+
+        python gui/benchmark.py --save before.json
+        python gui/benchmark.py --baseline before.json
+
+    --model skips the simulator and prints the back of the envelope numbers from model_run instead.
+    --check-queue runs every script in queue mode against the simulator in this process and checks the credits kept
+    the robot's queues from overflowing, see check_queue.
+"""
+
+import argparse, glob, json, os, random, subprocess, sys, tempfile, time
+
+import serial
+
+from executor import DEFAULT_WINDOW, ScriptExecutor, schedule
+from link import IDENTIFY_TIMEOUT, SerialReader
+from protocol import BAUDRATE, BUFFER_SIZE, binary_encoder, encode_ascii, execution_time, parse_queue_report, queue_mode, transmit_time, wants_ack
+from sams import load
+from stats import percentile
+
+BT_LATENCY = 0.02   # Rough one way latency of the rfcomm link
+SPEED = 20          # How much faster than real time the simulator runs
+HERE = os.path.dirname(os.path.abspath(__file__))
+THRESHOLDS = os.path.join(HERE, "benchmark_thresholds.json")
+
+# name -> (window, encoder, batch, queue mode)
+STRATEGIES = {
+    "stop-and-wait": (1, encode_ascii, False, False),
+    "pipelined": (DEFAULT_WINDOW, encode_ascii, False, False),
+    "pipelined-binary": (DEFAULT_WINDOW, binary_encoder, False, False),
+    "batched-binary": (DEFAULT_WINDOW, binary_encoder, True, False),
+    "queued-binary": (DEFAULT_WINDOW, binary_encoder, True, True),
+}
+
+def synthetic_script(kind, length, seed=0):
+    """ Big made up scripts. servo is all wrist writes, mixed throws in short stepper nudges and the claw,
+        joints sweeps the shoulder, elbow and base in turn like a pick and place would, runs nudges one joint a dozen times before the next.
+    """
+
+    rng = random.Random(seed)
+    script = []
+    for i in range(length):
+        roll = rng.random()
+        if kind == "joints":
+            script.append("%s_%s_%s_N" % ("seb"[i % 3], rng.randint(2, 12), rng.randint(0, 1)))
+        elif kind == "runs":
+            script.append("%s_%s_%s_N" % ("seb"[i // 12 % 3], rng.randint(2, 6), rng.randint(0, 1)))
+        elif kind == "servo" or roll < 0.6:
+            script.append("%s_%s_0_N" % (rng.choice("wr"), rng.randint(0, 180)))
+        elif roll < 0.9:
+            script.append("%s_%s_%s_N" % (rng.choice("seb"), rng.randint(2, 6), rng.randint(0, 1)))
+        else:
+            script.append("gN")
+    return script
+
+def start_simulator(speed, latency):
+    """ Runs simulator.py in its own process, so its CPU time doesn't get counted against the host """
+
+    link = os.path.join(tempfile.mkdtemp(prefix="sam-bench-"), "tty")
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "simulator.py"), "--link", link, "--speed", str(speed), "--latency", str(latency)],
+        stdout=subprocess.PIPE, text=True,
+    )
+    process.stdout.readline()   # Waits for "Simulated S.A.M listening on ..."
+    return process, link
+
+def run_case(script, window, encode, batch=False, queue=False, speed=SPEED, latency=BT_LATENCY):
+    process, link = start_simulator(speed, latency)
+    try:
+        ser = serial.Serial(link, BAUDRATE)
+        reader = SerialReader(ser)
+        reader.start()
+        queue_size = None
+        if queue:
+            ser.write(queue_mode(True).encode())
+            line = reader.wait_for_line(lambda line: parse_queue_report(line) is not None, IDENTIFY_TIMEOUT)
+            queue_size = parse_queue_report(line)[0] if line is not None else None
+        executor = ScriptExecutor(ser, reader, window=window, encode=encode, batch=batch, queue_size=queue_size)
+
+        cpu = time.process_time()
+        start = time.monotonic()
+        completed = executor.run(script)
+        wall = time.monotonic() - start
+        cpu = time.process_time() - cpu
+
+        reader.stop()
+        reader.join()
+        ser.close()
+    finally:
+        process.terminate()
+        process.wait()
+        if os.path.lexists(link):
+            os.remove(link)
+        os.rmdir(os.path.dirname(link))
+
+    latencies = [latency * speed for latency in executor.latencies]
+    return {
+        "completed": completed,
+        "commands": len(script),
+        "wall_time": wall * speed,
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p90": percentile(latencies, 0.9),
+        "latency_p99": percentile(latencies, 0.99),
+        "bytes_out": executor.bytes_written,
+        "bytes_in": reader.bytes_read,
+        "cpu_time": cpu,
+    }
+
+def compare(results, baseline, thresholds):
+    """ Returns a list of complaints about anything that got worse by more than its threshold """
+
+    regressions = []
+    for case, metrics in results.items():
+        if case not in baseline:
+            continue
+        for metric, tolerance in thresholds.items():
+            old, new = baseline[case].get(metric), metrics.get(metric)
+            if old is None or new is None:
+                continue
+            if new > old * (1 + tolerance) and new - old > 1e-3:
+                regressions.append("%s %s: %.4g -> %.4g (allowed +%d%%)" % (case, metric, old, new, tolerance * 100))
+        if baseline[case].get("completed") and not metrics["completed"]:
+            regressions.append("%s no longer completes" % case)
+    return regressions
+
+def model_run(script, window, byte_budget=BUFFER_SIZE, latency=BT_LATENCY, encode=encode_ascii):
+    """ Returns the modelled seconds from the first byte sent to the last ack received """
+
+    frames = [encode(command) for command in script]
+
+    ack_received = []   # When the host sees the ack for each command, None for plain commands
+    link_free = 0       # When the host -> robot direction is free again
+    robot_free = 0      # When the robot finishes the previous command
+    reply_free = 0      # When the robot -> host direction is free again
+    end = 0
+
+    for i, command in enumerate(script):
+        # Wait for enough acks to free up a slot in the window and room in the byte budget
+        ready = 0
+        acked = [t for t in ack_received if t is not None]
+        if len(acked) >= window:
+            ready = acked[-window]
+        in_flight = len(frames[i])
+        for j in range(i - 1, -1, -1):
+            in_flight += len(frames[j])
+            if in_flight > byte_budget:
+                ready = max(ready, max([t for t in ack_received[:j + 1] if t is not None], default=0))
+                break
+
+        sent = max(link_free, ready)
+        link_free = sent + transmit_time(len(frames[i]))
+        start = max(link_free + latency, robot_free)
+
+        robot_free = start + execution_time(command)
+        if wants_ack(command):
+            reply_free = max(reply_free, robot_free) + transmit_time(1)
+            ack_received.append(reply_free + latency)
+            end = ack_received[-1]
+        else:
+            ack_received.append(None)
+            end = max(end, robot_free)
+
+    return end
+
+def print_model(scripts, latency, window):
+    print("%-28s %8s %10s %10s %8s" % ("script", "commands", "stop/wait", "pipelined", "speedup"))
+    for name, script in scripts.items():
+        old = model_run(script, 1, latency=latency)
+        new = model_run(script, window, latency=latency)
+        print("%-28s %8d %9.3fs %9.3fs %7.2fx" % (name[:28], len(script), old, new, old / new if new else 1))
+
+    # Binary framing. Commands a second is what the wire alone could carry, script times are with the pipelined executor.
+    print()
+    print("%-28s %7s %7s %9s %9s %10s %10s" % ("script", "B/cmd", "B/cmd", "cmd/s", "cmd/s", "ascii", "binary"))
+    print("%-28s %7s %7s %9s %9s %10s %10s" % ("", "ascii", "binary", "ascii", "binary", "", ""))
+    for name, script in scripts.items():
+        ascii_bytes = sum(len(encode_ascii(command)) for command in script) / len(script)
+        binary_bytes = sum(len(binary_encoder(command)) for command in script) / len(script)
+        ascii_time = model_run(script, window, latency=latency)
+        binary_time = model_run(script, window, latency=latency, encode=binary_encoder)
+        print("%-28s %7.1f %7.1f %9.1f %9.1f %9.3fs %9.3fs" % (
+            name[:28], ascii_bytes, binary_bytes,
+            BAUDRATE / 10 / ascii_bytes, BAUDRATE / 10 / binary_bytes, ascii_time, binary_time))
+
+    # Batching neighbouring moves on different joints, pipelined ASCII either way
+    print()
+    print("%-28s %8s %8s %10s %10s %8s" % ("script", "commands", "batched", "pipelined", "batched", "speedup"))
+    for name, script in scripts.items():
+        batched = list(schedule(script))
+        old = model_run(script, window, latency=latency)
+        new = model_run(batched, window, latency=latency)
+        print("%-28s %8d %8d %9.3fs %9.3fs %7.2fx" % (name[:28], len(script), len(batched), old, new, old / new if new else 1))
+
+def check_queue(script, speed=SPEED * 10):
+    """ Runs script in queue mode against an in process simulator. Returns (problems, stats). """
+
+    from simulator import QUEUE_SIZE, SimulatedSerial
+
+    ser = SimulatedSerial(speed=speed)
+    reader = SerialReader(ser)
+    reader.start()
+    problems = []
+    ser.write(queue_mode(True).encode())
+    line = reader.wait_for_line(lambda line: parse_queue_report(line) is not None, IDENTIFY_TIMEOUT)
+    if line is None:
+        problems.append("no answer to %s" % queue_mode(True))
+        executor = None
+    else:
+        executor = ScriptExecutor(ser, reader, encode=binary_encoder, batch=True, queue_size=parse_queue_report(line)[0])
+        if not executor.run(script):
+            problems.append("didn't complete")
+    reader.stop()
+    reader.join()
+    firmware = ser.firmware
+    stats = firmware.stats()
+    if stats["bytes_dropped"]:
+        problems.append("the robot dropped %s bytes" % stats["bytes_dropped"])
+    if stats["deepest"] > QUEUE_SIZE:
+        problems.append("%s moves queued on one motor, room for %s" % (stats["deepest"], QUEUE_SIZE))
+    if executor is not None:
+        executor.take_credits()
+        stats.update(executor.stats())
+        if executor.queued:
+            problems.append("%s moves never started" % executor.queued)
+    return problems, stats
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scripts", nargs="*", help="Scripts to replay. Defaults to everything in scripts/ plus the synthetic ones.")
+    parser.add_argument("--latency", type=float, default=BT_LATENCY, help="One way link latency in seconds")
+    parser.add_argument("--speed", type=float, default=SPEED, help="Run the simulator this many times faster than real time")
+    parser.add_argument("--strategy", action="append", choices=sorted(STRATEGIES), help="Only run these strategies")
+    parser.add_argument("--synthetic", type=int, default=200, help="Commands in each synthetic script, 0 to skip them")
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare against results saved by an earlier --save")
+    parser.add_argument("--thresholds", default=THRESHOLDS, help="JSON of metric -> allowed fractional increase")
+    parser.add_argument("--model", action="store_true", help="Print the analytic model instead of running the simulator")
+    parser.add_argument("--check-queue", action="store_true", help="Check queue mode flow control instead of timing anything")
+    args = parser.parse_args()
+
+    scripts = {}
+    for filename in args.scripts or sorted(glob.glob(os.path.join(HERE, "..", "scripts", "*.sams"))):
+        scripts[os.path.basename(filename)] = load(filename)
+    if not args.scripts and args.synthetic:
+        for kind in ("servo", "mixed", "joints", "runs"):
+            scripts["synthetic-%s-%d" % (kind, args.synthetic)] = synthetic_script(kind, args.synthetic)
+
+    if args.model:
+        print_model(scripts, args.latency, DEFAULT_WINDOW)
+        return 0
+
+    if args.check_queue:
+        code = 0
+        for name, script in scripts.items():
+            problems, stats = check_queue(script)
+            print("%-40s %s, %s credits, %s waits for one, deepest queue %s" % (
+                name[:40], "; ".join(problems) or "OK", stats.get("credits", 0), stats.get("credit_waits", 0), stats["deepest"]))
+            code = code or (1 if problems else 0)
+        return code
+
+    results = {}
+    print("%-40s %9s %8s %8s %8s %7s %7s %7s" % ("case", "wall", "p50", "p90", "p99", "out B", "in B", "cpu"))
+    for name, script in scripts.items():
+        for strategy in args.strategy or STRATEGIES:
+            window, encode, batch, queue = STRATEGIES[strategy]
+            case = "%s/%s" % (strategy, name)
+            result = results[case] = run_case(script, window, encode, batch, queue, speed=args.speed, latency=args.latency)
+            ms = lambda value: "-" if value is None else "%.0fms" % (value * 1000)
+            print("%-40s %8.3fs %8s %8s %8s %7d %7d %6.3fs%s" % (
+                case[:40], result["wall_time"], ms(result["latency_p50"]), ms(result["latency_p90"]), ms(result["latency_p99"]),
+                result["bytes_out"], result["bytes_in"], result["cpu_time"], "" if result["completed"] else "  INCOMPLETE"))
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({"speed": args.speed, "latency": args.latency, "results": results}, file, indent=2)
+
+    if args.baseline:
+        baseline = json.load(open(args.baseline))["results"]
+        thresholds = json.load(open(args.thresholds))
+        regressions = compare(results, baseline, thresholds)
+        for regression in regressions:
+            print("REGRESSION: " + regression)
+        if regressions:
+            return 1
+        print("No regressions against %s" % args.baseline)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+"""
+    Latest-value-wins sending for slider driven servo commands
+
+    Dragging a wrist slider fires value_changed dozens of times a second, and writing every one of them
+    backs up the 9600 baud link until the arm lags well behind the hand. Only the newest angle for each joint matters,
+    so the sliders drop their commands in a per-joint slot and a background thread writes them out no faster than the link can carry them.
+"""
+
+import threading, time
+
+from protocol import BAUDRATE, transmit_time
+
+LINK_SHARE = 0.5    # Fraction of the link's bandwidth the sliders are allowed to use
+
+class LatestValueSender(threading.Thread):
+    """ Keeps only the latest command for each joint and writes them out with write(command).
+
+        By default each write is followed by a pause long enough that the sliders use no more than
+        `share` of the link. Passing rate caps it at that many commands a second instead.
+        on_sent(command) is called from this thread after every write.
+    """
+
+    def __init__(self, write, rate=None, share=LINK_SHARE, baudrate=BAUDRATE, on_sent=None):
+        super().__init__(daemon=True)
+        self.write = write
+        self.rate = rate
+        self.share = share
+        self.baudrate = baudrate
+        self.on_sent = on_sent
+        self.condition = threading.Condition()
+        self.pending = {}       # joint -> latest command not yet sent. Dicts keep insertion order, so joints take turns.
+        self.running = True
+
+        self.submitted = 0
+        self.sent = 0
+        self.dropped = 0        # Stale angles that got replaced before they were sent
+
+    def submit(self, joint, command):
+        with self.condition:
+            self.submitted += 1
+            if joint in self.pending:
+                self.dropped += 1
+                del self.pending[joint]     # Send it after the other joints' waiting commands
+            self.pending[joint] = command
+            self.condition.notify()
+
+    def interval(self, command):
+        """ Seconds to wait after sending command before the next one """
+        if self.rate:
+            return 1 / self.rate
+        return transmit_time(len(command), self.baudrate) / self.share
+
+    def run(self):
+        while self.running:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                joint = next(iter(self.pending))
+                command = self.pending.pop(joint)
+
+            try:
+                self.write(command)
+            except Exception as e:
+                print("Failed to send %s: %s" % (command, e))
+            else:
+                self.sent += 1
+                if self.on_sent is not None:
+                    self.on_sent(command)
+            time.sleep(self.interval(command))
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return {"submitted": self.submitted, "sent": self.sent, "dropped": self.dropped}
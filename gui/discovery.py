@@ -0,0 +1,158 @@
+"""
+    Finding the robot
+
+    Every candidate port is opened and asked who it is at the same time, so a dead bluetooth link or some other
+    device's USB port only costs its own timeout rather than holding up the rest. A port that answers the identify
+    handshake is the robot. The last port that did is remembered in ~/.cache/sam/last_port and tried on its own first,
+    so reconnecting after a cable bump is one open and one round trip.
+
+    Firmware from before the handshake never answers it. If nothing does, the first port that opened, in the order
+    they were given, is taken to be one of those and comes back with no identity, so it gets plain ASCII commands.
+"""
+
+import os, sys, threading, time
+from collections import namedtuple
+
+from link import IDENTIFY_TIMEOUT, parse_identity
+from protocol import BAUDRATE, IDENTIFY, ReplyParser
+
+RFCOMM = "/dev/rfcomm0"
+PROBE_TIMEOUT = 2.0     # Opening the port resets an Uno on some machines, and its bootloader takes a second or so to hand over
+RESEND_INTERVAL = 0.25  # The sketch might not be listening yet the first time we ask
+LAST_PORT = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "sam", "last_port")
+
+# identity is None for a port that opened but never identified itself, which might be older firmware
+Found = namedtuple("Found", "ser port identity kind")
+
+def kind_of(port):
+    return "bt" if "rfcomm" in port else "usb"
+
+def usb_ports():
+    """ Serial ports that could be the robot's USB connection """
+    from serial.tools import list_ports
+    return [port.device for port in sorted(list_ports.comports()) if "rfcomm" not in port.device]
+
+def candidates():
+    """ Every port worth trying, bluetooth first like the GUI always has """
+    ports = [RFCOMM] if sys.platform.startswith("linux") else []
+    return ports + usb_ports()
+
+def last_port(path=LAST_PORT):
+    try:
+        with open(path) as file:
+            return file.read().strip() or None
+    except OSError:
+        return None
+
+def remember(port, path=LAST_PORT):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as file:
+            file.write(port + "\n")
+    except OSError as e:
+        print("Couldn't remember port %s: %s" % (port, e))
+
+def probe(port, timeout=PROBE_TIMEOUT, keep=False):
+    """ Opens port and asks it to identify itself. Returns (ser, identity) with the port left open, or None.
+        keep leaves a port that opened but never answered open too, as (ser, None).
+    """
+
+    import serial
+
+    ser = serial.Serial()
+    ser.port = port
+    ser.baudrate = BAUDRATE
+    ser.timeout = RESEND_INTERVAL / 5
+    ser.write_timeout = timeout
+    ser.dtr = False     # Saves resetting the board on platforms that honour it
+    try:
+        ser.open()
+    except (serial.SerialException, OSError):
+        return None
+
+    parser = ReplyParser()
+    deadline = time.monotonic() + timeout
+    try:
+        while time.monotonic() < deadline:
+            ser.write(IDENTIFY.encode())
+            resend = min(deadline, time.monotonic() + RESEND_INTERVAL)
+            while time.monotonic() < resend:
+                for kind, value in parser.feed(ser.read(max(1, ser.in_waiting))):
+                    identity = parse_identity(value) if kind == 'line' else None
+                    if identity is not None:
+                        ser.timeout = None
+                        ser.write_timeout = None
+                        return ser, identity
+    except (serial.SerialException, OSError):
+        ser.close()
+        return None
+    if keep:
+        ser.timeout = None
+        ser.write_timeout = None
+        return ser, None
+    ser.close()
+    return None
+
+def discover(ports=None, timeout=PROBE_TIMEOUT, cache=LAST_PORT):
+    """ Returns a Found for the first port to identify as the robot, or None.
+
+        The remembered port goes first on its own with a short timeout, then everything in ports (candidates() by default)
+        is probed at once. The remembered port is probed again in that sweep with the full timeout, since a board that is
+        still in its bootloader can miss the short one. Ports that answer after the winner are closed again.
+        If none of them answer, the first of ports that opened comes back with identity None.
+    """
+
+    anywhere = ports is None
+    ports = candidates() if anywhere else list(ports)
+    previous = last_port(cache) if cache else None
+    # The remembered port might be something candidates() doesn't know about, like the simulator's pty
+    if previous is not None and (previous in ports or anywhere and os.path.exists(previous)):
+        result = probe(previous, min(timeout, IDENTIFY_TIMEOUT))
+        if result is not None:
+            return Found(result[0], previous, result[1], kind_of(previous))
+        if previous not in ports:
+            ports.append(previous)
+    if not ports:
+        return None
+
+    lock = threading.Lock()
+    finished = threading.Event()
+    winner = []     # Holds the Found once there is one, or None if we stopped waiting first
+    silent = {}     # port: ser for the ones that opened but didn't answer, in case nothing does
+    remaining = [len(ports)]
+
+    def worker(port):
+        result = probe(port, timeout, keep=True)
+        with lock:
+            if result is not None and not winner:
+                if result[1] is not None:
+                    winner.append(Found(result[0], port, result[1], kind_of(port)))
+                else:
+                    silent[port] = result[0]
+                result = None
+            remaining[0] -= 1
+            if winner or not remaining[0]:
+                finished.set()
+        if result is not None:
+            result[0].close()
+
+    for port in ports:
+        threading.Thread(target=worker, args=[port], daemon=True).start()
+    # Opening a bluetooth port can block well past the timeout, so don't wait on those forever
+    finished.wait(timeout + 1)
+
+    with lock:
+        if not winner:
+            winner.append(None)
+        found = winner[0]
+        if found is None:
+            port = next((port for port in ports if port in silent), None)
+            if port is not None:
+                found = Found(silent.pop(port), port, None, kind_of(port))
+        unused = list(silent.values())
+    for ser in unused:
+        ser.close()
+    # Only remember a port that said it's the robot, a silent one could be anything
+    if found is not None and found.identity is not None and cache:
+        remember(found.port, cache)
+    return found
@@ -0,0 +1,439 @@
+"""
+    Script execution shared by the GUI and the command line tools
+
+    The old loop sent one command and then sat on the line until the robot acked it before sending the next.
+    Over bluetooth most of a script's time went into those round trips rather than into moving the arm.
+    The robot now holds on to the next instruction until the current scripted one has finished, so we can keep a few commands queued up on the line.
+
+    With batch=True, neighbouring moves of different joints are folded into one batch command (see schedule()),
+    so a script that moves the shoulder, then the elbow, then the base takes as long as the slowest of them rather than all three.
+
+    On a transport.Transport, a dropped link doesn't end the script. Once it's reopened the executor asks the robot
+    how many acks it has sent, marks off whatever finished while we couldn't hear it and sends the rest again, see resync().
+    If the board was reset meanwhile, which reopening a USB port does to an Uno, everything in flight goes again.
+
+    With queue_size, the robot is in queue mode (protocol.QUEUE) and each motor keeps a queue of moves to make one after
+    the other. queue_ahead() lets moves on the same joint go without waiting for an ack, and the executor keeps no more
+    moves waiting on the robot than its queues hold, counting one off for every credit the robot writes as a move starts.
+    A full queue would stop the robot reading, and then its receive buffer would overflow.
+"""
+
+import queue, time
+from array import array
+from collections import deque
+
+from link import parse_identity
+from transport import LinkReset
+from protocol import (ACK_COUNT_MODULO, BUFFER_SIZE, END_MARKER, HARD_END_MARKER, MAX_COMMAND_LENGTH, QUEUE_QUERY, RESYNC, STEPPERS,
+                      encode_ascii, encode_batch, parse, parse_queue_report, queue_mode, queued_moves, wants_ack)
+from stats import percentile
+
+DEFAULT_WINDOW = 4  # Scripted commands allowed in flight at once
+POLL_INTERVAL = 0.1 # Seconds to wait for an ack before checking whether we've been cancelled
+RESYNC_TIMEOUT = 30 # Seconds to wait for the robot to answer after a reconnect, when there's no timeout
+RESYNC_RESENDS = 3
+RESYNC_RESEND_INTERVAL = 1.0
+UPTIME_SLACK = 0.5  # Seconds the robot's millis() can seem to fall behind ours from one identify to the next without it having been reset
+
+def batchable(command):
+    """ Returns the joint a command moves if it's worth batching, otherwise None.
+
+        Servo writes are over as soon as they're made, so batching them only swaps short binary frames for a long ASCII batch.
+    """
+    try:
+        id, angle, dir, terminator = parse(command)
+    except ValueError:
+        return None
+    return id if id in STEPPERS and terminator else None
+
+def schedule(commands):
+    """ Yields commands with runs of moves on different joints folded into batches.
+
+        A run ends at the first joint that's already in it, at anything that isn't a stepper move (servos, the claw, resets),
+        after a move that doesn't wait for an ack (the one after it was already going to start straight away),
+        or when the batch would no longer fit in the robot's buffer.
+    """
+
+    group = []
+    joints = set()
+    for command in commands:
+        joint = batchable(command)
+        if group and (joint is None or joint in joints or not group[-1].endswith(HARD_END_MARKER)
+                      or len(encode_batch(group + [command])) > MAX_COMMAND_LENGTH):
+            yield group[0] if len(group) == 1 else encode_batch(group)
+            group = []
+            joints = set()
+        if joint is None:
+            yield command
+        else:
+            group.append(command)
+            joints.add(joint)
+    if group:
+        yield group[0] if len(group) == 1 else encode_batch(group)
+
+def queue_ahead(commands):
+    """ Yields commands with the N taken off moves that are followed by another held move on the same joint, for queue mode.
+
+        The second one would have waited for the first to finish anyway, and in queue mode it does that on the robot
+        without cutting it short, so there's no need to hold everything else up for an ack in between.
+        The last held move of a run keeps its N, so whatever comes after still waits for all of it.
+    """
+
+    previous = None
+    for command in commands:
+        if previous is not None:
+            joint = batchable(command)
+            if (joint is not None and joint == batchable(previous) and previous.endswith(HARD_END_MARKER)
+                    and command.endswith(HARD_END_MARKER)):
+                previous = previous[:-1] + END_MARKER
+            yield previous
+        previous = command
+    if previous is not None:
+        yield previous
+
+class ScriptExecutor():
+    """ Sends a list of commands, keeping up to `window` unacknowledged commands in flight.
+
+        window=1 behaves like the old stop-and-wait loop.
+        The bytes in flight never go past byte_budget, which defaults to the size of the robot's receive buffer.
+        Acks come from a link.SerialReader running on the same port.
+        encode turns each command into the bytes that go down the wire, see protocol.binary_encoder.
+        batch folds neighbouring moves into batch commands. Only for robots that advertise protocol.CAPABILITY_BATCH.
+        timeout gives up on a script once the robot has gone that many seconds without acking anything it owes us. None waits forever.
+        tracker, a kinematics.JointTracker, is told about every command sent and every ack.
+        monitor, a telemetry.Monitor, likewise, along with how long each ack took.
+        tracer, a tracing.Tracer, gets the time each command spent at every stage between leaving the script and being acked.
+        queue_size is how many moves each motor can queue, from the robot's Q reply, once it's been put in queue mode. None if it isn't.
+        setup is the commands that got the robot ready for the script, like motion.profile_commands(terminator='n').
+        A reset board has forgotten them, so they go again before anything is replayed, and so does queue mode.
+    """
+
+    def __init__(self, ser, reader, window=DEFAULT_WINDOW, byte_budget=BUFFER_SIZE, encode=encode_ascii, batch=False, timeout=None, tracker=None, queue_size=None, monitor=None, tracer=None, setup=()):
+        if window < 1:
+            raise ValueError("window must be at least 1")
+        self.ser = ser
+        self.reader = reader
+        self.window = window
+        self.byte_budget = byte_budget
+        self.encode = encode
+        self.batch = batch
+        self.timeout = timeout
+        self.timed_out = False
+        self.tracker = tracker
+        self.monitor = monitor
+        self.tracer = tracer
+        self.queue_size = queue_size
+        self.setup = list(setup)
+        self.queued = 0         # Moves sent in queue mode that the robot hasn't started yet
+        self.credits = 0
+        self.credit_waits = 0   # Times the window had room but the robot's queues didn't
+        self.resyncs = 0
+        self.lost_acks = 0      # Acks the robot sent while the link was down
+        self.resets = 0         # Times the board was reset while the link was down
+        self.ack_offset = None  # The robot's ack count less the reader's, None if it never said
+        self.robot_uptime = None    # Its millis() the last time it said
+        self.uptime_at = None   # When that was, by our clock
+        self.replayed = 0       # Commands sent again after the link came back
+        self.consumed = 0       # Commands taken from the script, which can be more than were sent once they're batched
+        self.sent = 0
+        self.acked = 0
+        self.bytes_written = 0
+        self.latencies = array("d")     # Seconds from writing each scripted command to getting its ack
+
+    def run(self, script, on_progress=None, running=lambda: True):
+        """ Executes script, a list or any other iterable of terminated command strings. Returns True if it ran to completion.
+
+            Commands are only pulled from script as the window has room for them, so a sams.Script streams straight off the disk.
+            Progress comes from script.progress() if it has one, otherwise from how far through the list we are.
+            Streams with neither only report progress once they've finished.
+        """
+
+        commands = self.count(script)
+        if self.queue_size:
+            commands = queue_ahead(commands)
+        if self.batch:
+            commands = schedule(commands)
+        commands = iter(commands)
+        if hasattr(script, "progress"):
+            position = script.progress
+        elif hasattr(script, "__len__"):
+            total = len(script)
+            position = lambda: self.consumed / total if total else 1
+        else:
+            position = lambda: 0    # A stream, no telling how far through we are until it ends
+
+        self.reader.clear_acks()
+        self.ack_offset = None
+        self.robot_uptime = None
+        generation = getattr(self.ser, "generation", 0)
+        if self.reader.identity is not None:
+            # Whatever the robot said when it was connected to, which is enough to tell lost acks from a reset later on
+            identity, seen, self.uptime_at = self.reader.identity
+            self.ack_offset = None if identity.acks is None else identity.acks - seen
+            self.robot_uptime = identity.uptime
+        if self.queue_size:
+            # Moves from before this script might still be waiting
+            self.reader.clear_credits()
+            try:
+                self.ask_queue(running, generation)
+            except LinkReset:
+                pass
+        in_flight = deque()     # (frame, wants_ack, time sent, progress once it's done, queued moves) in the order they were sent
+        in_flight_bytes = 0
+        pending_acks = 0
+        progress = 0
+        waiting_since = None    # When we last heard an ack, or sent the first command that wants one
+        command = next(commands, None)
+        taken_at = time.monotonic() if self.tracer is not None else None
+
+        def acked(arrived=None):
+            """ Everything up to and including the first scripted command has finished. arrived is when the reader saw the ack. """
+            nonlocal in_flight_bytes, pending_acks, progress, waiting_since
+            waiting_since = time.monotonic()
+            if self.tracer is not None:
+                self.tracer.acked(arrived, waiting_since)
+            while in_flight:
+                frame, needs_ack, sent_at, progress, moves = in_flight.popleft()
+                in_flight_bytes -= len(frame)
+                if needs_ack:
+                    self.latencies.append(time.monotonic() - sent_at)
+                    if self.monitor is not None:
+                        self.monitor.acked(self.latencies[-1])
+                    break
+            # Plain commands queued behind it go straight through now
+            while in_flight and not in_flight[0][1]:
+                frame, needs_ack, sent_at, progress, moves = in_flight.popleft()
+                in_flight_bytes -= len(frame)
+            pending_acks -= 1
+            self.acked += 1
+            if self.tracker is not None:
+                self.tracker.acked()
+            if on_progress is not None:
+                on_progress(progress)
+
+        while running() and (command is not None or pending_acks):
+            if getattr(self.ser, "generation", 0) != generation:
+                # The link was dropped and reopened. Work out what the robot never got and send it again.
+                generation = self.ser.generation
+                try:
+                    if not self.resync(in_flight, acked, running, generation):
+                        break
+                except LinkReset:
+                    pass    # Dropped again part way through, so start over
+                continue
+
+            # Fill the window up as far as our credit allows
+            starved = False     # Waiting for a queued move to start rather than for an ack
+            while command is not None and pending_acks < self.window:
+                if self.tracer is not None:
+                    encoding = time.monotonic()
+                frame = self.encode(command)
+                if len(frame) > MAX_COMMAND_LENGTH:
+                    raise ValueError("Command %r is longer than the robot's %s character buffer" % (command, BUFFER_SIZE))
+                if in_flight and in_flight_bytes + len(frame) > self.byte_budget:
+                    break
+                moves = queued_moves(command) if self.queue_size else 0
+                if moves and self.queued + moves > self.queue_size:
+                    self.take_credits()
+                    if self.queued + moves > self.queue_size:
+                        starved = True
+                        self.credit_waits += 1
+                        break
+                if self.tracer is not None:
+                    writing = time.monotonic()
+                try:
+                    self.write(frame, generation)
+                except LinkReset:
+                    break   # Resync first, this one goes out after the replay
+                if self.tracer is not None:
+                    self.tracer.sent(command, len(frame), taken_at, encoding, writing, time.monotonic(), wants_ack(command))
+                self.sent += 1
+                self.bytes_written += len(frame)
+                self.queued += moves
+                if self.tracker is not None:
+                    self.tracker.sent(command)
+                if self.monitor is not None:
+                    self.monitor.sent()
+                if wants_ack(command):
+                    if not pending_acks:
+                        waiting_since = time.monotonic()
+                    pending_acks += 1
+                if pending_acks:
+                    # Only worth tracking while something ahead of it is still holding the robot up
+                    in_flight.append((frame, wants_ack(command), time.monotonic(), position(), moves))
+                    in_flight_bytes += len(frame)
+                else:
+                    progress = position()
+                command = next(commands, None)
+                if self.tracer is not None:
+                    taken_at = time.monotonic()
+
+            if starved and not pending_acks:
+                # Nothing to ack, just moves waiting their turn on the robot
+                try:
+                    self.reader.credits.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+                self.queued -= 1
+                self.credits += 1
+                continue
+
+            if not pending_acks:
+                continue
+
+            try:
+                arrived = self.reader.acks.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if self.timeout is not None and time.monotonic() - waiting_since > self.timeout:
+                    self.timed_out = True
+                    break
+                continue
+            acked(arrived)
+
+        completed = command is None and not pending_acks
+        if self.queue_size:
+            self.take_credits()
+        if on_progress is not None:
+            on_progress(1 if completed else progress)
+        return completed
+
+    def write(self, data, generation):
+        """ Writes data, unless the link has been reopened since generation. A Transport raises LinkReset then. """
+        if hasattr(self.ser, "send"):
+            self.ser.send(data, generation)
+        else:
+            self.ser.write(data)
+
+    def take_credits(self):
+        """ Counts off the queued moves the robot has started since we last looked, without waiting """
+        while self.queued:
+            try:
+                self.reader.credits.get_nowait()
+            except queue.Empty:
+                return
+            self.queued -= 1
+            self.credits += 1
+
+    def ask_queue(self, running, generation):
+        """ Asks the robot how many moves are waiting on its queues and starts counting from there. Returns False if it never said. """
+
+        report = self.ask(QUEUE_QUERY, parse_queue_report, running, generation)
+        if report is None:
+            return False
+        size, depths = report
+        if self.queue_size and not size:
+            # It's been reset since it was put in queue mode. Held moves sent without N would only cut each other short now.
+            report = self.ask(queue_mode(True), parse_queue_report, running, generation)
+            if report is None or not report[0]:
+                return False
+            size, depths = report
+        self.queued = sum(depths.values())
+        return True
+
+    def ask_identity(self, message, running, generation):
+        """ Sends message (ending in an identify) and waits for the robot to answer. Returns its Identity, or None. """
+        return self.ask(message, parse_identity, running, generation)
+
+    def ask(self, message, answer, running, generation):
+        """ Sends message and waits for a line that answer() turns into something other than None, and returns that """
+
+        self.reader.drain_lines()
+        deadline = time.monotonic() + (self.timeout or RESYNC_TIMEOUT)
+        resends = 0
+        next_send = 0
+        while running() and time.monotonic() < deadline:
+            if getattr(self.ser, "generation", 0) != generation:
+                raise LinkReset("reconnected while waiting for the robot to answer")
+            if resends < RESYNC_RESENDS and time.monotonic() >= next_send:
+                # A robot that's just been reset won't hear the first one. Too many would overflow its receive buffer though.
+                self.write(message.encode(), generation)
+                resends += 1
+                next_send = time.monotonic() + RESYNC_RESEND_INTERVAL
+            line = self.reader.wait_for_line(lambda line: answer(line) is not None, POLL_INTERVAL)
+            if line is not None:
+                return answer(line)
+        return None
+
+    def resync(self, in_flight, acked, running, generation):
+        """ Called after the transport reconnects. Returns False if the robot never answered.
+
+            Some of what was in flight may already be sitting in the robot's receive buffer (a bluetooth drop doesn't touch
+            the Arduino) and some may have been lost with the link (a USB reset clears everything). The robot answers
+            an identify only once it has worked through everything before it, so once the answer is in, anything still
+            unacked either finished while the link was down, with its ack lost, or never arrived at all.
+            The answer carries the robot's ack count, and comparing that with ours says which.
+
+            Unless the board was reset, which starts its ack count and millis() from 0 again and throws away everything
+            it had been sent. Then nothing in flight was done and all of it goes again.
+        """
+
+        if self.ask_identity(RESYNC, running, generation) is None:
+            return False
+        # The reader noted how many acks it had seen when the answer came in, which is every one that got through
+        identity, seen, answered = self.reader.identity
+
+        while True:
+            try:
+                arrived = self.reader.acks.get_nowait()
+            except queue.Empty:
+                break
+            acked(arrived)
+        # Its millis() should have gone on at least as far as our clock has since it last said. Going backwards isn't enough,
+        # a board reset twice in a row could still be further on the second time.
+        reset = (identity.uptime is not None and self.robot_uptime is not None
+                 and identity.uptime < self.robot_uptime + (answered - self.uptime_at - UPTIME_SLACK) * 1000)
+        if identity.acks is not None and self.ack_offset is not None and not reset:
+            lost = (identity.acks - self.ack_offset - seen) % ACK_COUNT_MODULO
+            # More acks than we were owed can only be the count starting again, on firmware that doesn't say its uptime
+            reset = lost > sum(1 for entry in in_flight if entry[1])
+            if not reset:
+                for i in range(lost):
+                    acked()
+                self.lost_acks += lost
+                self.ack_offset += lost
+        if reset:
+            self.resets += 1
+            self.ack_offset = None if identity.acks is None else identity.acks - seen
+            for command in self.setup:
+                self.write(self.encode(command), generation)
+        self.robot_uptime = identity.uptime
+        self.uptime_at = answered
+
+        if self.queue_size:
+            # Credits went missing with the link too. What's waiting now, plus whatever goes again.
+            self.reader.clear_credits()
+            if not self.ask_queue(running, generation):
+                return False
+            self.queued += sum(entry[4] for entry in in_flight)
+
+        for i, (frame, needs_ack, sent_at, progress, moves) in enumerate(in_flight):
+            self.write(frame, generation)
+            self.bytes_written += len(frame)
+            in_flight[i] = (frame, needs_ack, time.monotonic(), progress, moves)
+        self.replayed += len(in_flight)
+        self.resyncs += 1
+        return True
+
+    def stats(self):
+        """ Counters and send to ack latency percentiles in seconds, as a dict for printing or dumping to JSON """
+        return {
+            "consumed": self.consumed,
+            "sent": self.sent,
+            "acked": self.acked,
+            "bytes_written": self.bytes_written,
+            "latency_p50": percentile(self.latencies, 0.5),
+            "latency_p90": percentile(self.latencies, 0.9),
+            "latency_p99": percentile(self.latencies, 0.99),
+            "timed_out": self.timed_out,
+            "resyncs": self.resyncs,
+            "lost_acks": self.lost_acks,
+            "resets": self.resets,
+            "replayed": self.replayed,
+            "credits": self.credits,
+            "credit_waits": self.credit_waits,
+        }
+
+    def count(self, script):
+        for command in script:
+            self.consumed += 1
+            yield command
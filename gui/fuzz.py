@@ -0,0 +1,307 @@
+"""
+    Fuzzing and timing the firmware's command parser
+
+    interpreter/command.c parses every text instruction the robot gets. This throws millions of them at it, half made
+    properly (the way protocol.py, the scripts and the planner make them) and half mangled, and checks each decision
+    against reference(), a decoder written straight from the grammar in command.c with regular expressions. The C is
+    built for the host with the system compiler and called through ctypes in one go, so its time per command is the
+    parser's own. simulator.parse_command, the Python copy the simulator runs, gets the same treatment.
+
+    Lines are generated the way read() hands them over: at most 30 characters, then the end marker, with no end marker
+    in the middle and no binary flag on the first character.
+
+        python gui/fuzz.py --count 2000000
+        python gui/fuzz.py --backend model --seed 7
+"""
+
+import argparse, ctypes, glob, hashlib, os, random, re, shutil, subprocess, sys, tempfile, time
+
+import numpy as np
+
+from protocol import BINARY_FLAG, BUFFER_SIZE, END_MARKER, HARD_END_MARKER, IDENTIFY, QUEUE_QUERY, encode_batch, encode_profile, queue_mode
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SOURCE = os.path.join(HERE, "..", "interpreter", "command.c")
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "sam", "fuzz")
+MAX_BODY = BUFFER_SIZE - 2     # read() keeps overwriting the last character after this many
+MAX_ANGLE = 32767
+MAX_VALUE = 65535
+MAX_MOVES = 5
+STRIDE = BUFFER_SIZE
+
+# Runs every line through parse_command() in one call, so ctypes overhead doesn't get counted as parsing
+DRIVER = """
+#include "command.h"
+
+void parse_all(const char *texts, const uint8_t *lengths, uint32_t count, uint32_t stride, Command *out, uint8_t *accepted) {
+  uint32_t i;
+  for (i = 0; i < count; i++) {
+    accepted[i] = parse_command(texts + i * stride, lengths[i], out + i);
+  }
+}
+"""
+
+class CCommand(ctypes.Structure):
+    """ Command from command.h """
+    _fields_ = [
+        ("identifier", ctypes.c_uint8),     # chars, but c_char arrays come back cut short at the first 0
+        ("notify", ctypes.c_uint8),
+        ("fields", ctypes.c_uint8),
+        ("moves", ctypes.c_uint8),
+        ("joints", ctypes.c_uint8 * MAX_MOVES),
+        ("angles", ctypes.c_uint16 * MAX_MOVES),
+        ("dirs", ctypes.c_uint16 * MAX_MOVES),
+    ]
+
+NUMBER = r"([0-9]{1,5})"
+PLAIN = re.compile(r"([^_])[^_]*(?:_%s_%s)?" % (NUMBER, NUMBER), re.S)
+PROFILE = re.compile(r"a([seb])_%s_%s" % (NUMBER, NUMBER))
+BATCH = re.compile(r"m(?:_[sebwr]_[0-9]{1,5}_[0-9]{1,5}){1,%d}" % MAX_MOVES)
+BATCH_MOVE = re.compile(r"_([sebwr])_%s_%s" % (NUMBER, NUMBER))
+
+def reference(text):
+    """ What the firmware should make of a line: (True, notify, identifier, fields, moves) or (False, notify).
+        moves is a tuple of (joint, angle, dir), or (joint, cruise_del, accel) for a profile.
+    """
+
+    if text[-1:] not in (END_MARKER, HARD_END_MARKER):
+        return (False, False)
+    notify = text[-1] == HARD_END_MARKER
+    body = text[:-1]
+    if body.endswith("_"):
+        body = body[:-1]
+
+    if body[:1] == "m":
+        if not BATCH.fullmatch(body):
+            return (False, notify)
+        moves = tuple((joint, int(angle), int(dir)) for joint, angle, dir in BATCH_MOVE.findall(body))
+        if len(set(move[0] for move in moves)) < len(moves) or any(angle > MAX_ANGLE or dir > 1 for joint, angle, dir in moves):
+            return (False, notify)
+        return (True, notify, "m", 1 + 3 * len(moves), moves)
+
+    if body[:1] == "a":
+        match = PROFILE.fullmatch(body)
+        if not match or int(match.group(2)) > MAX_VALUE or int(match.group(3)) > MAX_VALUE:
+            return (False, notify)
+        return (True, notify, "a", 3, ((match.group(1), int(match.group(2)), int(match.group(3))),))
+
+    match = PLAIN.fullmatch(body)
+    if not match:
+        return (False, notify)
+    identifier = match.group(1)
+    if match.group(2) is None:
+        return (True, notify, identifier, 1, ((identifier, 0, 0),))
+    angle, dir = int(match.group(2)), int(match.group(3))
+    if angle > MAX_ANGLE or dir > 1:
+        return (False, notify)
+    return (True, notify, identifier, 3, ((identifier, angle, dir),))
+
+def model(text):
+    """ simulator.parse_command's decision, in the same shape as reference() """
+    from simulator import parse_command
+    accepted, command = parse_command(text)
+    if not accepted:
+        return (False, command.notify)
+    return (True, command.notify, command.identifier, command.fields, command.moves)
+
+def angle(rng):
+    roll = rng.random()
+    if roll < 0.6:
+        return rng.randint(0, 360)
+    if roll < 0.9:
+        return rng.randint(0, MAX_ANGLE)
+    return rng.choice((0, 1, 9999, 10000, MAX_ANGLE))
+
+def terminate(rng, body):
+    return body + rng.choice(("", "_")) + rng.choice((END_MARKER, HARD_END_MARKER))
+
+def valid(rng):
+    """ A line the robot should take, in one of the forms the host sends """
+
+    roll = rng.random()
+    if roll < 0.45:
+        return terminate(rng, "%s_%s_%s" % (rng.choice("sebwr"), angle(rng), rng.randint(0, 1)))
+    if roll < 0.65:
+        joints = rng.sample("sebwr", rng.randint(1, 3))
+        return encode_batch(["%s_%s_%s_%s" % (joint, rng.randint(0, 999), rng.randint(0, 1), rng.choice((END_MARKER, HARD_END_MARKER))) for joint in joints])
+    if roll < 0.75:
+        return encode_profile(rng.choice("seb"), rng.randint(0, MAX_VALUE), rng.randint(0, MAX_VALUE), rng.choice((END_MARKER, HARD_END_MARKER)))
+    if roll < 0.85:
+        return terminate(rng, rng.choice("gZ?q") + rng.choice(("", "", "b", "x")))
+    return rng.choice((IDENTIFY, QUEUE_QUERY, queue_mode(True), queue_mode(False), "gN", "Zn", "Zb_10_0_N"))
+
+# Characters mangled lines are made of. Mostly ones that mean something, so they get near the edges of the grammar.
+ALPHABET = "_0123456789sebwrmaqgZ?x-+ " + "".join(chr(c) for c in (0, 1, 9, 13, 127, 128, 200, 255))
+
+def mangle(rng, text):
+    """ text with a few characters deleted, added, swapped or duplicated """
+
+    body, end = list(text[:-1]), text[-1]
+    for i in range(rng.randint(1, 3)):
+        roll = rng.random()
+        position = rng.randint(0, len(body))
+        if roll < 0.3 and body:
+            del body[min(position, len(body) - 1)]
+        elif roll < 0.6:
+            body.insert(position, rng.choice(ALPHABET))
+        elif roll < 0.8 and body:
+            body[min(position, len(body) - 1)] = rng.choice(ALPHABET)
+        elif body:
+            start = rng.randint(0, len(body) - 1)
+            body[position:position] = body[start:start + rng.randint(1, 6)]
+        else:
+            body.append(rng.choice(ALPHABET))
+    if rng.random() < 0.1:
+        end = rng.choice((END_MARKER, HARD_END_MARKER))
+    return "".join(body) + end
+
+def garbage(rng):
+    return "".join(rng.choice(ALPHABET) for i in range(rng.randint(0, MAX_BODY))) + rng.choice((END_MARKER, HARD_END_MARKER))
+
+def delivered(text):
+    """ What read() would hand interpret() for text: cut at the first end marker and squeezed into the buffer """
+
+    for i, c in enumerate(text):
+        if c in (END_MARKER, HARD_END_MARKER):
+            body, end = text[:i], c
+            break
+    else:
+        return None
+    if body and ord(body[0]) & BINARY_FLAG:
+        body = chr(ord(body[0]) & ~BINARY_FLAG) + body[1:]  # That would be a binary frame
+    return body[:MAX_BODY] + end
+
+def generate(count, seed=0, corpus=()):
+    """ count lines, half of them valid(), the rest mangled copies of valid ones or garbage. corpus lines get mangled too. """
+
+    rng = random.Random(seed)
+    corpus = list(corpus)
+    lines = []
+    while len(lines) < count:
+        roll = rng.random()
+        if roll < 0.5:
+            text = valid(rng)
+        elif roll < 0.9:
+            text = mangle(rng, rng.choice(corpus) if corpus and rng.random() < 0.2 else valid(rng))
+        else:
+            text = garbage(rng)
+        text = delivered(text)
+        if text is not None:
+            lines.append(text)
+    return lines
+
+def build(cache_dir=CACHE_DIR):
+    """ Compiles command.c with the driver into a shared library. Returns its path, or None without a compiler. """
+
+    compiler = os.environ.get("CC") or shutil.which("cc") or shutil.which("gcc") or shutil.which("clang")
+    if compiler is None:
+        return None
+    with open(SOURCE, "rb") as file:
+        source = file.read()
+    with open(os.path.join(os.path.dirname(SOURCE), "command.h"), "rb") as file:
+        header = file.read()
+    key = hashlib.sha1(source + header + DRIVER.encode() + compiler.encode()).hexdigest()
+    path = os.path.join(cache_dir, "command-%s.so" % key)
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory() as scratch:
+        driver = os.path.join(scratch, "driver.c")
+        with open(driver, "w") as file:
+            file.write(DRIVER)
+        output = os.path.join(scratch, "command.so")
+        result = subprocess.run([compiler, "-O2", "-Wall", "-shared", "-fPIC", "-I", os.path.dirname(SOURCE), SOURCE, driver, "-o", output],
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if result.returncode:
+            print(result.stdout, file=sys.stderr)
+            return None
+        os.replace(output, path)
+    return path
+
+def run_c(library, lines):
+    """ Returns (decisions in reference() shape, seconds spent parsing) """
+
+    texts = np.zeros((len(lines), STRIDE), dtype=np.uint8)
+    lengths = np.zeros(len(lines), dtype=np.uint8)
+    for i, text in enumerate(lines):
+        data = text.encode("latin-1")
+        texts[i, :len(data)] = np.frombuffer(data, dtype=np.uint8)
+        lengths[i] = len(data)
+    out = (CCommand * len(lines))()
+    accepted = np.zeros(len(lines), dtype=np.uint8)
+
+    library.parse_all.restype = None
+    start = time.perf_counter()
+    library.parse_all(texts.ctypes.data_as(ctypes.c_char_p), lengths.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8)),
+                      ctypes.c_uint32(len(lines)), ctypes.c_uint32(STRIDE), out, accepted.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8)))
+    seconds = time.perf_counter() - start
+
+    decisions = []
+    for ok, command in zip(accepted.tolist(), out):
+        if not ok:
+            decisions.append((False, bool(command.notify)))
+            continue
+        moves = tuple((chr(command.joints[i]), command.angles[i], command.dirs[i]) for i in range(command.moves))
+        decisions.append((True, bool(command.notify), chr(command.identifier), command.fields, moves))
+    return decisions, seconds
+
+def compare(name, lines, decisions, expected, limit=10):
+    """ Prints the first few lines decided differently to the reference. Returns how many there were. """
+
+    wrong = 0
+    for text, decision, right in zip(lines, decisions, expected):
+        if decision != right:
+            wrong += 1
+            if wrong <= limit:
+                print("%s: %r gave %r, expected %r" % (name, text, decision, right))
+    return wrong
+
+def main():
+    from sams import load
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=1000000, help="Lines to generate")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backend", action="append", choices=("c", "model"), help="Only check these. Defaults to both.")
+    args = parser.parse_args()
+    backends = args.backend or ("c", "model")
+
+    corpus = [command for path in sorted(glob.glob(os.path.join(HERE, "..", "scripts", "*.sams"))) for command in load(path)]
+    start = time.perf_counter()
+    lines = generate(args.count, args.seed, corpus)
+    print("Generated %d lines in %.1fs" % (len(lines), time.perf_counter() - start))
+
+    code = 0
+    rejected = [command for command in corpus if not reference(command)[0]]
+    for command in rejected:
+        print("Bundled script command %r would be rejected" % command)
+        code = 1
+
+    start = time.perf_counter()
+    expected = [reference(text) for text in lines]
+    seconds = time.perf_counter() - start
+    accepted = sum(1 for decision in expected if decision[0])
+    print("reference: %d accepted, %d rejected, %.2fus a line" % (accepted, len(lines) - accepted, seconds / len(lines) * 1e6))
+
+    if "c" in backends:
+        path = build()
+        if path is None:
+            print("c: no working C compiler, skipped")
+        else:
+            decisions, seconds = run_c(ctypes.CDLL(path), lines)
+            wrong = compare("c", lines, decisions, expected)
+            print("c: %d disagreements, %.0fns a line, %.1fM lines/s on this machine" % (wrong, seconds / len(lines) * 1e9, len(lines) / seconds / 1e6))
+            code = code or (1 if wrong else 0)
+
+    if "model" in backends:
+        start = time.perf_counter()
+        decisions = [model(text) for text in lines]
+        seconds = time.perf_counter() - start
+        wrong = compare("model", lines, decisions, expected)
+        print("model: %d disagreements, %.2fus a line" % (wrong, seconds / len(lines) * 1e6))
+        code = code or (1 if wrong else 0)
+    return code
+
+if __name__ == "__main__":
+    sys.exit(main())
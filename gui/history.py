@@ -0,0 +1,87 @@
+"""
+    Command history that doesn't grow without limit
+
+    The history list used to keep every command sent since the GUI started, in a Gtk.ListStore, so a day at the controls
+    ended with hundreds of thousands of rows and a treeview that crawled. History keeps only the newest `limit` commands in
+    memory, in a ring buffer, and the view only ever shows those. Every command also goes straight to the session log
+    on disk (see sessionlog.py), which is where the older ones are read back from.
+"""
+
+import threading
+from collections import deque
+
+from sessionlog import SessionLog
+
+DEFAULT_LIMIT = 5000    # Commands kept in memory and shown in the list
+
+class History():
+    """ Every command recorded this session, oldest first. Indexing and iterating cover the ones only on disk too.
+
+        log is the SessionLog to record to, by default a new one in ~/.cache/sam/sessions.
+    """
+
+    def __init__(self, limit=DEFAULT_LIMIT, log=None):
+        if limit < 1:
+            raise ValueError("History limit must be at least 1")
+        self.limit = limit
+        self.recent = deque(maxlen=limit)
+        self.lock = threading.Lock()
+        self.log = log if log is not None else SessionLog()
+        self.first = len(self.log)  # Commands already in the log from before, which aren't ours
+
+    @property
+    def spilled(self):
+        """ Commands that are only on disk now """
+        return len(self) - len(self.recent)
+
+    def __len__(self):
+        return len(self.log) - self.first
+
+    def extend(self, commands):
+        """ Records commands. Returns how many of the ones in memory were pushed out to make room. """
+
+        commands = list(commands)
+        with self.lock:
+            self.log.extend(commands)
+            evicted = min(len(self.recent), max(0, len(self.recent) + len(commands) - self.limit))
+            self.recent.extend(commands)
+        return evicted
+
+    def append(self, command):
+        return self.extend([command])
+
+    def __getitem__(self, index):
+        with self.lock:
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError("history index out of range")
+            if index >= self.spilled:
+                return self.recent[index - self.spilled]
+        return self.log[self.first + index]
+
+    def __iter__(self):
+        """ Yields every command, oldest first """
+        return self.commands([(0, len(self))])
+
+    def commands(self, runs):
+        """ Yields the commands in each (start, stop) of runs, read from the log in bulk """
+        return self.log.commands([(self.first + start, self.first + stop) for start, stop in runs])
+
+    def export(self, runs, destination):
+        """ Copies the commands in each (start, stop) of runs straight from the log to destination, see SessionLog.export """
+        return self.log.export([(self.first + start, self.first + stop) for start, stop in runs], destination)
+
+    def close(self):
+        self.log.close()
+
+def as_script(commands):
+    """ Every command but the last waits for the robot to finish (N), so a saved history plays back one move at a time like it was recorded """
+
+    previous = None
+    for command in commands:
+        if previous is not None:
+            yield previous[:-1] + 'N'
+        previous = command
+    if previous is not None:
+        yield previous
@@ -0,0 +1,184 @@
+"""
+    Cartesian moves: inverse kinematics from a lookup table
+
+    Getting the claw somewhere used to mean nudging the shoulder, elbow and base in turn until it looked right.
+    solve() goes the other way, from an x, y, z target for the claw tip (in the same frame as kinematics.forward) to
+    stepper positions, and moves() turns those into the fewest commands that get there from where the tracker says we are.
+
+    The base just points at the target. The shoulder and elbow come from a table over the arm's vertical plane: every
+    pulse position the two of them can reach is run through forward kinematics once, and each cell of the table keeps the
+    one that lands nearest its centre. Looking a target up is then bilinear interpolation between four cells, well under a
+    millisecond. Building the table takes a moment, so it's cached in ~/.cache/sam/ik keyed on the arm's dimensions.
+
+    The hand is held level, pointing away from the base, so the wrist servo angle falls out of the other two.
+
+        python gui/ik.py 300 0 150
+"""
+
+import argparse, hashlib, os, sys
+
+import numpy as np
+
+from kinematics import ARM, DEGREES_PER_STEP, forward, pulse_time
+from optimizer import angle_for_steps, max_steps
+from protocol import END_MARKER, HARD_END_MARKER, STEPPERS, encode_batch
+
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "sam", "ik")
+CACHE_VERSION = 1
+CELL = 2.0      # mm per table cell
+# How far the shoulder and elbow can go from their switches, in degrees. Placeholders like kinematics.ARM.
+TRAVEL = {'s': 180, 'e': 180}
+
+def degrees_per_pulse(id):
+    return DEGREES_PER_STEP / STEPPERS[id][1]
+
+class Table():
+    """ Shoulder and elbow pulses for wrist positions in the arm's plane. reach is along the arm, height is up from the table. """
+
+    def __init__(self, arm=ARM, travel=TRAVEL, cell=CELL, cache_dir=CACHE_DIR):
+        self.arm = arm
+        self.cell = cell
+        key = repr((CACHE_VERSION, tuple(arm), sorted(travel.items()), cell, STEPPERS['s'], STEPPERS['e']))
+        path = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".npz") if cache_dir else None
+        if path and os.path.exists(path):
+            with np.load(path) as cached:
+                self.origin, self.pulses = cached["origin"], cached["pulses"]
+            return
+
+        self.build(travel)
+        if path:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                np.savez(path, origin=self.origin, pulses=self.pulses)
+            except OSError as e:
+                print("Couldn't cache the IK table: %s" % e)
+
+    def build(self, travel):
+        # Every pulse position of the shoulder and elbow, and where each puts the wrist
+        shoulder = np.arange(int(travel['s'] / degrees_per_pulse('s')) + 1)
+        elbow = np.arange(int(travel['e'] / degrees_per_pulse('e')) + 1)
+        s, e = np.meshgrid(shoulder, elbow, indexing="ij")
+        s, e = s.ravel(), e.ravel()
+        wrist = forward(self.arm.shoulder_home + s * degrees_per_pulse('s'), self.arm.elbow_home + e * degrees_per_pulse('e'), 0, arm=self.arm._replace(hand=0))
+        reach, height = wrist[:, 0], wrist[:, 2]
+
+        self.origin = np.array([reach.min(), height.min()])
+        cells = np.floor((np.stack([reach, height], axis=1) - self.origin) / self.cell).astype(int)
+        shape = cells.max(axis=0) + 1
+        flat = cells[:, 0] * shape[1] + cells[:, 1]
+        centres = (cells + 0.5) * self.cell + self.origin
+        miss = np.hypot(reach - centres[:, 0], height - centres[:, 1])
+
+        # For each cell, the sample that lands nearest its centre
+        order = np.lexsort((miss, flat))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = flat[order][1:] != flat[order][:-1]
+        best = order[first]
+        self.pulses = np.full((shape[0], shape[1], 2), np.nan)
+        self.pulses[cells[best, 0], cells[best, 1]] = np.stack([s[best], e[best]], axis=1)
+
+    def lookup(self, reach, height):
+        """ Shoulder and elbow pulses that put the wrist at reach, height, or None if that's out of reach """
+
+        position = (np.array([reach, height]) - self.origin) / self.cell - 0.5
+        low = np.floor(position).astype(int)
+        if (low < 0).any() or (low + 1 >= self.pulses.shape[:2]).any():
+            return None
+        fraction = position - low
+        corners = self.pulses[low[0]:low[0] + 2, low[1]:low[1] + 2]
+        if np.isnan(corners).any() or np.ptp(corners.reshape(4, 2), axis=0).max() > 2 / degrees_per_pulse('e'):
+            # On the edge of what it can reach, or the neighbours are different ways of bending the arm. Take the nearest.
+            nearest = self.pulses[tuple(np.clip(np.rint(position).astype(int), 0, np.array(self.pulses.shape[:2]) - 1))]
+            return None if np.isnan(nearest).any() else nearest
+        weights = np.array([[(1 - fraction[0]) * (1 - fraction[1]), (1 - fraction[0]) * fraction[1]],
+                            [fraction[0] * (1 - fraction[1]), fraction[0] * fraction[1]]])
+        return np.tensordot(weights, corners, axes=([0, 1], [0, 1]))
+
+def solve(x, y, z, table, current=None):
+    """ Stepper pulses and wrist angle that put the claw tip at x, y, z, as ({'s', 'e', 'b': pulses}, wrist), or None if it can't get there.
+        The pulses come out of the interpolation with fractions left on, for the caller to round however suits it.
+
+        current is where the steppers are now, from JointTracker.pulses(). Of the ways there, the one that moves them least wins.
+    """
+
+    arm = table.arm
+    current = current or dict.fromkeys(STEPPERS, 0)
+    distance = np.hypot(x, y)
+    yaw = np.degrees(np.arctan2(y, x))
+    best = None
+    # Facing the target with the arm reaching forwards, or facing away with it reaching back over the top
+    for reach, facing in ((distance, yaw), (-distance, yaw + 180)):
+        hand = arm.hand if reach >= 0 else -arm.hand
+        found = table.lookup(reach - hand, z)
+        if found is None:
+            continue
+        shoulder, elbow = found
+        # Hand level means the wrist cancels out the shoulder and elbow
+        angles = arm.shoulder_home + shoulder * degrees_per_pulse('s') + arm.elbow_home + elbow * degrees_per_pulse('e')
+        wrist = 90 - angles if reach >= 0 else 270 - angles
+        wrist = (wrist + 180) % 360 - 180
+        if not 0 <= wrist <= 180:
+            continue
+        # The base has no switch, so go whichever way round is shorter
+        base = (facing - arm.base_home) / degrees_per_pulse('b')
+        turn = 360 / degrees_per_pulse('b')
+        base += turn * np.round((current['b'] - base) / turn)
+        target = {'s': float(shoulder), 'e': float(elbow), 'b': float(base)}
+        seconds = max(abs(target[id] - current[id]) * pulse_time(id) for id in STEPPERS)
+        if best is None or seconds < best[0]:
+            best = (seconds, target, int(round(wrist)))
+    if best is None:
+        return None
+    return best[1], best[2]
+
+def steps_for_pulses(pulses, id):
+    """ Steps whose move comes closest to this many pulses. Every move gets two stray pulses, so short ones aren't worth sending. """
+    return max(0, int(round((abs(pulses) - 2) / STEPPERS[id][1])))
+
+def moves(current, target, wrist=None, current_wrist=None, batch=False):
+    """ The fewest commands that take the steppers from current to target pulses, plus the wrist servo if it changes.
+
+        With batch, moves on different joints go in one batch command. A move too long for one command is split into
+        several, with all but the last held (N) so they don't cut each other short.
+    """
+
+    commands = []
+    held = []
+    for id in "seb":
+        delta = target[id] - current[id]
+        steps = steps_for_pulses(delta, id)
+        dir = 1 if delta < 0 else 0     # Dir 1 is towards the switch, which counts down
+        limit = max_steps(id)
+        while steps > limit:
+            held.append("%s_%s_%s_%s" % (id, angle_for_steps(limit), dir, HARD_END_MARKER))
+            steps -= limit
+        if steps:
+            commands.append("%s_%s_%s_%s" % (id, angle_for_steps(steps), dir, END_MARKER))
+    if wrist is not None and wrist != current_wrist:
+        commands.append("w_%s_0_%s" % (wrist, END_MARKER))
+    if batch and len(commands) > 1:
+        commands = [encode_batch(commands)]
+    return held + commands
+
+def main():
+    from kinematics import joint_angles
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("x", type=float)
+    parser.add_argument("y", type=float)
+    parser.add_argument("z", type=float)
+    args = parser.parse_args()
+
+    table = Table()
+    solution = solve(args.x, args.y, args.z, table)
+    if solution is None:
+        print("Can't reach %s, %s, %s" % (args.x, args.y, args.z))
+        return 1
+    target, wrist = solution
+    angles = joint_angles(target)
+    print("Lands at x %.1f y %.1f z %.1f mm" % tuple(forward(angles['s'], angles['e'], angles['b'], wrist)))
+    print("".join(moves(dict.fromkeys(STEPPERS, 0), target, wrist, 90)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,311 @@
+"""
+    Where the arm is
+
+    The host only ever sends relative stepper moves (s_, e_, b_) and absolute servo angles (w_, r_), so nothing kept track
+    of where they add up to. JointTracker follows every command sent and every ack, counting pulses the way
+    interpreter.ino sends them: steps = (angle / phase_angle) / 2 truncated, times the motor's multiplier, plus the stray
+    pulses drive_motor sneaks in at the end. A plain n move that gets interrupted by the next move on the same joint only
+    gets credit for the pulses it had time for, going by each motor's ms_del.
+
+    forward() turns joint angles into the effector position with NumPy, so it takes whole arrays at once:
+    every state a script passes through (see script_positions), or a grid of joint angles from np.meshgrid.
+
+        python gui/kinematics.py scripts/weird.sams
+"""
+
+import argparse, sys, threading, time
+from collections import deque, namedtuple
+
+import numpy as np
+
+from motion import Profile, clamp, max_steps_for, pulse_ends
+from protocol import BATCH, HARD_END_MARKER, HOMING_DONE, HOMING_GAVE_UP, PHASE_ANGLE, PROFILE, QUEUE, STEPPERS, parse, parse_batch, steps_for_angle, transmit_time
+
+JOINTS = "sebwr"
+DEGREES_PER_STEP = PHASE_ANGLE * 2
+
+# Nothing in the repo records the arm's real dimensions, so these are rough placeholders. Measure yours and change them.
+#   lengths in mm: base_height from the table to the shoulder axle, then shoulder -> elbow -> wrist -> claw tip
+#   homes in degrees: where each stepper sits against its limit switch, the shoulder from horizontal and the elbow from straight
+Arm = namedtuple("Arm", "base_height upper_arm forearm hand shoulder_home elbow_home base_home")
+ARM = Arm(base_height=90, upper_arm=150, forearm=150, hand=80, shoulder_home=90, elbow_home=-90, base_home=0)
+
+def int16(value):
+    return (value + 0x8000) % 0x10000 - 0x8000
+
+def pulses_for(angle, id):
+    """ Pulses drive_motor sends for a move of angle on stepper id, stray ones included """
+
+    max_steps = int16(steps_for_angle(angle) * STEPPERS[id][1])
+    if max_steps > 0:
+        return max_steps + 2    # Runs while steps <= max_steps, then one more after clear_op
+    return 1 if max_steps == 0 else 0
+
+def pulse_time(id):
+    return 2 * STEPPERS[id][0] / 1000000
+
+def joint_angles(pulses, arm=ARM):
+    """ Turns stepper positions in pulses from the limit switches (a dict of arrays or numbers) into joint angles in degrees.
+
+        Dir 1 moves towards the switch, so positions count up away from it.
+    """
+
+    return {
+        id: getattr(arm, name + "_home") + np.asarray(pulses[id]) * DEGREES_PER_STEP / STEPPERS[id][1]
+        for id, name in (('s', "shoulder"), ('e', "elbow"), ('b', "base"))
+    }
+
+def forward(shoulder, elbow, base, wrist=90, arm=ARM):
+    """ Effector position in mm for joint angles in degrees. Arguments broadcast against each other like any NumPy
+        operation, and the result has a trailing x, y, z axis. The wrist servo is straight at 90. Roll doesn't move the tip.
+    """
+
+    upper = np.radians(shoulder)
+    fore = upper + np.radians(elbow)
+    hand = fore + np.radians(np.asarray(wrist) - 90)
+    reach = arm.upper_arm * np.cos(upper) + arm.forearm * np.cos(fore) + arm.hand * np.cos(hand)
+    height = arm.base_height + arm.upper_arm * np.sin(upper) + arm.forearm * np.sin(fore) + arm.hand * np.sin(hand)
+    yaw = np.radians(base)
+    return np.stack(np.broadcast_arrays(reach * np.cos(yaw), reach * np.sin(yaw), height), axis=-1)
+
+class Move():
+    """ A stepper operation in flight, in host time. A held one (sent with N) always runs to the end before anything else starts.
+
+        ends is when each pulse finishes, in seconds from the start, for a move with an acceleration profile (see motion.py).
+        Without one every pulse takes pulse_time.
+    """
+
+    def __init__(self, start, pulses, dir, pulse_time, held, ends=None, order=0):
+        self.start = start
+        self.order = order      # Which command it came from, counting from the first sent
+        self.pulses = pulses
+        self.sign = -1 if dir == 1 else 1
+        self.pulse_time = pulse_time
+        self.held = held
+        self.ends = ends
+
+    def done(self, now):
+        if now >= self.end():
+            return self.finished()  # Dividing can come out a hair short of the last pulse
+        if self.ends is not None:
+            return self.sign * int(np.searchsorted(self.ends, now - self.start, side="right"))
+        return self.sign * max(0, min(self.pulses, int((now - self.start) / self.pulse_time)))
+
+    def finished(self):
+        return self.sign * self.pulses
+
+    def end(self):
+        if self.ends is not None:
+            return self.start + (self.ends[-1] if self.pulses else 0)
+        return self.start + self.pulses * self.pulse_time
+
+class JointTracker():
+    """ Follows the commands sent to the robot. Times are time.monotonic() unless the caller passes its own.
+
+        Positions start at the limit switches, which is only true once the arm has been reset, so homed says whether it has.
+    """
+
+    def __init__(self, arm=ARM):
+        self.arm = arm
+        self.lock = threading.Lock()
+        self.position = dict.fromkeys(STEPPERS, 0)  # Pulses from the switch, not counting the move in flight
+        self.moves = {}                             # id -> [Move still going, or finished but not settled, then any queued behind it]
+        self.servos = {'w': 90, 'r': 90}
+        self.profiles = {}          # id -> motion.Profile for steppers that accelerate
+        self.claw = 0               # Times grabbed
+        self.homed = False
+        self.held_until = 0         # The robot holds everything after an N command until its motors stop
+        self.queueing = False       # In queue mode moves wait for the one before them instead of cutting it short
+        self.commands = 0           # Sent so far
+        self.unacked = deque()      # Which commands were sent with N and haven't been acked yet
+        self.homing_from = None     # Shoulder and elbow pulses when the last reset started, in case it stops short
+
+    def sent(self, command, now=None):
+        """ Records a command the robot has been sent. Returns when the robot should start on it. """
+
+        now = time.monotonic() if now is None else now
+        id, angle, dir, terminator = parse(command)
+        with self.lock:
+            start = max(now, self.held_until)
+            self.commands += 1
+            if id == BATCH:
+                moves, terminator = parse_batch(command)
+                for move in moves:
+                    self.run(move[0], move[1], move[2], start, terminator == HARD_END_MARKER)
+            elif id == QUEUE:
+                if '_' in command:  # qn only asks
+                    self.queueing = command[2:3] == '1'
+            else:
+                self.run(id, angle, dir, start, terminator == HARD_END_MARKER)
+            if terminator == HARD_END_MARKER:
+                self.held_until = max([start] + [moves[-1].end() for moves in self.moves.values()])
+                self.unacked.append(self.commands)
+        return start
+
+    def run(self, id, angle, dir, start, held):
+        # Must be called with the lock held
+        if id in STEPPERS:
+            ends = pulse_ends(max_steps_for(angle, id), id, self.profiles[id]) if id in self.profiles else None
+            ahead = self.moves.get(id)
+            if self.queueing and ahead and ahead[-1].end() > start:
+                self.moves[id].append(Move(ahead[-1].end(), pulses_for(angle, id), dir, pulse_time(id), held, ends, self.commands))
+            else:
+                self.settle(id, start)
+                self.moves[id] = [Move(start, pulses_for(angle, id), dir, pulse_time(id), held, ends, self.commands)]
+        elif id in self.servos:
+            # Servo.write() takes anything under 200 as degrees and clamps it, bigger numbers are pulse widths
+            self.servos[id] = max(0, min(180, angle)) if angle < 200 else angle
+        elif id[:1] == 'g':
+            self.claw += 1
+        elif id[:1] == PROFILE and id[1:] in STEPPERS:
+            # The angle and dir are the cruise speed and acceleration. It applies from the next pulse, but near enough.
+            profile = clamp(id[1:], Profile(angle, dir))
+            if profile.accel:
+                self.profiles[id[1:]] = profile
+            else:
+                self.profiles.pop(id[1:], None)
+        elif id[:1] == 'Z':
+            # Homing stops the shoulder and elbow and holds everything after it until they're back on their switches.
+            # The base has no switch yet, so it carries on with whatever it was doing.
+            for joint in "se":
+                self.settle(joint, start)
+            self.homing_from = (self.position['s'], self.position['e'], self.homed)
+            passes = max(self.position['s'], self.position['e'], 0)
+            # Anything we had below zero was down to not knowing where it started, since the switch stops it getting there
+            self.position['s'] = self.position['e'] = 0
+            self.held_until = max(self.held_until, start + passes * STEPPERS['s'][0] / 1000000)
+            self.homed = True
+
+    def settle(self, id, now):
+        # Anything still queued gets dropped along with it, as far as it got
+        for move in self.moves.pop(id, []):
+            # Our clock can be off, but the robot never starts the next command until a held one has finished
+            self.position[id] += move.finished() if move.held else move.done(now)
+
+    def acked(self, now=None):
+        """ The robot says it has finished, which is a better clock than our estimate """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            # Every motor is idle and every queue empty, so whatever had started or was sent before the held command
+            # is done, and whatever we thought was still to come starts now
+            self.held_until = now
+            barrier = self.unacked.popleft() if self.unacked else 0
+            for id, moves in list(self.moves.items()):
+                begin = now
+                for move in moves[:]:
+                    if move.start <= now or move.order <= barrier:
+                        self.position[id] += move.finished()
+                        moves.remove(move)
+                    else:
+                        move.start = begin
+                        begin = move.end()
+                        if move.held:
+                            self.held_until = max(self.held_until, move.end())
+                if not moves:
+                    del self.moves[id]
+
+    def homing_report(self, code, passes, now=None):
+        """ The robot says how homing went. Only a reset that was cancelled or gave up needs anything done about it. """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if code == HOMING_DONE or self.homing_from is None:
+                return
+            shoulder, elbow, homed = self.homing_from
+            self.position['s'] = max(shoulder - passes, 0)
+            self.position['e'] = max(elbow - passes, 0)
+            # Cancelled, it's only as homed as it was before. Giving up means a switch never closed, so who knows.
+            self.homed = homed and code != HOMING_GAVE_UP
+            self.held_until = now
+            self.homing_from = None
+
+    def pulses(self, now=None):
+        """ Stepper positions in pulses at time now """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            return {id: self.position[id] + sum(move.done(now) for move in self.moves.get(id, [])) for id in STEPPERS}
+
+    def moving(self, now=None):
+        now = time.monotonic() if now is None else now
+        return self.stopped() > now
+
+    def stopped(self):
+        """ When the last move in flight should finish """
+        with self.lock:
+            return max([self.held_until] + [moves[-1].end() for moves in self.moves.values()])
+
+    def effector(self, now=None):
+        """ Where the claw tip is at time now, as an x, y, z array in mm """
+        angles = joint_angles(self.pulses(now), self.arm)
+        return forward(angles['s'], angles['e'], angles['b'], self.servos['w'], self.arm)
+
+def script_states(commands, tracker=None):
+    """ Runs commands through a JointTracker (a fresh one by default) as if they were streamed at the baudrate.
+        Returns an array with a row of pulses and servo angles (in JOINTS order) for each command: where it leaves the arm
+        when the next one starts, and for the last one, once everything has stopped.
+    """
+
+    tracker = tracker or JointTracker()
+    now = 0
+    rows = []
+
+    def state(when):
+        pulses = tracker.pulses(when)
+        return [pulses['s'], pulses['e'], pulses['b'], tracker.servos['w'], tracker.servos['r']]
+
+    for command in commands:
+        now += transmit_time(len(command))
+        if rows:
+            rows[-1] = state(max(now, tracker.held_until))  # Now we know when the last one was cut off
+        tracker.sent(command, now)
+        rows.append(None)
+    if rows:
+        rows[-1] = state(tracker.stopped())
+    return np.array(rows, dtype=float).reshape(-1, len(JOINTS))
+
+def script_positions(commands, arm=ARM):
+    """ Effector position after each command of a script, as an (n, 3) array. Forward kinematics is one call for the lot. """
+
+    return positions(script_states(commands), arm)
+
+def positions(states, arm=ARM):
+    """ Effector positions for rows of joint states from script_states """
+    angles = joint_angles({'s': states[:, 0], 'e': states[:, 1], 'b': states[:, 2]}, arm)
+    return forward(angles['s'], angles['e'], angles['b'], states[:, 3], arm)
+
+def check(commands, arm=ARM):
+    """ Lists the places a script drives a joint past its limit switch or the claw into the table. Empty means it looks fine.
+
+        Until the script resets the arm there's no telling where it started, so only what comes after the first Z is checked.
+    """
+
+    commands = list(commands)
+    homed = next((i for i, command in enumerate(commands) if command[:1] == 'Z'), len(commands))
+    states = script_states(commands)[homed:]
+    effector = positions(states, arm)
+    problems = []
+    for column, id in ((0, 's'), (1, 'e')):
+        for index in np.flatnonzero(states[:, column] < 0)[:1]:
+            problems.append("Command %s (%r) drives %s %s pulses past its limit switch" % (homed + index + 1, commands[homed + index], id, int(-states[index, column])))
+    for index in np.flatnonzero(effector[:, 2] < 0)[:1]:
+        problems.append("Command %s (%r) puts the claw %.0fmm below the table" % (homed + index + 1, commands[homed + index], -effector[index, 2]))
+    return problems
+
+def main():
+    from sams import load
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("script", help=".sams file to check")
+    args = parser.parse_args()
+
+    commands = load(args.script)
+    if not commands:
+        return 0
+    positions = script_positions(commands)
+    print("Ends at x %.0f y %.0f z %.0f mm, %.0fmm from where it started" % (tuple(positions[-1]) + (np.linalg.norm(positions[-1] - forward(ARM.shoulder_home, ARM.elbow_home, ARM.base_home)),)))
+    problems = check(commands)
+    for problem in problems:
+        print(problem)
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,133 @@
+"""
+    Background reader for the serial link
+
+    Reading used to happen inside the script loop, which spun on ser.read(1) and burnt a whole core for the length of the script.
+    The reader thread blocks on the port instead, and hands acks, queue credits and anything else the robot prints out through queues.
+"""
+
+import queue, threading, time
+from collections import namedtuple
+
+from protocol import IDENTIFY, IDENTITY_PREFIX, ReplyParser
+
+READ_TIMEOUT = 0.1  # Seconds a read blocks before we check whether we've been asked to stop
+IDENTIFY_TIMEOUT = 1.0
+
+# acks is how many the robot has sent and uptime its millis() when it answered, if it says. Both start from 0 again when the board resets.
+Identity = namedtuple("Identity", "version capabilities acks uptime")
+
+class SerialReader(threading.Thread):
+    """ Reads from ser until stopped. Acks go to self.acks as the time.monotonic() they arrived, credits (queue mode only) to self.credits, everything else to self.lines.
+
+        It also keeps count of every ack it has seen, and the last identity the robot sent with that count and the time it
+        came in, whoever asked for it. The difference between the two counts is acks that never made it, see ScriptExecutor.resync.
+    """
+
+    def __init__(self, ser, timeout=READ_TIMEOUT):
+        super().__init__(daemon=True)
+        self.ser = ser
+        self.ser.timeout = timeout
+        self.parser = ReplyParser()
+        self.acks = queue.Queue()
+        self.credits = queue.Queue()
+        self.lines = queue.Queue()
+        self.running = True
+        self.bytes_read = 0
+        self.ack_count = 0
+        self.identity = None    # (Identity, ack_count when it arrived, time.monotonic() it arrived)
+
+    def run(self):
+        while self.running:
+            try:
+                # Block for one byte, then grab whatever else arrived with it
+                data = self.ser.read(1)
+                if data and getattr(self.ser, "in_waiting", 0):
+                    data += self.ser.read(self.ser.in_waiting)
+            except Exception as e:
+                # The port has gone away. Whoever owns it will notice on their next write.
+                self.lines.put("Serial read failed: %s" % e)
+                break
+            self.bytes_read += len(data)
+            arrived = time.monotonic()
+
+            for kind, value in self.parser.feed(data):
+                if kind == 'ack':
+                    self.ack_count += 1
+                    self.acks.put(arrived)
+                elif kind == 'credit':
+                    self.credits.put(True)
+                else:
+                    if value.startswith(IDENTITY_PREFIX):
+                        identity = parse_identity(value)
+                        if identity is not None:
+                            self.identity = (identity, self.ack_count, arrived)
+                    self.lines.put(value)
+
+    def stop(self):
+        self.running = False
+
+    def clear_acks(self):
+        """ Throws away any acks left over from a previous script """
+        while True:
+            try:
+                self.acks.get_nowait()
+            except queue.Empty:
+                return
+
+    def clear_credits(self):
+        """ Throws away any credits left over from a previous script """
+        while True:
+            try:
+                self.credits.get_nowait()
+            except queue.Empty:
+                return
+
+    def wait_for_line(self, predicate, timeout):
+        """ Returns the first line matching predicate within timeout seconds, or None. Lines that don't match are dropped. """
+
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                line = self.lines.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            if predicate(line):
+                return line
+
+    def drain_lines(self):
+        """ Returns every line received since the last call, without blocking """
+        lines = []
+        while True:
+            try:
+                lines.append(self.lines.get_nowait())
+            except queue.Empty:
+                return lines
+
+def identify(ser, reader, timeout=IDENTIFY_TIMEOUT):
+    """ Asks the robot who it is. Returns an Identity, or None if it's older firmware that doesn't answer. """
+
+    ser.write(IDENTIFY.encode())
+    line = reader.wait_for_line(lambda line: line.startswith(IDENTITY_PREFIX + " "), timeout)
+    if line is None:
+        return None
+    return parse_identity(line)
+
+def parse_identity(line):
+    """ Turns a reply like "SAM 9 BM 17 52310" or "SAM 4 BM 17" into an Identity, or None if it isn't one """
+
+    fields = line.split()
+    if not fields or fields[0] != IDENTITY_PREFIX:
+        return None
+    try:
+        version = int(fields[1])
+    except (IndexError, ValueError):
+        return None
+    numbers = []
+    while len(fields) > 2 and len(numbers) < 2 and fields[-1].isdigit():
+        numbers.insert(0, int(fields.pop()))
+    acks = numbers[0] if numbers else None
+    uptime = numbers[1] if len(numbers) > 1 else None
+    return Identity(version, set("".join(fields[2:])), acks, uptime)
@@ -0,0 +1,190 @@
+"""
+    Acceleration profiles, and a model of how interpreter.ino steps with them
+
+    Out of the box drive_motor sends every pulse at ms_del, the slowest speed a motor can safely start from, so a long
+    move crawls the whole way. With a profile (sent with protocol.encode_profile) a move starts at ms_del, speeds up at a
+    constant acceleration until its pulses are cruise_del apart, and slows down the same way at the end, or turns round
+    half way on a move too short to reach cruise speed.
+
+    The firmware works out the half period of each pulse as it goes, in integers:
+        v0 = 500000 / ms_del                                pulses per second at the start
+        d  = 8000000 / isqrt(256 * (v0 * v0 + 2 * accel * k))    k is steps to the nearer end of the move
+    never shorter than cruise_del. The 256 keeps sixteenths of a pulse per second, or rounding down would make the
+    ramp lurch at low speeds. Everything here does the same sums with NumPy, so it lands on the same microseconds
+    and a whole move is one call. kinematics.JointTracker and the simulator time profiled moves with it.
+
+    robot-cli.py --accel sends PROFILES before running scripts, and the GUI does when SAM_ACCEL is set.
+
+        python gui/motion.py --verify
+        python gui/motion.py scripts/*.sams
+"""
+
+import argparse, sys
+from collections import namedtuple
+
+import numpy as np
+
+from protocol import BATCH, STEPPERS, encode_profile, parse, parse_batch, steps_for_angle
+
+Profile = namedtuple("Profile", "cruise_del accel")    # Half period at full speed in us, acceleration in pulses/s/s
+MIN_DEL = 500       # Shortest half period the firmware takes. drive_motor's timing slop is around 50us.
+HALF_SECOND = 500000
+SCALE = 16          # Speeds are worked out in sixteenths of a pulse per second
+
+# Nobody has tuned these on the real arm yet. They triple to quadruple the top speed and take about 90 pulses to get there.
+PROFILES = {
+    's': Profile(2500, 200),
+    'e': Profile(1250, 800),
+    'b': Profile(1250, 800),
+}
+
+def int16(value):
+    return (value + 0x8000) % 0x10000 - 0x8000
+
+def isqrt(x):
+    """ Integer square root of an array, rounded down like the firmware's """
+    x = np.asarray(x, dtype=np.int64)
+    root = np.floor(np.sqrt(x)).astype(np.int64)
+    # Floats can be one out either way on big numbers
+    root -= root * root > x
+    root += (root + 1) * (root + 1) <= x
+    return root
+
+def clamp(id, profile):
+    """ The profile as the firmware stores it: both numbers are unsigned ints, and the cruise speed is kept between MIN_DEL and ms_del """
+    ms_del = STEPPERS[id][0]
+    return Profile(min(max(profile.cruise_del % 0x10000, MIN_DEL), ms_del), profile.accel % 0x10000)
+
+def ramp_steps(id, profile):
+    """ Steps from the end of a move before it reaches cruise speed. 0 means the profile is off. """
+
+    ms_del = STEPPERS[id][0]
+    if not profile.accel:
+        return 0
+    start = HALF_SECOND // ms_del
+    top = HALF_SECOND // profile.cruise_del
+    return (top * top - start * start) // (2 * profile.accel) + 1
+
+def step_delays(steps, max_steps, id, profile):
+    """ Half period of the pulse drive_motor sends at each of steps (an array) in a move of max_steps, with a clamped profile """
+
+    ms_del = STEPPERS[id][0]
+    steps = np.asarray(steps, dtype=np.int64)
+    ramp = ramp_steps(id, profile)
+    if not ramp:
+        return np.full(steps.shape, ms_del, dtype=np.int64)
+    k = np.maximum(np.minimum(steps, max_steps - steps), 0)
+    start = HALF_SECOND // ms_del
+    delays = HALF_SECOND * SCALE // isqrt(SCALE * SCALE * (start * start + 2 * profile.accel * np.minimum(k, ramp)))
+    return np.where(k >= ramp, profile.cruise_del, np.maximum(delays, profile.cruise_del))
+
+def max_steps_for(angle, id):
+    """ What new_op sets max_steps to for a move of angle on stepper id """
+    return int16(steps_for_angle(angle) * STEPPERS[id][1])
+
+def pulse_delays(max_steps, id, profile=None):
+    """ Half periods of every pulse drive_motor sends for an operation of max_steps on stepper id, the stray ones included """
+
+    if max_steps < 0:
+        return np.zeros(0, dtype=np.int64)
+    ms_del = STEPPERS[id][0]
+    if profile is None or max_steps == 0:
+        return np.full(max_steps + 2 if max_steps else 1, ms_del, dtype=np.int64)
+    # new_op works out the first delay, each finished pulse the next, and clear_op puts it back to ms_del for the stray one
+    return np.append(step_delays(np.arange(max_steps + 1), max_steps, id, clamp(id, profile)), ms_del)
+
+def pulse_ends(max_steps, id, profile=None):
+    """ Seconds from the start of an operation to the end of each of its pulses """
+    return np.cumsum(pulse_delays(max_steps, id, profile)) * 2 / 1000000
+
+def move_time(angle, id, profile=None):
+    """ Seconds until the firmware counts a move of angle as finished, which is before the stray pulse """
+    ends = pulse_ends(max_steps_for(angle, id), id, profile)
+    return float(ends[-2]) if len(ends) > 1 else 0.0
+
+def execution_time(command, profiles=None):
+    """ protocol.execution_time, with the steppers in profiles (id -> Profile) accelerating """
+
+    profiles = profiles or {}
+    id, angle, dir, terminator = parse(command)
+    if id == BATCH:
+        moves, terminator = parse_batch(command)
+        return max(execution_time("%s_%s_%s_" % move, profiles) for move in moves)
+    if id not in STEPPERS:
+        return 0
+    return move_time(angle, id, profiles.get(id))
+
+def profile_commands(profiles=PROFILES, terminator='N'):
+    return [encode_profile(id, profile.cruise_del, profile.accel, terminator) for id, profile in sorted(profiles.items())]
+
+def ideal_delays(steps, max_steps, id, profile):
+    """ step_delays without the integer maths, straight from v * v = v0 * v0 + 2 * accel * k """
+    steps = np.asarray(steps, dtype=float)
+    k = np.maximum(np.minimum(steps, max_steps - steps), 0)
+    start = HALF_SECOND / STEPPERS[id][0]
+    return np.maximum(HALF_SECOND / np.sqrt(start * start + 2 * profile.accel * k), profile.cruise_del)
+
+def verify(id, profile, tolerance=0.01, longest=None):
+    """ Checks every move length stepper id can make with profile, up to a bit past two ramps, against what the profile
+        promises. Returns a list of problems.
+
+        Each move has to start and finish at ms_del, never go faster than cruise_del, ramp the same both ways and keep
+        every pulse within a fraction tolerance of the half period a perfectly constant acceleration would give it.
+    """
+
+    ms_del = STEPPERS[id][0]
+    profile = clamp(id, profile)
+    problems = []
+    longest = longest or 2 * ramp_steps(id, profile) + 10
+    for max_steps in range(1, longest + 1):
+        delays = step_delays(np.arange(max_steps + 1), max_steps, id, profile)
+        if delays[0] != ms_del or delays[-1] != ms_del:
+            problems.append("%s: a %s step move starts at %sus and ends at %sus, not %sus" % (id, max_steps, delays[0], delays[-1], ms_del))
+        if delays.min() < profile.cruise_del:
+            problems.append("%s: a %s step move goes faster than %sus" % (id, max_steps, profile.cruise_del))
+        if not np.array_equal(delays, delays[::-1]):
+            problems.append("%s: a %s step move slows down differently to how it sped up" % (id, max_steps))
+        ideal = ideal_delays(np.arange(max_steps + 1), max_steps, id, profile)
+        error = np.abs(delays - ideal) / ideal
+        if error.max() > tolerance:
+            problems.append("%s: step %s of a %s step move is %.1f%% off constant acceleration" % (id, error.argmax(), max_steps, 100 * error.max()))
+        if len(problems) > 10:
+            break
+    return problems
+
+def main():
+    from kinematics import JointTracker, script_states
+    from sams import load
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scripts", nargs="*", help=".sams files to time with and without the profiles")
+    parser.add_argument("--verify", action="store_true", help="Check the profiles step by step")
+    args = parser.parse_args()
+
+    code = 0
+    if args.verify:
+        for id, profile in sorted(PROFILES.items()):
+            problems = verify(id, profile)
+            for problem in problems:
+                print(problem)
+            if problems:
+                code = 1
+            else:
+                print("%s: %s OK, cruising after %s steps" % (id, tuple(clamp(id, profile)), ramp_steps(id, clamp(id, profile))))
+
+    total = [0, 0]
+    for path in args.scripts:
+        commands = load(path)
+        times = []
+        for prefix in ([], profile_commands()):
+            tracker = JointTracker()
+            script_states(prefix + commands, tracker)
+            times.append(tracker.stopped())
+        total = [total[0] + times[0], total[1] + times[1]]
+        print("%s: %.1fs, %.1fs with profiles" % (path, times[0], times[1]))
+    if len(args.scripts) > 1 and total[0]:
+        print("Altogether %.1fs, %.1fs with profiles, %.0f%% less" % (total[0], total[1], 100 * (1 - total[1] / total[0])))
+    return code
+
+if __name__ == "__main__":
+    sys.exit(main())
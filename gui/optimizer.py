@@ -0,0 +1,277 @@
+"""
+    Peephole optimizer for .sams scripts
+
+    Scripts saved from the history are full of redundancy: the arrow buttons send s_10_1 nudges one at a time,
+    a nudge the wrong way gets undone straight after, and dragging a wrist slider records every angle it passed through.
+    The optimizer looks at runs of neighbouring commands and
+        - merges back to back moves of the same stepper into one move of the same number of steps
+        - drops runs of moves that cancel out altogether
+        - keeps only the last angle written to each wrist servo in a run of servo writes
+    Everything else (the claw, resets and anything it doesn't recognise) is passed through untouched and ends the run.
+
+    Merges are exact in steps, not degrees. interpret() truncates angle / 0.9 / 2, so s_10 twice is 10 steps
+    while s_20 is 11. The merged angle is picked so that it truncates to the right number of steps.
+
+    Dropping moves that cancel out changes what the arm does on the way, so nothing is optimized unless asked:
+    robot-cli takes --optimize, and the GUI has an Optimize box that covers both running and saving scripts.
+
+        python gui/optimizer.py scripts/weird.sams --output weird-optimized.sams
+"""
+
+import argparse, sys
+
+from protocol import BATCH, END_MARKER, HARD_END_MARKER, PHASE_ANGLE, STEPPERS, execution_time, parse, parse_batch, steps_for_angle, transmit_time
+
+SERVOS = "wr"
+MAX_ANGLE = 9999    # interpret() only reads four digits of the angle
+MAX_PULSES = 0x7FFF # max_steps = goal_steps * multiplier has to fit in an int
+DEGREES_PER_STEP = PHASE_ANGLE * 2
+
+def angle_for_steps(steps):
+    """ Smallest whole angle that interpret() turns into exactly this many steps """
+    angle = int(steps * DEGREES_PER_STEP)
+    while steps_for_angle(angle) < steps:
+        angle += 1
+    return angle
+
+def max_steps(id):
+    """ Most steps one command can move joint id without overflowing the firmware """
+    multiplier = STEPPERS[id][1]
+    steps = MAX_PULSES // multiplier
+    while angle_for_steps(steps) > MAX_ANGLE:
+        steps -= 1
+    return steps
+
+def cost(command):
+    """ Rough seconds a command takes: moving plus pushing it down the wire """
+    return execution_time(command) + transmit_time(len(command))
+
+def classify(command):
+    """ Returns (kind, id, value, terminator) where kind is 'stepper', 'servo' or None for anything we leave alone.
+
+        value is signed steps for steppers (dir 1 counts down towards the limit switch) and the angle for servos.
+    """
+
+    try:
+        id, angle, dir, terminator = parse(command)
+    except ValueError:
+        return None, None, None, None
+    if not terminator or not 0 <= angle <= MAX_ANGLE or dir not in (0, 1):
+        return None, id, None, terminator
+    if id in STEPPERS:
+        steps = steps_for_angle(angle)
+        return 'stepper', id, -steps if dir else steps, terminator
+    if id in SERVOS:
+        return 'servo', id, angle, terminator
+    return None, id, None, terminator
+
+class JointState():
+    """ Where a script leaves each joint, going by what it commands rather than what the motors manage """
+
+    def __init__(self):
+        self.steps = dict.fromkeys(STEPPERS, 0)     # Net steps since the start or the last reset
+        self.servos = dict.fromkeys(SERVOS)         # None until written
+        self.grabs = 0
+        self.resets = 0
+
+    def apply(self, command):
+        kind, id, value, terminator = classify(command)
+        if kind == 'stepper':
+            self.steps[id] += value
+        elif kind == 'servo':
+            # Servo.write() takes anything under 200 as degrees and clamps it, bigger numbers are pulse widths
+            self.servos[id] = max(0, min(180, value)) if value < 200 else value
+        elif id == BATCH:
+            moves, terminator = parse_batch(command)
+            for move in moves:
+                self.apply("%s_%s_%s_%s" % (move + (terminator,)))
+        elif id is not None and id[:1] == 'g':
+            self.grabs += 1
+        elif id is not None and id[:1] == 'Z':
+            # Homing brings the shoulder and elbow back to their switches. The base has no switch yet.
+            self.resets += 1
+            self.steps['s'] = self.steps['e'] = 0
+
+    def state(self):
+        return {
+            "steps": dict(self.steps),
+            "servos": dict(self.servos),
+            "claw toggles": self.grabs % 2,
+            "resets": self.resets,
+        }
+
+def final_state(commands):
+    joints = JointState()
+    for command in commands:
+        joints.apply(command)
+    return joints.state()
+
+def differences(before, after):
+    """ Lists every way two final states (from final_state or JointState.state) disagree. Empty means they're equivalent. """
+
+    found = []
+    for key in before:
+        if isinstance(before[key], dict):
+            for joint in before[key]:
+                if before[key][joint] != after[key][joint]:
+                    found.append("%s %s: %s -> %s" % (key, joint, before[key][joint], after[key][joint]))
+        elif before[key] != after[key]:
+            found.append("%s: %s -> %s" % (key, before[key], after[key]))
+    return found
+
+class Optimizer():
+    """ Wraps any iterable of commands (a list, a sams.Script) and yields the optimized script, streaming as it goes.
+
+        Keeps track of what it removed and of the final joint state of both scripts, so once it's been run through
+        report() says what it saved and differences() should always come back empty.
+    """
+
+    def __init__(self, commands):
+        self.commands = commands
+        self.before = JointState()
+        self.after = JointState()
+        self.commands_in = 0
+        self.commands_out = 0
+        self.seconds_in = 0
+        self.seconds_out = 0
+
+        self.kind = None        # What the run being collected is, 'stepper' or 'servo'
+        self.run = []           # The original commands in the run
+        self.id = None          # Stepper runs: which joint
+        self.net = 0            # Stepper runs: steps so far
+        self.latest = {}        # Servo runs: servo -> last angle, oldest first
+
+    def progress(self):
+        """ How far through the source script we are, if it knows """
+        if hasattr(self.commands, "progress"):
+            return self.commands.progress()
+        if not hasattr(self.commands, "__len__"):
+            return 0
+        return self.commands_in / len(self.commands) if len(self.commands) else 1
+
+    def __iter__(self):
+        last = None     # Last command sent on, to know whether the motors were idle when the run started. Scripts start with them idle.
+        for command in self.commands:
+            self.commands_in += 1
+            self.seconds_in += cost(command)
+            self.before.apply(command)
+
+            kind, id, value, terminator = classify(command)
+            if not self.joins(kind, id):
+                for output in self.flush(last):
+                    last = output
+                    yield self.emit(output)
+            if kind is None:
+                last = command
+                yield self.emit(command)
+                continue
+
+            self.kind = kind
+            self.run.append(command)
+            if kind == 'stepper':
+                self.id = id
+                self.net += value
+            else:
+                self.latest.pop(id, None)   # Move it to the end, so the servos are written in the same order as last time
+                self.latest[id] = value
+
+        for output in self.flush(last):
+            yield self.emit(output)
+
+    def joins(self, kind, id):
+        """ True if a command of this kind can be folded into the current run """
+
+        if not self.run or kind != self.kind:
+            return False
+        if kind == 'stepper':
+            # An n move gets cut short by the next move on the same joint, so only merge moves that ran to the end
+            return id == self.id and self.run[-1].endswith(HARD_END_MARKER)
+        return True
+
+    def flush(self, last):
+        """ Returns the commands the current run boils down to """
+
+        if not self.run:
+            return []
+        run, kind = self.run, self.kind
+        held = any(command.endswith(HARD_END_MARKER) for command in run)
+        terminator = run[-1][-1]
+
+        if kind == 'stepper':
+            output = self.merge_steps(run, terminator)
+            if not output and terminator == HARD_END_MARKER and last is not None and not last.endswith(HARD_END_MARKER):
+                # Dropping the run would also drop its wait for the motors, and the move before it might still be going
+                output = run
+        else:
+            output = []
+            for id, angle in self.latest.items():
+                output.append("%s_%s_0_%s" % (id, angle, END_MARKER))
+            if held:
+                output[-1] = output[-1][:-1] + HARD_END_MARKER
+
+        if len(output) >= len(run):
+            output = run    # Nothing gained, so leave it as it was written
+        self.run, self.kind, self.id, self.net, self.latest = [], None, None, 0, {}
+        return output
+
+    def merge_steps(self, run, terminator):
+        """ Moves self.net steps in as few commands as will fit in the firmware's ints. Empty if they cancelled out. """
+
+        output = []
+        remaining = abs(self.net)
+        dir = 1 if self.net < 0 else 0
+        limit = max_steps(self.id)
+        while remaining:
+            steps = min(remaining, limit)
+            remaining -= steps
+            output.append("%s_%s_%s_%s" % (self.id, angle_for_steps(steps), dir, HARD_END_MARKER if remaining else terminator))
+        return output
+
+    def emit(self, command):
+        self.commands_out += 1
+        self.seconds_out += cost(command)
+        self.after.apply(command)
+        return command
+
+    def differences(self):
+        return differences(self.before.state(), self.after.state())
+
+    def stats(self):
+        return {
+            "commands_in": self.commands_in,
+            "commands_out": self.commands_out,
+            "removed": self.commands_in - self.commands_out,
+            "seconds_saved": self.seconds_in - self.seconds_out,
+        }
+
+    def report(self):
+        return "Optimizer removed %(removed)s of %(commands_in)s commands, about %(seconds_saved).2fs" % self.stats()
+
+def optimize(commands):
+    """ Optimizes a whole script at once. Returns (optimized list, Optimizer) so the caller can report or check it. """
+    optimizer = Optimizer(commands)
+    return list(optimizer), optimizer
+
+def main():
+    from sams import Script
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("script", help=".sams file to optimize")
+    parser.add_argument("--output", help="Write the optimized script here")
+    args = parser.parse_args()
+
+    script, optimizer = optimize(Script(args.script))
+    print(optimizer.report())
+    problems = optimizer.differences()
+    for problem in problems:
+        print("MISMATCH: " + problem)
+    if problems:
+        return 1
+
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write("".join(script))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,265 @@
+"""
+    Trajectory planner: waypoint paths compiled into step-exact scripts
+
+    A path is a text file with one waypoint per line:
+        200 0 150               the claw tip at x, y, z in mm, solved with ik.py
+        s=30 e=45 b=-10 w=90    joint angles, steppers in degrees from their limit switches and servos as written.
+                                Joints left out stay where they are.
+        gN                      anything else ending in n or N goes in the script as it is, so the claw and resets can too.
+                                Moves in there are followed, but mind that a plain n one gets cut short by the next move.
+        # comments and blank lines are ignored
+
+    interpret() truncates every move to whole steps, so a path built out of separate moves (like ik.moves makes) drifts
+    a little further off with every waypoint. The planner rounds where each joint should be in total instead: for every
+    waypoint at once, with NumPy, it picks the whole number of steps from the start of the path that lands nearest, so
+    what one move loses the next makes up. The two stray pulses drive_motor adds to the end of every move are counted in too.
+
+    Each waypoint becomes one move for every joint that changes, all started together, either as a batch or as plain n
+    commands with the last one held (N) so the next waypoint waits for them all to stop.
+
+        python gui/planner.py path.txt --output path.sams --batch
+"""
+
+import argparse, sys
+
+import numpy as np
+
+from kinematics import DEGREES_PER_STEP, JointTracker
+from optimizer import SERVOS, angle_for_steps, max_steps
+from protocol import END_MARKER, HARD_END_MARKER, MAX_COMMAND_LENGTH, STEPPERS, encode_batch, execution_time
+
+STRAY_PULSES = 2    # drive_motor's extra pulses on every move, see kinematics.pulses_for
+SETTLE_ROUNDS = 8   # Which moves pick up stray pulses depends on which moves happen, so quantize() goes round a few times
+
+class PathError(ValueError):
+    pass
+
+def parse_path(lines):
+    """ Turns the lines of a path into waypoints: ('xyz', (x, y, z)), ('joints', {id: angle}) or ('command', text) """
+
+    waypoints = []
+    for number, line in enumerate(lines, 1):
+        line = line.split("#")[0].strip()
+        if not line:
+            continue
+        fields = line.split()
+        try:
+            if all("=" in field for field in fields):
+                joints = {}
+                for field in fields:
+                    id, value = field.split("=", 1)
+                    if id not in STEPPERS and id not in SERVOS:
+                        raise ValueError("there's no joint %r" % id)
+                    joints[id] = float(value)
+                waypoints.append(('joints', joints))
+            elif len(fields) == 3:
+                waypoints.append(('xyz', tuple(float(field) for field in fields)))
+            elif len(fields) == 1 and line[-1] in (END_MARKER, HARD_END_MARKER):
+                waypoints.append(('command', line))
+            else:
+                raise ValueError("expected x y z, joint=angle or a command")
+        except ValueError as e:
+            raise PathError("Line %s, %r: %s" % (number, line, e))
+    return waypoints
+
+def reached(steps, start, multiplier):
+    """ Where a joint is after each of a run of moves, in pulses. Negative steps are towards the switch. """
+    steps = np.asarray(steps)
+    return start + np.cumsum(steps * multiplier + STRAY_PULSES * np.sign(steps))
+
+def quantize(targets, start, multiplier):
+    """ Steps for each of a run of moves on one joint that land it nearest targets (in pulses, fractions and all)
+        after each, starting from start. Returns an int array, negative for towards the switch.
+    """
+
+    targets = np.asarray(targets, dtype=float) - start
+    stray = np.zeros(len(targets))
+    for i in range(SETTLE_ROUNDS):
+        steps = np.diff(np.rint((targets - stray) / multiplier), prepend=0).astype(int)
+        settled = STRAY_PULSES * np.cumsum(np.sign(steps))
+        if np.array_equal(settled, stray):
+            break
+        stray = settled
+    return steps
+
+def truncated(targets, start, multiplier):
+    """ Steps for the same moves made one at a time, each truncated like interpret() does. For comparison. """
+    deltas = np.diff(np.asarray(targets, dtype=float), prepend=start)
+    return np.trunc(deltas / multiplier).astype(int)
+
+def stepper_commands(id, steps, terminator):
+    """ Commands that move stepper id by steps: a held one for each max_steps a long move needs, then the rest """
+
+    dir = 1 if steps < 0 else 0     # Dir 1 is towards the switch, which counts down
+    steps = abs(int(steps))
+    limit = max_steps(id)
+    commands = []
+    while steps > limit:
+        commands.append("%s_%s_%s_%s" % (id, angle_for_steps(limit), dir, HARD_END_MARKER))
+        steps -= limit
+    if steps:
+        commands.append("%s_%s_%s_%s" % (id, angle_for_steps(steps), dir, terminator))
+    return commands
+
+def batches(moves):
+    """ Folds moves on different joints into as few batches as fit in the robot's buffer """
+
+    groups = [[]]
+    for move in moves:
+        if groups[-1] and len(encode_batch(groups[-1] + [move])) > MAX_COMMAND_LENGTH:
+            groups.append([])
+        groups[-1].append(move)
+    return [group[0] if len(group) == 1 else encode_batch(group) for group in groups]
+
+class Planner():
+    """ Compiles waypoints into commands.
+
+        start is a JointTracker for where the arm is when the script starts, by default one straight after a reset.
+        table is the ik.Table for x, y, z waypoints, built when the first one turns up if not given.
+        With batch, each waypoint's moves go in as few batch commands as fit.
+    """
+
+    def __init__(self, start=None, table=None, batch=False):
+        start = start or JointTracker()
+        pulses = start.pulses()
+        self.position = {id: float(pulses[id]) for id in STEPPERS}  # Where the arm will really be, whole pulses
+        self.servos = dict(start.servos)
+        self.table = table
+        self.batch = batch
+        self.stats = {
+            "waypoints": 0,
+            "commands": 0,
+            "seconds": 0,           # Moving, with joints running at the same time
+            "seconds_apart": 0,     # Moving, if every move ran one after another
+            "error": dict.fromkeys(STEPPERS, 0),        # Furthest any joint ends up from a target, in pulses
+            "error_truncated": dict.fromkeys(STEPPERS, 0),  # The same for separate truncated moves
+        }
+
+    def solve(self, waypoint, pulses, servos):
+        """ Target pulses and servo angles for a waypoint, given the targets before it """
+
+        kind, value = waypoint
+        pulses, servos = dict(pulses), dict(servos)
+        if kind == 'xyz':
+            from ik import Table, solve
+            if self.table is None:
+                self.table = Table()
+            solution = solve(*value, self.table, pulses)
+            if solution is None:
+                raise PathError("Can't reach x %s y %s z %s" % value)
+            pulses, servos['w'] = solution
+        else:
+            for id, angle in value.items():
+                if id in STEPPERS:
+                    pulses[id] = angle * STEPPERS[id][1] / DEGREES_PER_STEP
+                else:
+                    servos[id] = int(round(angle))
+        return pulses, servos
+
+    def plan(self, waypoints):
+        """ The commands for a whole path, as a list """
+
+        commands = []
+        run = []
+        pulses, servos = self.position, self.servos
+        for waypoint in waypoints:
+            if waypoint[0] == 'command':
+                commands += self.compile(run)
+                run = []
+                commands.append(waypoint[1])
+                self.stats["commands"] += 1
+                self.follow(waypoint[1])
+                pulses, servos = self.position, self.servos
+            else:
+                pulses, servos = self.solve(waypoint, pulses, servos)
+                run.append((pulses, servos))
+        return commands + self.compile(run)
+
+    def follow(self, command):
+        """ Keeps up with a command from the path that the planner didn't make, a reset or a move of its own """
+
+        tracker = JointTracker()
+        tracker.position = dict(self.position)
+        tracker.servos = dict(self.servos)
+        try:
+            tracker.sent(command, 0)
+        except ValueError:
+            return      # Not one the tracker understands, so it can't have moved anything it knows about
+        self.position = {id: float(pulses) for id, pulses in tracker.pulses(tracker.stopped()).items()}
+        self.servos = tracker.servos
+
+    def compile(self, run):
+        """ Commands for a run of (pulses, servos) targets with nothing else in between """
+
+        if not run:
+            return []
+        self.stats["waypoints"] += len(run)
+        steps = {}
+        for id in STEPPERS:
+            multiplier = STEPPERS[id][1]
+            targets = np.array([pulses[id] for pulses, servos in run])
+            steps[id] = quantize(targets, self.position[id], multiplier)
+            ends = reached(steps[id], self.position[id], multiplier)
+            naive = reached(truncated(targets, self.position[id], multiplier), self.position[id], multiplier)
+            self.stats["error"][id] = max(self.stats["error"][id], float(np.abs(ends - targets).max()))
+            self.stats["error_truncated"][id] = max(self.stats["error_truncated"][id], float(np.abs(naive - targets).max()))
+            self.position[id] = float(ends[-1])
+
+        commands = []
+        for i, (pulses, servos) in enumerate(run):
+            held = []
+            moves = []
+            for id in STEPPERS:
+                split = stepper_commands(id, steps[id][i], END_MARKER)
+                held += split[:-1]
+                moves += split[-1:]
+            for id in SERVOS:
+                if servos[id] != self.servos[id]:
+                    moves.append("%s_%s_0_%s" % (id, servos[id], END_MARKER))
+                    self.servos[id] = servos[id]
+            if not moves:
+                continue
+            self.stats["seconds"] += sum(execution_time(command) for command in held) + max(execution_time(command) for command in moves)
+            self.stats["seconds_apart"] += sum(execution_time(command) for command in held + moves)
+            if self.batch:
+                moves = batches(moves)
+            # Everything in the waypoint starts at once, and the N on the end holds the next waypoint until it's all stopped
+            moves[-1] = moves[-1][:-1] + HARD_END_MARKER
+            commands += held + moves
+        self.stats["commands"] += len(commands)
+        return commands
+
+    def report(self):
+        stats = self.stats
+        return "Planned %s waypoints in %s commands, about %.2fs of moving (%.2fs one joint at a time). Furthest off %s pulses, %s with truncated moves" % (
+            stats["waypoints"], stats["commands"], stats["seconds"], stats["seconds_apart"],
+            "/".join("%.1f" % stats["error"][id] for id in STEPPERS), "/".join("%.1f" % stats["error_truncated"][id] for id in STEPPERS))
+
+def plan(waypoints, start=None, table=None, batch=False):
+    """ Plans a whole path at once. Returns (commands, Planner) so the caller can report on it. """
+    planner = Planner(start, table, batch)
+    return planner.plan(waypoints), planner
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="Waypoints, one per line")
+    parser.add_argument("--output", help="Write the script here rather than to stdout")
+    parser.add_argument("--batch", action="store_true", help="Move each waypoint's joints with one batch command. Needs firmware that supports them.")
+    args = parser.parse_args()
+
+    try:
+        with open(args.path) as file:
+            script, planner = plan(parse_path(file), batch=args.batch)
+    except PathError as e:
+        print(e, file=sys.stderr)
+        return 1
+    print(planner.report(), file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write("".join(script))
+    else:
+        print("".join(script))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,241 @@
+"""
+    Bits of the serial protocol shared by the GUI, the CLI and the helper scripts
+
+    Commands are ASCII strings: [id]_[angle]_[dir]_ followed by a terminator.
+    A batch, m_[id]_[angle]_[dir]_[id]_[angle]_[dir]..., starts moves on several joints at once and acks once they've all stopped.
+    A trailing 'n' just sends the command, a trailing 'N' asks the robot to write a single '0' back once the command has finished moving.
+    Anything else the robot sends back is a line ending in \\r\\n, so a '0' at the start of a line is always an ack.
+    It used to echo every text command, but now it only answers the ones that ask something, see TELEMETRY.
+    In queue mode the robot also writes a '+' for every move it takes off a motor's queue, see QUEUE.
+"""
+
+BAUDRATE = 9600         # Baudrate of both the rfcomm0 port and the usb connection
+BUFFER_SIZE = 32        # Size of receivedChars in interpreter.ino
+MAX_COMMAND_LENGTH = BUFFER_SIZE - 1    # read() needs one spare character to terminate the string
+
+ACK = b'0'
+CREDIT = b'+'
+END_MARKER = 'n'
+HARD_END_MARKER = 'N'
+
+def wants_ack(command):
+    """ True if the robot will write an ack back once it has finished this command """
+    return command.endswith(HARD_END_MARKER)
+
+def transmit_time(n_bytes, baudrate=BAUDRATE):
+    """ Seconds it takes to push n_bytes down the line. 8N1 framing means 10 bits per byte. """
+    return n_bytes * 10 / baudrate
+
+class ReplyParser():
+    """ Splits the raw byte stream coming back from the robot into acks, credits and lines """
+
+    def __init__(self):
+        self.line = bytearray()
+
+    def feed(self, data):
+        """ Returns a list of ('ack', None), ('credit', None) and ('line', text) events for the bytes received so far """
+        events = []
+        for byte in data:
+            if not self.line and byte == ACK[0]:
+                events.append(('ack', None))
+            elif not self.line and byte == CREDIT[0]:
+                events.append(('credit', None))
+            elif byte == ord('\n'):
+                events.append(('line', self.line.decode(errors="replace").rstrip('\r')))
+                self.line.clear()
+            else:
+                self.line.append(byte)
+        return events
+
+# Mirrors the StepperMotor setup in interpreter.ino: id -> (ms_del in us, multiplier)
+STEPPERS = {
+    's': (10000, 8),    # Both shoulder steppers move together
+    'e': (5000, 6),
+    'b': (5000, 20),
+}
+PHASE_ANGLE = 0.9
+
+BATCH = 'm'
+BATCH_JOINTS = "sebwr"  # Joints a batch can move. Each one at most once, since a second move would cut the first short.
+
+# as_2500_400n sets the shoulder's acceleration profile: a cruise half period of 2500us, reached at 400 pulses/s/s.
+# The id is the PROFILE prefix plus the stepper, so parse() reads it as an ordinary command. See motion.py.
+PROFILE = 'a'
+
+def parse(command):
+    """ Splits a command into (id, angle, dir, terminator). Single character commands like g and Z, and batches, get an angle and dir of 0. """
+
+    terminator = command[-1] if command[-1:] in (END_MARKER, HARD_END_MARKER) else ''
+    body = command[:len(command) - len(terminator)].rstrip('_')
+    fields = body.split('_')
+    if fields[0] == BATCH:
+        parse_batch(command)
+        return BATCH, 0, 0, terminator
+    if not body or len(fields) not in (1, 3):
+        raise ValueError("Malformed command %r" % command)
+    if len(fields) == 1:
+        return fields[0], 0, 0, terminator
+    return fields[0], int(fields[1]), int(fields[2]), terminator
+
+def parse_batch(command):
+    """ Splits a batch into ([(id, angle, dir), ...], terminator) """
+
+    terminator = command[-1] if command[-1:] in (END_MARKER, HARD_END_MARKER) else ''
+    fields = command[:len(command) - len(terminator)].rstrip('_').split('_')
+    if fields[0] != BATCH or len(fields) < 4 or (len(fields) - 1) % 3:
+        raise ValueError("Malformed batch %r" % command)
+    moves = []
+    for i in range(1, len(fields), 3):
+        id = fields[i]
+        if id not in BATCH_JOINTS or id in [move[0] for move in moves]:
+            raise ValueError("Batch %r can't move %r" % (command, id))
+        moves.append((id, int(fields[i + 1]), int(fields[i + 2])))
+    return moves, terminator
+
+def encode_batch(commands):
+    """ Folds single joint commands into one batch. It asks for an ack if any of them did. """
+
+    moves = []
+    terminator = END_MARKER
+    for command in commands:
+        id, angle, dir, end = parse(command)
+        moves.append("%s_%s_%s" % (id, angle, dir))
+        if end == HARD_END_MARKER:
+            terminator = HARD_END_MARKER
+    return "_".join([BATCH] + moves) + "_" + terminator
+
+# q_1_0n puts the robot in queue mode and q_0_0n takes it out. In queue mode a move waits on its motor's queue for the
+# one before it to finish, rather than cutting it short, and the robot writes a CREDIT as each one starts.
+# qn just asks. The robot answers any of them with a line: Q <moves each motor can queue, 0 if off> <waiting on s> <e> <b>
+QUEUE = 'q'
+QUEUE_QUERY = "qn"
+QUEUE_REPORT_PREFIX = "Q"
+
+def queue_mode(on):
+    return "%s_%s_0_%s" % (QUEUE, 1 if on else 0, END_MARKER)
+
+def parse_queue_report(line):
+    """ Turns a reply like "Q 8 1 0 2" into (queue size, {id: moves waiting}), or None if it isn't one """
+
+    fields = line.split()
+    if len(fields) != 5 or fields[0] != QUEUE_REPORT_PREFIX or not all(field.isdigit() for field in fields[1:]):
+        return None
+    return int(fields[1]), dict(zip("seb", (int(field) for field in fields[2:])))
+
+def queued_moves(command):
+    """ How many motor queue slots a command takes up in queue mode: one for each stepper it moves """
+
+    id, angle, dir, terminator = parse(command)
+    if id == BATCH:
+        moves, terminator = parse_batch(command)
+        return sum(1 for move in moves if move[0] in STEPPERS)
+    return 1 if id in STEPPERS else 0
+
+# Z sends the shoulder and elbow back to their limit switches. Robots with CAPABILITY_HOMING do it without blocking
+# and report as they go with lines like "H 1 150": a HOMING_ code and the passes so far, one pulse on each joint per
+# pass. The robot takes nothing else until it's finished, apart from HOME_CANCEL if that's the next thing it reads.
+RESET = "Zn"
+HOME_CANCEL = "xn"
+HOMING_REPORT_PREFIX = "H"
+HOMING_DONE = 0
+HOMING_RUNNING = 1
+HOMING_CANCELLED = 2
+HOMING_GAVE_UP = 3      # Ran out of passes without both switches closing
+HOMING_REPORT_PASSES = 50   # Passes between progress reports
+HOMING_LIMIT = 20000
+
+def parse_homing_report(line):
+    """ Turns a reply like "H 1 150" into (code, passes), or None if it isn't one """
+
+    fields = line.split()
+    if len(fields) != 3 or fields[0] != HOMING_REPORT_PREFIX or not all(field.isdigit() for field in fields[1:]):
+        return None
+    return int(fields[1]), int(fields[2])
+
+# t_250_0n has the robot send a line of telemetry every 250ms, t_0_0n stops it and tn asks for one straight away.
+# Periods under TELEMETRY_MIN_PERIOD get bumped up to it. telemetry.py decodes the lines.
+TELEMETRY = 't'
+TELEMETRY_QUERY = "tn"
+TELEMETRY_PREFIX = "T"
+TELEMETRY_MIN_PERIOD = 100  # ms, telemetryMinPeriod. A report is around 50 bytes, half of what the link can carry in that time.
+
+def telemetry_mode(period):
+    """ The command that sets the telemetry period in ms. 0 turns it off. """
+    return "%s_%s_0_%s" % (TELEMETRY, period, END_MARKER)
+
+def encode_profile(id, cruise_del, accel, terminator=END_MARKER):
+    """ The command that gives stepper id an acceleration profile. An accel of 0 turns it off. """
+    return "%s%s_%s_%s_%s" % (PROFILE, id, cruise_del, accel, terminator)
+
+def steps_for_angle(angle):
+    """ Same truncation as interpret(): int steps = (angle / phase_angle)/2 """
+    return int((angle / PHASE_ANGLE) / 2)
+
+def execution_time(command):
+    """ Seconds the robot spends moving for a command. Servo and single character commands are treated as instant. """
+
+    id, angle, dir, terminator = parse(command)
+    if id == BATCH:
+        # Everything in a batch moves at once
+        moves, terminator = parse_batch(command)
+        return max(execution_time("%s_%s_%s_" % move) for move in moves)
+    if id not in STEPPERS:
+        return 0
+    ms_del, multiplier = STEPPERS[id]
+    # drive_motor pulses while steps <= max_steps, and every pulse takes two lots of ms_del
+    return (steps_for_angle(angle) * multiplier + 1) * 2 * ms_del / 1000000
+
+# Binary framing, the same commands in four bytes: [0x80 | joint][packed high][packed low][n or N]
+# The packed field is angle << 1 | dir. The top bit of the opcode can never appear at the start of an ASCII command, so the robot can accept both.
+BINARY_FLAG = 0x80
+BINARY_JOINTS = "sebwrgZ"   # Opcode is BINARY_FLAG | index in this string
+FRAME_SIZE = 4
+MAX_BINARY_ANGLE = 0x3FFF   # Keeps the high byte below 0x80 so a dropped byte can't look like the start of a frame
+
+# Sent at connect time. Robots that understand it reply with a line like "SAM 2 B", where the letters are capabilities.
+IDENTIFY = "?n"
+# Sent ahead of an identify after the link drops. If the robot was left holding part of a binary frame, these fill it up
+# without an end marker so it gets thrown away, and the n finishes off anything else as a line that does nothing.
+FLUSH = "___n"
+RESYNC = FLUSH + IDENTIFY
+ACK_COUNT_MODULO = 0x10000  # The robot's count of acks sent, on the end of its identity, is an unsigned int
+IDENTITY_PREFIX = "SAM"
+CAPABILITY_BINARY = "B"
+CAPABILITY_BATCH = "M"
+CAPABILITY_PROFILE = "A"
+CAPABILITY_QUEUE = "Q"
+CAPABILITY_HOMING = "H"
+CAPABILITY_TELEMETRY = "T"
+
+def encode_ascii(command):
+    return command.encode()
+
+def encode_binary(command):
+    """ Packs a command into a binary frame. Raises ValueError for anything that doesn't fit. """
+
+    id, angle, dir, terminator = parse(command)
+    if id not in BINARY_JOINTS or not terminator or not 0 <= angle <= MAX_BINARY_ANGLE or dir not in (0, 1):
+        raise ValueError("Command %r has no binary encoding" % command)
+    packed = angle << 1 | dir
+    return bytes((BINARY_FLAG | BINARY_JOINTS.index(id), packed >> 8, packed & 0xFF, ord(terminator)))
+
+def decode_binary(frame):
+    """ Turns a binary frame back into the equivalent ASCII command """
+
+    if len(frame) != FRAME_SIZE or not frame[0] & BINARY_FLAG or chr(frame[3]) not in (END_MARKER, HARD_END_MARKER):
+        raise ValueError("Malformed frame %r" % bytes(frame))
+    joint = frame[0] & ~BINARY_FLAG
+    if joint >= len(BINARY_JOINTS):
+        raise ValueError("Unknown opcode in frame %r" % bytes(frame))
+    id = BINARY_JOINTS[joint]
+    packed = frame[1] << 8 | frame[2]
+    if id in "gZ":
+        return id + chr(frame[3])
+    return "%s_%s_%s_%s" % (id, packed >> 1, packed & 1, chr(frame[3]))
+
+def binary_encoder(command):
+    """ Binary where the command has an encoding, plain ASCII where it doesn't """
+    try:
+        return encode_binary(command)
+    except ValueError:
+        return encode_ascii(command)
@@ -1,19 +1,280 @@
-import bluetooth
+"""
+    Command line interface for S.A.M
+
+    With no scripts it's the old line at a time loop: type a command, see what the robot says back.
+    Give it .sams files, or - for commands on stdin, and it runs them headless with the same pipelined
+    executor and ack handling as the GUI, without needing GTK:
+
+        python gui/robot-cli.py scripts/weird.sams --stats -
+        generate-moves | python gui/robot-cli.py - --timeout 60
+        python gui/robot-cli.py scripts/weird.sams --simulate 20
+        python gui/robot-cli.py scripts/weird.sams --port socket://localhost:7777
+        python gui/robot-cli.py scripts/*.sams --queue --simulate 20
+        python gui/robot-cli.py scripts/weird.sams --telemetry 250 --stats -
+        python gui/robot-cli.py scripts/weird.sams --trace /tmp/weird.json
+
+    If the link drops part way through, the port is reopened and whatever the robot didn't finish is sent again,
+    see transport.py. --port takes anything pyserial can open, so the simulator's --tcp mode works for trying that out.
+
+    Exit codes:
+        0   every script ran to the end
+        1   a script had a command the robot wouldn't understand, or failed --check
+        2   bad arguments
+        3   couldn't open the port, or it stayed down too long to reconnect
+        4   the robot stopped acking for --ack-timeout seconds
+        5   ran past --timeout
+        130 interrupted
+"""
+
+import argparse, json, os, sys, threading, time
+
 import serial
 
+from executor import DEFAULT_WINDOW, ScriptExecutor
+from discovery import discover
+from link import IDENTIFY_TIMEOUT, SerialReader, identify
+from protocol import (BAUDRATE, CAPABILITY_BATCH, CAPABILITY_BINARY, CAPABILITY_PROFILE, CAPABILITY_QUEUE, CAPABILITY_TELEMETRY, END_MARKER, ReplyParser,
+                      binary_encoder, encode_ascii, parse_queue_report, queue_mode, telemetry_mode)
+from sams import Script, ScriptError, parse_stream
+from optimizer import Optimizer
+from transport import Transport, opener
+
 MODULE_ADDRESS = "98:D3:71:FD:42:23"
+ACK_TIMEOUT = 30    # Longest a single move should take, with plenty to spare
 
+EXIT_OK = 0
+EXIT_SCRIPT_ERROR = 1
+EXIT_USAGE = 2          # What argparse exits with
+EXIT_NO_CONNECTION = 3
+EXIT_ACK_TIMEOUT = 4
+EXIT_TIMEOUT = 5
+EXIT_INTERRUPTED = 130
 
 port = 1
 
+#import bluetooth
 #sock=bluetooth.BluetoothSocket( bluetooth.RFCOMM )
 #sock.connect((MODULE_ADDRESS, port))
+#sock.close()
+
+def interactive(ser):
+    # The robot only answers commands that ask it something, so print whatever comes back as it comes rather than waiting for a line
+    def show():
+        parser = ReplyParser()
+        while ser.is_open:
+            for kind, value in parser.feed(ser.read(1)):
+                print(value if kind == 'line' else kind)
+
+    threading.Thread(target=show, daemon=True).start()
+    while True:
+        ser.write(input().encode())
+
+def stdin_commands():
+    # A line at a time, so commands run as they're piped in rather than once a whole chunk has built up
+    for command, position in parse_stream(sys.stdin, chunk_size=None):
+        yield command
+
+def connect(args):
+    """ Opens the port, the simulator with --simulate, or whichever port answers as the robot if neither was given """
+    if args.simulate:
+        from simulator import SimulatedSerial
+        return SimulatedSerial(speed=args.simulate)
+    if args.port:
+        return Transport(opener(args.port), name=args.port)
+    found = discover()
+    if found is None:
+        raise serial.SerialException("couldn't open any port S.A.M might be on")
+    if found.identity is None:
+        print("Nothing answered as S.A.M, trying %s as older firmware" % found.port, file=sys.stderr)
+    args.port = found.port
+    return Transport(opener(found.port), connection=found.ser, name=found.port)
+
+def run_scripts(ser, args, stats):
+    """ Runs every script in turn. Returns the exit code. """
+
+    reader = SerialReader(ser)
+    reader.start()
+    started = time.monotonic()
+    deadline = started + args.timeout if args.timeout else None
+
+    encode, batch = encode_ascii, False
+    identity = None
+    if not args.ascii:
+        identity = identify(ser, reader)
+        if identity is not None:
+            stats["firmware"] = "%s %s" % (identity.version, "".join(sorted(identity.capabilities)))
+            if CAPABILITY_BINARY in identity.capabilities:
+                encode = binary_encoder
+            batch = CAPABILITY_BATCH in identity.capabilities and not args.no_batch
+    stats["encoding"] = "binary" if encode is binary_encoder else "ascii"
+    stats["batch"] = batch
+    stats["accel"] = False
+    setup = []     # Sent again if the board resets part way through
+    if args.accel:
+        if identity is not None and CAPABILITY_PROFILE in identity.capabilities:
+            from motion import profile_commands
+            ScriptExecutor(ser, reader, window=args.window, encode=encode, timeout=args.ack_timeout).run(profile_commands())
+            setup = profile_commands(terminator=END_MARKER)
+            stats["accel"] = True
+        else:
+            print("The robot doesn't do acceleration profiles, moving at constant speed", file=sys.stderr)
+    queue_size = None
+    if args.queue:
+        if identity is not None and CAPABILITY_QUEUE in identity.capabilities:
+            ser.write(queue_mode(True).encode())
+            line = reader.wait_for_line(lambda line: parse_queue_report(line) is not None, IDENTIFY_TIMEOUT)
+            if line is not None:
+                queue_size = parse_queue_report(line)[0] or None
+        if queue_size is None:
+            print("The robot doesn't queue moves, waiting on acks instead", file=sys.stderr)
+    stats["queue_size"] = queue_size
+    monitor = None
+    if args.telemetry:
+        if identity is not None and CAPABILITY_TELEMETRY in identity.capabilities:
+            from telemetry import Monitor, parse_telemetry
+            monitor = Monitor()
+            ser.write(telemetry_mode(args.telemetry).encode())
+        else:
+            print("The robot doesn't send telemetry", file=sys.stderr)
+    stats["connect_time"] = time.monotonic() - started
+    tracer = None
+    if args.trace:
+        from tracing import Tracer
+        # The simulator speeds the baudrate up along with everything else
+        tracer = Tracer(baudrate=BAUDRATE * (args.simulate or 1))
+
+    def running():
+        # Lines pile up otherwise
+        for line in reader.drain_lines():
+            if monitor is not None:
+                report = parse_telemetry(line)
+                if report is not None:
+                    monitor.report(report)
+            if args.echo:
+                print(line, file=sys.stderr)
+        return deadline is None or time.monotonic() < deadline
+
+    code = EXIT_OK
+    stats["scripts"] = []
+    for filename in args.scripts:
+        if args.check and filename != "-":
+            from kinematics import check
+            try:
+                problems = check(Script(filename))
+            except ScriptError:
+                problems = []   # Reported properly when it runs
+            if problems:
+                print("%s: %s" % (filename, "\n".join(problems)), file=sys.stderr)
+                code = EXIT_SCRIPT_ERROR
+                break
+        script = stdin_commands() if filename == "-" else Script(filename)
+        if args.optimize:
+            script = Optimizer(script)
+        # Batching waits to see the next command before sending, which could be forever if stdin is someone typing
+        executor = ScriptExecutor(ser, reader, window=args.window, encode=encode, batch=batch and filename != "-", timeout=args.ack_timeout, queue_size=queue_size, monitor=monitor, tracer=tracer, setup=setup)
+
+        start = time.monotonic()
+        try:
+            completed = executor.run(script, running=running)
+        except ScriptError as e:
+            print("%s: %s" % (filename, e), file=sys.stderr)
+            completed = False
+            code = EXIT_SCRIPT_ERROR
+        else:
+            if executor.timed_out:
+                print("%s: no ack from the robot in %ss" % (filename, args.ack_timeout), file=sys.stderr)
+                code = EXIT_ACK_TIMEOUT
+            elif not completed:
+                print("%s: ran out of time" % filename, file=sys.stderr)
+                code = EXIT_TIMEOUT
+
+        if tracer is not None:
+            tracer.span(filename, start)
+        result = {"script": filename, "completed": completed, "wall_time": time.monotonic() - start}
+        result.update(executor.stats())
+        if args.optimize:
+            result["optimizer"] = script.stats()
+        stats["scripts"].append(result)
+        if code != EXIT_OK:
+            break
+
+    if queue_size:
+        ser.write(queue_mode(False).encode())
+    if monitor is not None:
+        ser.write(telemetry_mode(0).encode())
+    running()
+    if monitor is not None:
+        stats["telemetry"] = monitor.snapshot()
+    if tracer is not None:
+        try:
+            tracer.save(args.trace)
+        except OSError as e:
+            print("Couldn't save the trace: %s" % e, file=sys.stderr)
+        print(tracer.table(), file=sys.stderr)
+    reader.stop()
+    reader.join()
+    stats["bytes_read"] = reader.bytes_read
+    if hasattr(ser, "health"):
+        stats["link"] = ser.health()
+    stats["wall_time"] = time.monotonic() - started
+    return code
+
+def write_stats(stats, destination):
+    text = json.dumps(stats, indent=2)
+    if destination == "-":
+        print(text)
+    else:
+        with open(destination, "w") as file:
+            file.write(text + "\n")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scripts", nargs="*", help=".sams files to run in order, - reads commands from stdin. None for the interactive loop.")
+    parser.add_argument("--port", default=os.environ.get("SAM_PORT"), help="Serial port, defaults to $SAM_PORT or finding it")
+    parser.add_argument("--simulate", type=float, metavar="SPEED", help="Run against the simulator at this many times real time instead of a port")
+    parser.add_argument("--window", type=int, default=DEFAULT_WINDOW, help="Scripted commands in flight at once, 1 for stop and wait")
+    parser.add_argument("--ascii", action="store_true", help="Don't ask the robot what it supports, just send plain ASCII")
+    parser.add_argument("--no-batch", action="store_true", help="Don't batch moves even if the robot can")
+    parser.add_argument("--optimize", action="store_true", help="Run scripts through the peephole optimizer first")
+    parser.add_argument("--accel", action="store_true", help="Turn on the acceleration profiles from motion.py first, if the robot has them")
+    parser.add_argument("--queue", action="store_true", help="Put the robot in queue mode so moves on the same joint go without waiting for acks, if it can")
+    parser.add_argument("--check", action="store_true", help="Refuse to run a script that drives a joint past its limit switch, see kinematics.py")
+    parser.add_argument("--timeout", type=float, help="Give up after this many seconds in total")
+    parser.add_argument("--ack-timeout", type=float, default=ACK_TIMEOUT, help="Give up if the robot goes this long without an ack")
+    parser.add_argument("--stats", metavar="FILE", help="Write timing stats as JSON to FILE, - for stdout")
+    parser.add_argument("--telemetry", type=int, metavar="MS", help="Have the robot report how it's doing every MS milliseconds, if it can, and put a summary in the stats")
+    parser.add_argument("--trace", metavar="FILE", help="Time every command's trip through the host, the link and the robot, and save it as a Chrome trace. See tracing.py.")
+    parser.add_argument("--echo", action="store_true", help="Print the lines the robot sends back to stderr")
+    args = parser.parse_args()
+    if args.window < 1:
+        parser.error("--window must be at least 1")
+
+    try:
+        ser = connect(args)
+    except serial.SerialException as e:
+        print("Couldn't open %s: %s" % (args.port or "the robot", e), file=sys.stderr)
+        return EXIT_NO_CONNECTION
+
+    if not args.scripts:
+        try:
+            interactive(ser)
+        except (EOFError, KeyboardInterrupt):
+            return EXIT_OK
 
-ser = serial.Serial("/dev/rfcomm0")
-while True:
-    ser.write(input().encode())
-    output = ser.read_until(b'\n')
-    if output != b'':
-        print(output)
+    stats = {"port": "simulator" if args.simulate else args.port}
+    try:
+        code = run_scripts(ser, args, stats)
+    except KeyboardInterrupt:
+        code = EXIT_INTERRUPTED
+    except serial.SerialException as e:
+        print("Lost the connection: %s" % e, file=sys.stderr)
+        code = EXIT_NO_CONNECTION
+    finally:
+        ser.close()
+    stats["exit_code"] = code
+    if args.stats:
+        write_stats(stats, args.stats)
+    return code
 
-#sock.close()
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
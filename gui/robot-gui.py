@@ -7,7 +7,20 @@
     s_90_1_n = Move shoulder forward 90 degrees
 """
 
-import gi, serial, time, threading, random, sys, inspect
+import time
+STARTED = time.monotonic()  # Before anything slow gets imported, so the startup times count it
+
+import gi, threading, sys, os
+
+# Only the light modules are imported up front. serial, the executor, the script loader and the simulator
+# are imported where they're first used, so the window can get on screen sooner.
+from protocol import (CAPABILITY_BATCH, CAPABILITY_BINARY, CAPABILITY_HOMING, CAPABILITY_PROFILE, CAPABILITY_TELEMETRY, END_MARKER, HOME_CANCEL,
+                      HOMING_CANCELLED, HOMING_GAVE_UP, HOMING_RUNNING, RESET, binary_encoder, encode_ascii, parse_homing_report, telemetry_mode)
+from uipump import UIPump
+from coalesce import LatestValueSender
+from startup import StartupTimer
+from history import DEFAULT_LIMIT, History, as_script
+from telemetry import DEFAULT_PERIOD, LATENCY_BINS, Monitor, bin_labels, parse_telemetry
 
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk, GLib, Gio, Gdk, GdkPixbuf
@@ -20,26 +33,22 @@ class ListBoxRowWithData(Gtk.ListBoxRow):
         self.data = data
         self.add(Gtk.Label(label=data))
 
-class DummySerial():
-    """ Fake serial for debugging purposes """
-    def __init__(self):
-        pass
-
-    def write(self, data):
-        print(data)
-
-    def read(self, length):
-        if random.randint(1, 100000) == 1:
-            return(b'0')
-        else:
-            return(b'1')
-
 class Window(Gtk.Window):
     def __init__(self):
         # Window initialisation
         super().__init__(title="S.A.M Interface")
         self.set_default_size(800, 600)
 
+        self.startup = StartupTimer(STARTED)
+        self.first_draw = self.connect("draw", self.first_frame)
+
+        # Everything that touches the UI from the script thread or in a hurry goes through here
+        self.pump = UIPump(GLib.timeout_add)
+
+        # Slider drags only ever send the newest angle for each servo, at a rate the link can keep up with
+        self.slider_sender = LatestValueSender(self.write, on_sent=self.update_history)
+        self.slider_sender.start()
+
         # Set icon
         pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale("./gui/icon.svg", -1, 128, True)
         self.set_icon(pixbuf)
@@ -70,6 +79,10 @@ class Window(Gtk.Window):
         self.display_warning(False)
         top_bar.pack_start(self.debug_warning)
 
+        self.position_label = Gtk.Label()
+        self.position_label.set_tooltip_text("Where the claw should be, worked out from the commands sent. Only means anything once the arm has been reset.")
+        top_bar.pack_start(self.position_label)
+
         bt_button.connect("clicked", self.get_bt_connection)
         usb_button.connect("button-release-event", self.get_usb_connection)
         usb_button.connect("key-release-event", self.get_usb_connection)
@@ -105,15 +118,43 @@ class Window(Gtk.Window):
         claw_button.connect("toggled", self.grab)
         rcol.pack_start(claw_button, False, False, 20)
 
-        self.ser = self.get_serial_connection()
+        xyz_box = self.create_control_block(rcol, "Cartesian Move")
+        self.cartesian_block(xyz_box)
+
+        telemetry_box = self.create_control_block(rcol, "Telemetry")
+        self.telemetry_block(telemetry_box)
+
+        self.reader = None
+        self.encode = encode_ascii     # Swapped for the binary encoder if the robot says it understands it
+        self.batch = False             # Likewise for batching moves in scripts
+        self.homing_reports = False    # Likewise for progress reports while it resets
+        self.homing_dialog = None      # (dialog, progress bar, passes expected) while a reset is going
+        self.telemetry_reports = False # Likewise for a telemetry stream
+        self.setup = []                # Commands that got the robot ready, for scripts to send again if it resets
+        self.monitor = None            # telemetry.Monitor for the current connection
+        self.trace_file = os.environ.get("SAM_TRACE")  # Where to save a trace of every command sent, see tracing.py
+        self.tracer = None
+        if self.trace_file:
+            from tracing import Tracer
+            self.tracer = Tracer()
+        self.negotiating = False
+        self.tracker = None            # Follows where the arm is, from the commands sent since connecting
+        self.ik_table = None           # Built or loaded from the cache the first time it's needed
+        self.ser = None                # Until probe_connection finds something
+        self.link_icon = None          # Whichever of bt_icon and usb_icon the connection is on
+        self.link_state = None         # Last state from Transport.health() we showed
+        self.identified = None         # Whether the robot answered the identify handshake, None until it's been asked
+        GLib.timeout_add(100, self.show_output)
         self.limits = {'s': False, 'e': False, 'b': False}
         #GLib.idle_add(self.read_limits)
 
         history_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=0)
 
-        self.history = Gtk.ListStore(str)
+        # Only the newest commands are in the list. The rest are on disk, in self.history.
+        self.history = History(int(os.environ.get("SAM_HISTORY_LIMIT", DEFAULT_LIMIT)))
+        self.history_store = Gtk.ListStore(str)
         self.scrollbox = Gtk.ScrolledWindow()
-        self.history_list = Gtk.TreeView(model=self.history)
+        self.history_list = Gtk.TreeView(model=self.history_store)
         self.history_list.set_headers_visible(False)
 
         # All of this is GTK treeview code, which is needlessly complicated but I have to use it because GTK3 is a buggy mess
@@ -140,6 +181,11 @@ class Window(Gtk.Window):
 
         self.execute_button.connect("clicked", self.execute_from_file)
 
+        # Off by default, a move that undoes another might be there on purpose, like a wiggle to seat a part
+        self.optimize_button = Gtk.CheckButton(label="Optimize")
+        self.optimize_button.set_tooltip_text("Squashes moves that cancel each other out before a script is run or saved. Off runs and saves exactly what's there.")
+        top_bar.pack_end(self.optimize_button, False, False, 5)
+
         self.reset_button = Gtk.Button(label="RESET")
         self.reset_button.set_tooltip_text("Resets the robot back to it's default position. Keycode: Z")
         main_box.pack_end(self.reset_button, False, False, 0)
@@ -151,20 +197,86 @@ class Window(Gtk.Window):
 
         sys.excepthook = self.error_handler
 
+        # Opening /dev/rfcomm0 can take seconds, so look for the robot once the window is up
+        self.probe_connection()
+
+    def first_frame(self, widget, cr):
+        self.startup.mark("first_frame")
+        self.disconnect(self.first_draw)
+        return False
+
     def grab(self, button):
         """ Sends a simple signal to toggle the claw """
-        self.ser.write(b'gn')
+        self.write('gn')
         self.update_history('gn')
 
     def reset(self, button):
         """ Sends a simple signal to trigger the reset callibration process """
-        self.ser.write(b'Zn')
-        self.update_history('Zn')
+
+        # How far the shoulder and elbow have to go, if we know where they are
+        expected = None
+        if self.tracker is not None and self.tracker.homed:
+            pulses = self.tracker.pulses()
+            expected = max(pulses['s'], pulses['e'], 0)
+        self.write(RESET)
+        self.update_history(RESET)
+        if self.homing_reports and self.homing_dialog is None:
+            self.homing_progress(expected)
+
+    def homing_progress(self, expected):
+        """ Shows how the reset is going, with a button to stop it. The robot reports back every so often while it homes. """
+
+        dialog = Gtk.Dialog(transient_for=self, flags=0, modal=True)
+        dialog.set_default_size(250, 50)
+        box = dialog.get_content_area()
+        box.pack_start(Gtk.Label(label="<big>Resetting...</big>", use_markup = True), False, True, 20)
+
+        progress = Gtk.ProgressBar(text="Homing", show_text=True)
+        box.pack_start(progress, True, True, 0)
+
+        def cancel(button):
+            # Sent as text whatever the encoder, homing only listens for a line starting with x.
+            # The link stays up, so the robot is still there to try again.
+            self.ser.write(encode_ascii(HOME_CANCEL))
+            button.set_sensitive(False)
+
+        cancel_button = Gtk.Button()
+        image = Gtk.Image.new_from_stock(Gtk.STOCK_CANCEL, Gtk.IconSize.BUTTON)
+        cancel_button.set_image(image)
+        cancel_button.connect("clicked", cancel)
+        box.pack_start(cancel_button, False, True, 5)
+
+        # Nothing else gets through while it homes, so keep the controls out of reach until it's done
+        dialog.connect("delete-event", lambda *args: True)
+        dialog.show_all()
+        self.homing_dialog = (dialog, progress, expected)
+
+    def homing_update(self, code, passes):
+        """ Moves the progress bar on, or closes it once the robot says homing is over """
+
+        if self.tracker is not None and code != HOMING_RUNNING:
+            self.tracker.homing_report(code, passes)
+        if code == HOMING_CANCELLED:
+            print("Reset cancelled after %s passes, run it again before trusting the position" % passes)
+        elif code == HOMING_GAVE_UP:
+            print("Reset gave up after %s passes without reaching the limit switches, check them" % passes)
+        if self.homing_dialog is None:
+            return
+        dialog, progress, expected = self.homing_dialog
+        if code != HOMING_RUNNING:
+            dialog.destroy()
+            self.homing_dialog = None
+        elif expected:
+            progress.set_fraction(min(1, passes / expected))
+            progress.set_text("%s of %s passes" % (passes, expected))
+        else:
+            progress.pulse()
+            progress.set_text("%s passes" % passes)
 
     def display_warning(self, state):
         self.debug_warning.set_opacity(int(state))
         if state:
-            self.debug_warning.set_tooltip_text("Currently using debug serial. This is a fake connection and does not indicate connectivity to the robot. No data will be sent.")
+            self.debug_warning.set_tooltip_text("Currently using the simulated robot. This is a fake connection and does not indicate connectivity to the robot. No data will be sent.")
         else:
             self.debug_warning.set_tooltip_text(None)
 
@@ -177,17 +289,36 @@ class Window(Gtk.Window):
     def execute_script(self, script, dialog, progress):
         """ Executes the script file in a seperate thread """
 
+        from executor import ScriptExecutor, DEFAULT_WINDOW
+        from sams import ScriptError
+
         global dialog_exists
-        length = len(script)
-        while script and dialog_exists:
-            print((length - len(script))/length)
-            GLib.idle_add(progress.set_fraction, (length - len(script))/length)
-            if self.ser.read(1) == b'0':
-                self.ser.write(script[0].encode())
-                script.pop(0)
+        executor = ScriptExecutor(self.ser, self.reader, window=DEFAULT_WINDOW, encode=self.encode, batch=self.batch, tracker=self.tracker, monitor=self.monitor, tracer=self.tracer, setup=self.setup)
+        started = time.monotonic()
+        try:
+            executor.run(
+                script,
+                on_progress=lambda fraction: self.pump.set("progress", self.show_progress, progress, fraction),
+                running=lambda: dialog_exists,
+            )
+        except ScriptError as e:
+            # The script is only checked as it's read, so this can turn up part way through
+            print("Stopped script: %s" % e)
+        if hasattr(script, "report"):
+            print(script.report())
+        if self.tracer is not None:
+            # Everything traced so far, so the file always has the whole session
+            self.tracer.span("script", started)
+            self.save_trace()
+        print("UI updates: %(submitted)s submitted, %(dropped)s dropped, %(merged)s merged into %(flushes)s redraws" % self.pump.stats())
         if dialog_exists:
-            GLib.idle_add(dialog.destroy)
             dialog_exists = False
+            GLib.idle_add(dialog.destroy)
+
+    def show_progress(self, progress, fraction):
+        """ The pump can get to this after the dialog has gone, but it runs on the main loop like the destroy, so checking is enough """
+        if dialog_exists:
+            progress.set_fraction(fraction)
     
     def execute_from_file(self, button, *data):
         """ Selects a file and starts the execution thread with a popup """
@@ -196,9 +327,13 @@ class Window(Gtk.Window):
         response, filename = self.filechooser_dialog(Gtk.FileChooserAction.OPEN)
 
         if filename != None:
-            # Load file, split into seperate commands
-            script = open(filename, "r").read().split("N")
-            script = [x + 'N' for x in script[:-1]] + ['n']
+            from sams import Script
+
+            # Commands are read off the disk as the executor gets to them
+            script = Script(filename)
+            if self.optimize_button.get_active():
+                from optimizer import Optimizer
+                script = Optimizer(script)
             
             dialog = Gtk.Dialog(
                 transient_for=self,
@@ -243,14 +378,22 @@ class Window(Gtk.Window):
             #    dialog.destroy()
 
     def update_history(self, command):
-        self.history.append([command])
-
-        self.history_list.show_all()
-
-        # Supposed to scroll to bottom. Doesn't work. I want to die.
-        adj = self.scrollbox.get_vadjustment()
-        adj.set_value(adj.get_property('upper'))
-        self.scrollbox.set_vadjustment(adj)
+        """ Queues a command for the history list. The pump adds them in batches so dragging a slider doesn't redraw every time. """
+        self.pump.append("history", self.append_history, command)
+
+    def append_history(self, commands):
+        self.history.extend(commands)
+        commands = commands[-self.history.limit:]
+        # Keep the list to what History has in memory, so it never gets slow to draw
+        for i in range(len(self.history_store) + len(commands) - self.history.limit):
+            self.history_store.remove(self.history_store.get_iter_first())
+        for command in commands:
+            last = self.history_store.append([command])
+        if self.history.spilled:
+            self.scrollbox.set_tooltip_text("Showing the last %s of %s commands. Saving with nothing selected saves all of them." % (len(self.history_store), len(self.history)))
+
+        # Scrolling the adjustment never worked, but scrolling the treeview to the new row does
+        self.history_list.scroll_to_cell(self.history_store.get_path(last), None, False, 0, 0)
 
     def filechooser_dialog(self, action):
         """ Stock function that throws up a dialog to choose a file """
@@ -291,28 +434,35 @@ class Window(Gtk.Window):
         return response, filename
 
     def save_script(self, button, *data):
-        """ Converts selected history to text and saves it to a .sams file. """
+        """ Saves the selected history to a .sams file. The commands are read back from the session log a slice at a time. """
 
-        history = []
+        from sessionlog import ranges
 
-        # Adapted from StackOverflow. Gets the current selection. No idea why it has to be this complicated
-        tree_selection = self.history_list.get_selection()
-        model, pathlist = tree_selection.get_selected_rows()
-        for path in pathlist :
-            tree_iter = model.get_iter(path)
-            value = model.get_value(tree_iter,0)
-            history.append(value)
-
-        if len(history) <= 1:
+        # The list shows the newest commands in the history, so row i is this far in
+        model, pathlist = self.history_list.get_selection().get_selected_rows()
+        shown_from = len(self.history) - len(self.history_store)
+        runs = ranges(shown_from + path.get_indices()[0] for path in pathlist)
+        if len(pathlist) <= 1:
             # Haven't selected anything, or only selected a single action, so we save the whole history
-            history = [x[0] for x in list(self.history)]
+            runs = [(0, len(self.history))]
 
         response, filename = self.filechooser_dialog(Gtk.FileChooserAction.SAVE)    # Throw up the file chooser dialog
-        if response == Gtk.ResponseType.OK:
-            file = open(filename, "w")
-            for command in history[:-1]:
-                file.write(command.replace("n", "N"))
-            file.write(history[-1])
+        if response == Gtk.ResponseType.OK and not self.optimize_button.get_active():
+            with open(filename, "w") as file:
+                file.writelines(as_script(self.history.commands(runs)))
+        elif response == Gtk.ResponseType.OK:
+            from optimizer import Optimizer
+
+            # Squash the button mashing down before it's saved, unless that would somehow leave the arm somewhere else
+            optimizer = Optimizer(as_script(self.history.commands(runs)))
+            with open(filename, "w") as file:
+                file.writelines(optimizer)
+            print(optimizer.report())
+            problems = optimizer.differences()
+            if problems:
+                print("Saving the script as it was recorded, the optimized one ends up somewhere else: %s" % ", ".join(problems))
+                with open(filename, "w") as file:
+                    file.writelines(as_script(self.history.commands(runs)))
         elif response == Gtk.ResponseType.CANCEL:
             print("Cancel clicked")
 
@@ -326,46 +476,213 @@ class Window(Gtk.Window):
             else:
                 processed_data = data
             command = "%s_%s_%s_n" % processed_data
+            queued = time.monotonic() if self.tracer is not None else None
             self.update_history(command)
-            self.ser.write(command.encode())
+            self.write(command, queued)
         else:
             print("Failed to send command, please check usb/bluetooth connection and try again")
 
-    def get_serial_connection(self):
-        """ Fetches the serial connection through bluetooth or USB """
+    def write(self, command, queued=None):
+        """ Sends a command from the controls. While the link is reconnecting it's dropped, rather than the window freezing until it's back.
+            queued is when the button was pressed, for the trace.
+        """
 
-        ser = None
+        if hasattr(self.ser, "connected") and not self.ser.connected():
+            print("Not connected to S.A.M right now, dropped %s" % command)
+            return
+        if self.tracer is None:
+            self.ser.write(self.encode(command))
+        else:
+            encoding = time.monotonic()
+            frame = self.encode(command)
+            writing = time.monotonic()
+            self.ser.write(frame)
+            # The executor handles acks, so commands from the controls are only followed onto the wire
+            self.tracer.sent(command, len(frame), queued, encoding, writing, time.monotonic(), False)
+        if self.tracker is not None:
+            self.tracker.sent(command)
+        if self.monitor is not None:
+            self.monitor.sent()
+
+    def save_trace(self):
         try:
-            ser = serial.Serial("/dev/rfcomm0")
-            self.bt_icon.set_opacity(1)
-        except serial.serialutil.SerialException:
-            print("Bluetooth connection failed, falling back to USB")
-            self.bt_icon.set_opacity(0.5)
-            try:
-                ser = serial.Serial('/dev/ttyACM1')
-                self.usb_icon.set_opacity(1)
-            except serial.serialutil.SerialException as e:
-                print("USB connection failed.")
-                self.usb_icon.set_opacity(0.5)
-        
-        if ser != None:
-            self.sensitivity(True)
+            self.tracer.save(self.trace_file)
+        except OSError as e:
+            print("Couldn't save the trace: %s" % e)
+            return
+        print("Trace saved to %s\n%s" % (self.trace_file, self.tracer.table()))
 
-        return ser
+    def slider_changed(self, slider, id):
+        """ Hands servo angles to the slider sender, which drops any that go stale before the link is free """
 
-    def get_bt_connection(self, button):
-        """ BT Button function, attempts to create bluetooth connection """
+        if self.ser is not None:
+            self.slider_sender.submit(id, "%s_%s_%s_n" % (id, int(slider.get_value()), 0))
+        else:
+            print("Failed to send command, please check usb/bluetooth connection and try again")
+
+    def start_reader(self, identity=None):
+        """ (Re)starts the background reader thread on the current connection. identity skips asking the robot again. """
+
+        from link import SerialReader
+        from kinematics import JointTracker
+
+        if self.reader is not None:
+            self.reader.stop()
+            self.reader = None
+        self.encode = encode_ascii
+        self.batch = False
+        self.homing_reports = False
+        self.telemetry_reports = False
+        self.setup = []
+        self.identified = None
+        # No telling where the arm is on a new connection until it's reset
+        self.tracker = JointTracker() if self.ser is not None else None
+        self.monitor = Monitor() if self.ser is not None else None
+        if self.ser is not None:
+            self.reader = SerialReader(self.ser)
+            self.reader.start()
+            self.negotiating = True
+            threading.Thread(target=self.negotiate, args=[self.ser, self.reader, identity], daemon=True).start()
+
+    def negotiate(self, ser, reader, identity=None):
+        """ Asks the robot whether it takes binary commands and batches. Older firmware doesn't answer, so we stay on plain ASCII. """
+
+        from link import identify
 
         try:
-            self.ser = serial.Serial("/dev/rfcomm0")
-            self.bt_icon.set_opacity(1)
-            self.usb_icon.set_opacity(0.5)
+            if identity is None:
+                identity = identify(ser, reader)
+        finally:
+            self.negotiating = False
+            self.startup.mark("identified")
+            self.startup.save(identified=identity is not None)
+        if ser is not self.ser:
+            return
+        self.identified = identity is not None
+        self.link_state = None      # So show_link puts it in the tooltip
+        if identity is None:
+            print("Robot didn't identify itself, using ASCII commands")
+            return
+        if CAPABILITY_BINARY in identity.capabilities:
+            self.encode = binary_encoder
+        self.batch = CAPABILITY_BATCH in identity.capabilities
+        self.homing_reports = CAPABILITY_HOMING in identity.capabilities
+        self.telemetry_reports = CAPABILITY_TELEMETRY in identity.capabilities
+        # Acceleration profiles are opt in until someone has tuned them on the real arm, see motion.py
+        accelerating = CAPABILITY_PROFILE in identity.capabilities and bool(os.environ.get("SAM_ACCEL"))
+        if accelerating:
+            from motion import profile_commands
+            self.setup = profile_commands(terminator=END_MARKER)
+            for command in self.setup:
+                self.write(command)
+        print("Connected to S.A.M firmware v%s, using %s commands%s%s" % (
+            identity.version, "binary" if self.encode is binary_encoder else "ASCII", ", batching moves" if self.batch else "",
+            ", accelerating" if accelerating else ""))
+
+    def show_output(self):
+        """ Prints whatever the robot has sent back since we last checked. Runs on a GLib timer. """
+
+        if self.reader is not None and not self.negotiating:
+            for line in self.reader.drain_lines():
+                report = parse_homing_report(line)
+                if report is not None:
+                    self.homing_update(*report)
+                    if report[0] == HOMING_RUNNING:
+                        continue    # Too many to print
+                telemetry = parse_telemetry(line) if self.monitor is not None else None
+                if telemetry is not None:
+                    self.monitor.report(telemetry)
+                    continue        # It's in the panel
+                print(line)
+        self.show_telemetry()
+        if self.tracker is not None:
+            x, y, z = self.tracker.effector()
+            self.position_label.set_text("x %.0f  y %.0f  z %.0f mm%s" % (x, y, z, "" if self.tracker.homed else " (not reset yet)"))
+        if hasattr(self.ser, "health"):
+            health = self.ser.health()
+            if health["state"] != self.link_state:
+                self.link_state = health["state"]
+                self.show_link(health)
+        return True
+
+    def show_link(self, health):
+        """ Dims the connection's icon while the transport is reconnecting, and gives up on it if the transport does """
+
+        if self.link_icon is None:
+            return
+        state = health["state"]
+        if state == "up":
+            self.link_icon.set_opacity(1)
+            self.link_icon.set_tooltip_text("Connected to %s, reconnected %s times%s" % (self.ser.name, health["reconnects"],
+                "" if self.identified is not False else ". It didn't say it's S.A.M, so it's taken to be older firmware and sent plain ASCII"))
             self.sensitivity(True)
-            self.display_warning(False)
-        except serial.serialutil.SerialException:
-            print("Bluetooth connection failed. Please check connection and try again. ")
+        elif state == "reconnecting":
+            self.link_icon.set_opacity(0.75)
+            self.link_icon.set_tooltip_text("Lost %s, reconnecting: %s" % (self.ser.name, health["last_error"]))
+        else:
+            self.link_icon.set_opacity(0.5)
+            self.link_icon.set_tooltip_text("Lost %s: %s" % (self.ser.name, health["last_error"]))
             self.sensitivity(False)
 
+    def probe_connection(self, ports=None):
+        """ Looks for the robot on a background thread. The icons and controls get updated once it's done. """
+        threading.Thread(target=lambda: GLib.idle_add(self.use_connection, self.get_serial_connection(ports)), daemon=True).start()
+
+    def use_connection(self, found):
+        """ Takes over a connection found by get_serial_connection. Runs on the main loop. """
+
+        from transport import Transport, opener
+
+        if found is None:
+            self.startup.save(connected=False)
+            if self.ser is None:
+                self.sensitivity(False)
+            return False
+        self.startup.mark("connected")
+        if self.reader is not None:
+            self.reader.stop()
+            self.reader = None
+        if self.ser is not None:
+            self.ser.close()
+        # A dropped bluetooth link or bumped cable gets reopened underneath rather than ending the session
+        self.ser = Transport(opener(found.port), connection=found.ser, name=found.port)
+        self.start_reader(found.identity)
+        self.bt_icon.set_opacity(1 if found.kind == "bt" else 0.5)
+        self.usb_icon.set_opacity(1 if found.kind == "usb" else 0.5)
+        self.link_icon = self.bt_icon if found.kind == "bt" else self.usb_icon
+        self.link_state = None
+        self.sensitivity(True)
+        self.display_warning(False)
+        return False
+
+    def get_serial_connection(self, ports=None):
+        """ Finds the robot on one of ports, or anywhere it might be. Returns a discovery.Found, or None.
+
+            Ports are probed all at once, and one that answers the identify handshake wins. If none do, the first that opened
+            is used as older firmware, see discovery.py.
+            Doesn't touch the UI, so it's safe to call off the main thread.
+        """
+
+        from discovery import discover
+
+        port = os.environ.get("SAM_PORT")   # Lets you point the GUI at something else, like the pty from simulator.py
+        if port and ports is None:
+            found = discover([port], cache=None)
+            if found is not None:
+                return found
+            print("Couldn't open SAM_PORT %s, trying the usual ports" % port)
+
+        found = discover(ports)
+        if found is None:
+            print("Couldn't find S.A.M on %s" % (", ".join(ports) if ports else "any port"))
+        return found
+
+    def get_bt_connection(self, button):
+        """ BT Button function, attempts to create bluetooth connection """
+
+        from discovery import RFCOMM
+        self.probe_connection([RFCOMM])
+
     def get_usb_connection(self, button, event):
         """ USB button function. Attempts to create a USB connection, or if button is shift clicked, create a fake debug connection"""
 
@@ -374,27 +691,20 @@ class Window(Gtk.Window):
                 return 1
 
         if event.get_state() & Gdk.ModifierType.SHIFT_MASK:
-            self.ser = DummySerial()
+            from simulator import SimulatedSerial
+            if self.ser is not None:
+                self.ser.close()
+            self.ser = SimulatedSerial()
+            self.link_icon = None
+            self.start_reader()
             self.usb_icon.set_opacity(1)
             self.bt_icon.set_opacity(0.5)
             self.sensitivity(True)
             self.display_warning(True)
-            print("Using debug serial. THIS WILL NOT SEND DATA TO THE ROBOT! ")
+            print("Using the simulated robot. THIS WILL NOT SEND DATA TO THE ROBOT! ")
         else:
-            for n in range(0, 5):
-                try: 
-                    self.ser = serial.Serial("/dev/ttyACM%s" % n)
-                    self.usb_icon.set_opacity(1)
-                    self.bt_icon.set_opacity(0.5)
-                    self.sensitivity(True)
-                    self.display_warning(False)
-                    return 1
-                except serial.serialutil.SerialException:
-                    pass
-            print("USB connection failed.")
-            self.usb_icon.set_opacity(0.5)
-            self.sensitivity(False)
-            self.display_warning(False)
+            from discovery import usb_ports
+            self.probe_connection(usb_ports())
 
     def create_control_block(self, col, label_text):
         col.pack_start(Gtk.Label(label="<big>%s</big>" % label_text, use_markup=True), False, True, 10)
@@ -441,7 +751,7 @@ class Window(Gtk.Window):
         slider = Gtk.Scale(orientation=Gtk.Orientation.HORIZONTAL, adjustment=adj)
         slider.set_digits(0)
         slider.set_hexpand(True)
-        slider.connect("value_changed", self.send_command, id, slider)
+        slider.connect("value_changed", self.slider_changed, id)
 
         grid.attach_next_to(slider, label, Gtk.PositionType.RIGHT, 6, 2)
 
@@ -474,13 +784,115 @@ class Window(Gtk.Window):
 
         self.send_command(button, id, abs(int(val)), dir)
 
+    def cartesian_block(self, box):
+        """ Spin buttons for an x, y, z target in mm and a button to send the claw there """
+
+        grid = Gtk.Grid(column_spacing=10)
+        box.pack_start(grid, True, True, 0)
+
+        spins = []
+        for n, (axis, value) in enumerate((("X", 200), ("Y", 0), ("Z", 200))):
+            grid.attach(Gtk.Label(label=axis), n * 2, 0, 1, 1)
+            adj = Gtk.Adjustment(value=value, lower=-500, upper=500, step_increment=5, page_increment=50)
+            spin = Gtk.SpinButton(adjustment=adj, digits=0)
+            grid.attach(spin, n * 2 + 1, 0, 1, 1)
+            spins.append(spin)
+
+        button = Gtk.Button(label="Go", tooltip_text="Move the claw tip to this point, with the hand level. ")
+        grid.attach(button, 6, 0, 1, 1)
+        button.connect("clicked", self.cartesian_move, spins)
+
+    def cartesian_move(self, button, spins):
+        """ Works out the joint moves for the target from the IK table and sends only the ones that change anything """
+
+        from ik import Table, moves, solve
+
+        if self.ser is None or self.tracker is None:
+            print("Failed to send command, please check usb/bluetooth connection and try again")
+            return
+        if not self.tracker.homed:
+            print("The arm hasn't been reset, so this is relative to wherever it was when we connected")
+        if self.ik_table is None:
+            self.ik_table = Table()
+
+        target = [spin.get_value() for spin in spins]
+        current = self.tracker.pulses()
+        solution = solve(*target, self.ik_table, current)
+        if solution is None:
+            print("Can't reach x %.0f y %.0f z %.0f with the hand level" % tuple(target))
+            return
+        pulses, wrist = solution
+        for command in moves(current, pulses, wrist, self.tracker.servos['w'], batch=self.batch):
+            self.update_history(command)
+            self.write(command)
+
+    def telemetry_block(self, box):
+        """ Live numbers for the link and, once it's streaming, the robot: commands/s, ack round trips and loop() timings """
+
+        self.telemetry_button = Gtk.ToggleButton(label="Stream from the robot", tooltip_text="Have the robot report how it's doing a few times a second. ")
+        self.telemetry_button.set_sensitive(False)
+        self.telemetry_button.connect("toggled", self.toggle_telemetry)
+        box.pack_start(self.telemetry_button, False, False, 0)
+
+        self.telemetry_label = Gtk.Label(label="Not connected", xalign=0)
+        box.pack_start(self.telemetry_label, False, True, 0)
+
+        # Ack round trips, a bar for each bin in telemetry.LATENCY_BINS
+        self.latency_area = Gtk.DrawingArea()
+        self.latency_area.set_size_request(-1, 60)
+        self.latency_area.connect("draw", self.draw_latencies)
+        box.pack_start(self.latency_area, False, True, 0)
+
+    def toggle_telemetry(self, button):
+        if self.ser is not None:
+            self.write(telemetry_mode(DEFAULT_PERIOD if button.get_active() else 0))
+
+    def show_telemetry(self):
+        """ Updates the telemetry panel. Runs from show_output. """
+
+        self.telemetry_button.set_sensitive(self.telemetry_reports)
+        if self.monitor is None:
+            return
+        stats = self.monitor.snapshot()
+        ms = lambda seconds: "-" if seconds is None else "%.0fms" % (seconds * 1000)
+        lines = ["Commands/s  sent %.1f  run %s" % (stats["host_rate"], "-" if stats["robot_rate"] is None else "%.1f" % stats["robot_rate"]),
+                 "Ack round trip  p50 %s  p90 %s  (%s acks)" % (ms(stats["latency_p50"]), ms(stats["latency_p90"]), stats["acks"])]
+        if stats["reports"]:
+            lines.append("loop()  mean %sus  jitter %sus  worst %sus" % (stats["loop_mean"], stats["loop_jitter"], stats["loop_worst"]))
+            lines.append("Queued  %s   Switches closed  %s" % (
+                " ".join("%s %s" % item for item in stats["queued"].items()), stats["switches"] or "none"))
+        self.telemetry_label.set_text("\n".join(lines))
+        self.latency_area.queue_draw()
+
+    def draw_latencies(self, widget, cr):
+        counts = self.monitor.snapshot()["histogram"] if self.monitor is not None else [0] * (len(LATENCY_BINS) + 1)
+        width, height = widget.get_allocated_width(), widget.get_allocated_height()
+        label_height = 12
+        bar_width = width / len(counts)
+        tallest = max(counts) or 1
+        cr.set_font_size(9)
+        for n, (count, label) in enumerate(zip(counts, bin_labels())):
+            bar = (height - label_height) * count / tallest
+            cr.set_source_rgb(0.3, 0.5, 0.8)
+            cr.rectangle(n * bar_width + 1, height - label_height - bar, bar_width - 2, bar)
+            cr.fill()
+            cr.set_source_rgb(0.4, 0.4, 0.4)
+            cr.move_to(n * bar_width + 2, height - 2)
+            cr.show_text(label)
+        return False
+
     def error_handler(self, exception_type, value, traceback):
-        if exception_type == serial.SerialException:
-            self.get_serial_connection()
+        serial = sys.modules.get("serial")  # If it's not imported yet, this can't be a serial error
+        if serial is not None and issubclass(exception_type, serial.SerialException):
+            # A Transport that's still reconnecting will sort itself out. Once it gives up, go looking again.
+            if not getattr(self.ser, "reconnecting", False):
+                self.probe_connection()
         else:
             print(value)
 
 win = Window()
 win.connect("destroy", Gtk.main_quit)
 win.show_all()
-Gtk.main()
\ No newline at end of file
+Gtk.main()
+if win.tracer is not None:
+    win.save_trace()   # Commands from the controls since the last script
\ No newline at end of file
@@ -0,0 +1,159 @@
+"""
+    Loading .sams script files
+
+    A script is just commands run together, each ending in n or N, e.g. s_54_1_Nb_10_0_NgNZn
+    Scripts are read in chunks and parsed as the executor asks for commands, so a huge one starts straight away
+    and never sits in memory all at once. The first full read also writes a compiled copy (one checked command per line)
+    to the cache, keyed by path, modification time and size, so running the same script again skips the parsing.
+    Only the CACHE_LIMIT most recently used copies are kept.
+"""
+
+import hashlib, os, re, tempfile
+
+from protocol import MAX_COMMAND_LENGTH, parse
+
+CHUNK_SIZE = 64 * 1024
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "sam", "scripts")
+CACHE_VERSION = 1
+CACHE_LIMIT = 100   # Compiled scripts kept in CACHE_DIR
+
+COMMAND = re.compile(r"[^nN]*[nN]")
+WHITESPACE = re.compile(r"\s+")
+
+class ScriptError(ValueError):
+    pass
+
+def check(command, index):
+    """ Raises ScriptError if the robot wouldn't make sense of command """
+    if len(command) > MAX_COMMAND_LENGTH:
+        raise ScriptError("Command %s (%r) is longer than the robot's buffer" % (index + 1, command))
+    try:
+        parse(command)
+    except ValueError:
+        raise ScriptError("Command %s (%r) is malformed" % (index + 1, command))
+
+def parse_stream(file, chunk_size=CHUNK_SIZE):
+    """ Yields (command, characters read so far) from an open script file, checking each command as it goes.
+
+        chunk_size=None reads a line at a time instead, for pipes where read(chunk_size) would sit waiting for a full chunk.
+    """
+
+    leftover = ""
+    read = 0
+    index = 0
+    while True:
+        chunk = file.readline() if chunk_size is None else file.read(chunk_size)
+        if not chunk:
+            break
+        read += len(chunk)
+        text = leftover + chunk
+        end = 0
+        for match in COMMAND.finditer(text):
+            end = match.end()
+            command = WHITESPACE.sub("", match.group())
+            if len(command) == 1:
+                continue    # A lone terminator, which older GUIs tacked on to the end of scripts
+            check(command, index)
+            index += 1
+            yield command, read - len(text) + end
+        leftover = text[end:]
+        if len(leftover) > MAX_COMMAND_LENGTH:
+            # Nothing that long can be a command, so don't read the rest of what's probably not a script looking for the end of it
+            leftover = WHITESPACE.sub("", leftover)
+            if len(leftover) > MAX_COMMAND_LENGTH:
+                raise ScriptError("Command %s (%r...) is longer than the robot's buffer" % (index + 1, leftover[:MAX_COMMAND_LENGTH]))
+
+    if leftover.strip():
+        raise ScriptError("Script ends with an unterminated command %r" % leftover.strip())
+
+def prune(directory, limit=CACHE_LIMIT):
+    """ Deletes all but the limit most recently used compiled scripts in directory """
+
+    try:
+        copies = [entry for entry in os.scandir(directory) if entry.name.endswith(".samc")]
+        copies.sort(key=lambda entry: entry.stat().st_mtime)
+    except OSError:
+        return
+    for entry in copies[:max(0, len(copies) - limit)]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass    # Someone else pruned it first
+
+class Script():
+    """ A .sams file. Iterating over it yields commands, and progress() says how far through the file the last one was. """
+
+    def __init__(self, path, cache_dir=CACHE_DIR):
+        self.path = os.path.abspath(path)
+        stat = os.stat(self.path)
+        self.key = "%s %s %s %s" % (CACHE_VERSION, self.path, stat.st_mtime_ns, stat.st_size)
+        self.cache_dir = cache_dir
+        self.cache_path = os.path.join(cache_dir, hashlib.sha1(self.path.encode()).hexdigest() + ".samc") if cache_dir else None
+        self.size = 0
+        self.position = 0
+
+    def progress(self):
+        return self.position / self.size if self.size else 1
+
+    def cached(self):
+        """ True if there's an up to date compiled copy of this script """
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return False
+        with open(self.cache_path, "r") as file:
+            return file.readline().rstrip("\n") == self.key
+
+    def __iter__(self):
+        if self.cached():
+            return self.iter_cache()
+        return self.iter_source()
+
+    def iter_cache(self):
+        self.size = os.path.getsize(self.cache_path)
+        try:
+            os.utime(self.cache_path)  # Used, so it's the last to be pruned
+        except OSError:
+            pass
+        with open(self.cache_path, "r") as file:
+            self.position = len(file.readline())
+            for line in file:
+                self.position += len(line)
+                yield line.rstrip("\n")
+
+    def iter_source(self):
+        self.size = os.path.getsize(self.path)
+        cache = None
+        if self.cache_path is not None:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                # A file of its own, so two runs of the same script don't write over each other's copy
+                fd, name = tempfile.mkstemp(suffix=".samc.tmp", dir=self.cache_dir)
+                cache = os.fdopen(fd, "w")
+                cache.write(self.key + "\n")
+            except OSError:
+                cache = None    # No cache then, we can still run the script
+
+        finished = False
+        try:
+            with open(self.path, "r") as file:
+                for command, self.position in parse_stream(file):
+                    if cache is not None:
+                        cache.write(command + "\n")
+                    yield command
+            finished = True
+        finally:
+            # Only keep the compiled copy if we got all the way through, otherwise the next run would be missing the end
+            if cache is not None:
+                cache.close()
+                try:
+                    if finished:
+                        os.replace(name, self.cache_path)
+                    else:
+                        os.remove(name)
+                except OSError:
+                    pass    # Someone else's copy got there first, or the cache went away. Either way the script ran.
+                if finished:
+                    prune(self.cache_dir)
+
+def load(path):
+    """ Reads a whole script into a list, for when it's small enough not to matter """
+    return list(Script(path))
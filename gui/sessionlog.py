@@ -0,0 +1,198 @@
+"""
+    Append-only log of every command sent in a session
+
+    Each session gets its own pair of files in ~/.cache/sam/sessions, named after when it started and the process:
+        20261017-142501-4242.sams   the commands, one per line, so the log is itself a script
+        20261017-142501-4242.idx    where each command starts in the .sams, as 8 byte little endian offsets
+    Finding command i is one 8 byte read from the index, so exporting a range is working out where it starts and ends
+    and copying the bytes in between, however long the session has gone on. Nothing is ever held in memory.
+Only the newest KEEP_SESSIONS sessions are kept, older ones are deleted when a new one starts.
+
+        python gui/sessionlog.py ~/.cache/sam/sessions/20261017-142501-4242.sams --range 1000:2000 --output part.sams
+"""
+
+import argparse, os, struct, sys, threading, time
+
+SESSION_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "sam", "sessions")
+OFFSET = struct.Struct("<Q")
+COPY_CHUNK = 1024 * 1024
+KEEP_SESSIONS = 50      # Sessions left in SESSION_DIR, counting the new one
+
+def ranges(indices):
+    """ Turns indices into a sorted list of (start, stop) runs of consecutive ones """
+
+    runs = []
+    for index in sorted(set(indices)):
+        if runs and runs[-1][1] == index:
+            runs[-1][1] += 1
+        else:
+            runs.append([index, index + 1])
+    return [tuple(run) for run in runs]
+
+def create(directory):
+    """ Makes a new, empty .sams in directory and returns its path. Two sessions starting in the same second still get a file each. """
+
+    stem = time.strftime("%Y%m%d-%H%M%S") + "-%s" % os.getpid()
+    for attempt in range(100):
+        path = os.path.join(directory, stem + ("_%s" % attempt if attempt else "") + ".sams")
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return path
+        except FileExistsError:
+            pass
+    raise FileExistsError("No free session log name in %s" % directory)
+
+def prune(directory, keep=KEEP_SESSIONS, current=None):
+    """ Deletes all but the newest keep sessions in directory, never current, the path of the one just started """
+
+    try:
+        logs = [entry for entry in os.scandir(directory) if entry.name.endswith(".sams") and entry.path != current]
+        logs.sort(key=lambda entry: (entry.stat().st_mtime, entry.name))
+    except OSError:
+        return
+    keep -= current is not None
+    for name in [entry.name for entry in logs[:max(0, len(logs) - keep)]]:
+        for path in (name, os.path.splitext(name)[0] + ".idx"):
+            try:
+                os.remove(os.path.join(directory, path))
+            except OSError:
+                pass    # Already gone, or still open on Windows in another GUI
+
+class SessionLog():
+    """ path is the .sams half. By default it's a new file in directory named after the time, and all but the newest keep
+        sessions there are deleted. An existing log is added to.
+    """
+
+    def __init__(self, path=None, directory=SESSION_DIR, keep=KEEP_SESSIONS):
+        if path is None:
+            os.makedirs(directory, exist_ok=True)
+            path = create(directory)
+            prune(directory, keep, path)
+        self.path = path
+        self.index_path = os.path.splitext(path)[0] + ".idx"
+        self.lock = threading.Lock()
+        # Appends always go to the end in "a" mode, whatever we've seeked to for reading
+        self.file = open(self.path, "a+b")
+        self.index = open(self.index_path, "a+b")
+        self.size = os.path.getsize(self.path)
+        self.count = os.path.getsize(self.index_path) // OFFSET.size
+
+    def __len__(self):
+        return self.count
+
+    def extend(self, commands):
+        """ Appends commands to the log, with one write to each file """
+
+        data = []
+        offsets = []
+        with self.lock:
+            position = self.size
+            for command in commands:
+                line = command.encode() + b"\n"
+                offsets.append(OFFSET.pack(position))
+                data.append(line)
+                position += len(line)
+            if not data:
+                return
+            self.file.write(b"".join(data))
+            self.index.write(b"".join(offsets))
+            # Flushed every time, so a crash loses nothing the robot was sent
+            self.file.flush()
+            self.index.flush()
+            self.size = position
+            self.count += len(offsets)
+
+    def append(self, command):
+        self.extend([command])
+
+    def offset(self, index):
+        """ Where command index starts in the .sams file. len(self) gives the end of the file. Call with the lock held. """
+
+        if index >= self.count:
+            return self.size
+        self.index.seek(index * OFFSET.size)
+        return OFFSET.unpack(self.index.read(OFFSET.size))[0]
+
+    def span(self, start, stop):
+        """ Byte offsets of the slice start:stop, clamped to the log like a list slice would be """
+        start, stop, step = slice(start, stop).indices(self.count)
+        with self.lock:
+            return self.offset(start), self.offset(max(start, stop))
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("session log index out of range")
+        return self.read(index, index + 1).decode().strip()
+
+    def read(self, start, stop):
+        """ The raw bytes of commands start:stop, newlines and all """
+
+        begin, end = self.span(start, stop)
+        with self.lock:
+            self.file.seek(begin)
+            return self.file.read(end - begin)
+
+    def commands(self, runs=None):
+        """ Yields the commands in each (start, stop) of runs, by default the whole log, reading a chunk at a time """
+
+        for start, stop in runs if runs is not None else [(0, self.count)]:
+            begin, end = self.span(start, stop)
+            leftover = b""
+            while begin < end:
+                with self.lock:
+                    self.file.seek(begin)
+                    data = self.file.read(min(COPY_CHUNK, end - begin))
+                begin += len(data)
+                lines = (leftover + data).split(b"\n")
+                leftover = lines.pop()
+                for line in lines:
+                    yield line.decode()
+
+    def export(self, runs, destination):
+        """ Copies the commands in each (start, stop) of runs to destination, a path or a binary file. Returns how many. """
+
+        if isinstance(destination, str):
+            with open(destination, "wb") as file:
+                return self.export(runs, file)
+        copied = 0
+        for start, stop in runs:
+            start, stop, step = slice(start, stop).indices(self.count)
+            begin, end = self.span(start, stop)
+            with self.lock:
+                self.file.seek(begin)
+                remaining = end - begin
+                while remaining:
+                    data = self.file.read(min(COPY_CHUNK, remaining))
+                    destination.write(data)
+                    remaining -= len(data)
+            copied += max(0, stop - start)
+        return copied
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+def parse_range(text):
+    start, sep, stop = text.partition(":")
+    return int(start or 0), int(stop) if stop else None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("log", help="Session log, the .sams next to its .idx")
+    parser.add_argument("--range", action="append", type=parse_range, metavar="START:STOP", help="Commands to export, like a Python slice. Repeat for more than one.")
+    parser.add_argument("--output", help="Write them here rather than to stdout")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.log):
+        parser.error("%s doesn't exist" % args.log)
+    log = SessionLog(args.log)
+    runs = [(start, len(log) if stop is None else stop) for start, stop in args.range or [(0, None)]]
+    copied = log.export(runs, args.output or sys.stdout.buffer)
+    print("Exported %s of %s commands" % (copied, len(log)), file=sys.stderr)
+    log.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,723 @@
+"""
+    Simulator for interpreter.ino, so the host side can be tested and benchmarked without the robot plugged in.
+
+    Firmware models the sketch in simulated time: the 64 byte serial receive buffer, the 32 character line reader,
+    parse_command() from command.c and what interpret() does with it, homing a pass at a time with its reports, telemetry, the per StepperMotor ms_del/multiplier timing with every motor moving at once,
+    the hold on scripted instructions and the ack once everything is idle, and the motor queues and credits in queue mode. Both directions of the link are throttled to the baudrate.
+
+    SimulatedSerial wraps it in something that looks enough like serial.Serial for the executor and reader,
+    and serve_pty puts it on a pseudo terminal so the GUI and CLI can open it like /dev/ttyACM*:
+
+        python gui/simulator.py --link /tmp/ttySAM
+        SAM_PORT=/tmp/ttySAM python gui/robot-gui.py
+"""
+
+import argparse, os, select, threading, time
+from collections import deque, namedtuple
+
+import numpy as np
+
+from motion import Profile, clamp, pulse_ends
+from protocol import (BAUDRATE, CREDIT, BINARY_FLAG, BINARY_JOINTS, BUFFER_SIZE, FRAME_SIZE, END_MARKER, HARD_END_MARKER, HOME_CANCEL,
+                      HOMING_CANCELLED, HOMING_DONE, HOMING_GAVE_UP, HOMING_LIMIT, HOMING_REPORT_PASSES, HOMING_RUNNING, STEPPERS,
+                      TELEMETRY_MIN_PERIOD, transmit_time)
+
+RX_BUFFER_SIZE = 64     # HardwareSerial buffers on the Uno
+TX_BUFFER_SIZE = 64
+LOOP_TIME = 25e-6       # Seconds per trip round loop(). interpreter.ino measures 18-30us.
+IDENTITY = "SAM 9 BMAQHT"
+QUEUE_SIZE = 8          # queueSize
+BOOT_TIME = 1.0         # Seconds the bootloader has the serial port after a reset, before the sketch starts
+
+# command.h
+COMMAND_MAX_MOVES = 5
+COMMAND_MAX_FIELDS = 1 + 3 * COMMAND_MAX_MOVES
+COMMAND_MAX_ANGLE = 32767
+COMMAND_MAX_VALUE = 65535
+
+# What parse_command() fills in. moves is a tuple of (joint, angle, dir), or (joint, cruise_del, accel) for a profile.
+Command = namedtuple("Command", "identifier notify fields moves")
+
+def parse_number(text, limit):
+    if not 1 <= len(text) <= 5 or any(c < '0' or c > '9' for c in text):
+        return None
+    value = int(text)
+    return value if value <= limit else None
+
+def parse_command(text):
+    """ parse_command() from command.c, step for step. Returns (accepted, Command). """
+
+    if not text or text[-1] not in (END_MARKER, HARD_END_MARKER):
+        return False, Command('\0', False, 0, ())
+    notify = text[-1] == HARD_END_MARKER
+    text = text[:-1]
+    if text[-1:] == '_':
+        text = text[:-1]
+    if not text or text[0] == '_':
+        return False, Command('\0', notify, 0, ())
+
+    fields = text.split('_')
+    if len(fields) > COMMAND_MAX_FIELDS:
+        return False, Command('\0', notify, 0, ())
+    identifier = text[0]
+    rejected = (False, Command(identifier, notify, len(fields), ()))
+
+    if identifier == 'm':
+        if len(fields[0]) != 1 or len(fields) < 4 or (len(fields) - 1) % 3:
+            return rejected
+        moves = []
+        for i in range(1, len(fields), 3):
+            joint = fields[i]
+            if len(joint) != 1 or joint not in "sebwr" or joint in [move[0] for move in moves]:
+                return rejected
+            angle, dir = parse_number(fields[i + 1], COMMAND_MAX_ANGLE), parse_number(fields[i + 2], 1)
+            if angle is None or dir is None:
+                return rejected
+            moves.append((joint, angle, dir))
+        return True, Command(identifier, notify, len(fields), tuple(moves))
+
+    if identifier == 'a':
+        if len(fields[0]) != 2 or len(fields) != 3 or text[1] not in "seb":
+            return rejected
+        cruise, accel = parse_number(fields[1], COMMAND_MAX_VALUE), parse_number(fields[2], COMMAND_MAX_VALUE)
+        if cruise is None or accel is None:
+            return rejected
+        return True, Command(identifier, notify, 3, ((text[1], cruise, accel),))
+
+    if len(fields) == 1:
+        return True, Command(identifier, notify, 1, ((identifier, 0, 0),))
+    if len(fields) != 3:
+        return rejected
+    angle, dir = parse_number(fields[1], COMMAND_MAX_ANGLE), parse_number(fields[2], 1)
+    if angle is None or dir is None:
+        return rejected
+    return True, Command(identifier, notify, 3, ((identifier, angle, dir),))
+
+def int16(value):
+    return (value + 0x8000) % 0x10000 - 0x8000
+
+def c_steps(angle):
+    """ int steps = (angle / phase_angle)/2, truncated towards zero like C does """
+    return int16(int((angle / 0.9) / 2))
+
+class Motor():
+    """ One StepperMotor. Position is in pulses away from the limit switch, so dir 1 (towards the switch) counts down. """
+
+    def __init__(self, name, id, ms_del, multiplier, position=0):
+        self.name = name
+        self.id = id
+        self.ms_del = ms_del
+        self.multiplier = multiplier
+        self.position = position
+        self.max_steps = 0
+        self.dir = 0
+        self.start = 0
+        self.pulses = 0     # Pulses this operation will send
+        self.end = None     # When max_steps drops back to 0, or None if idle
+        self.profile = None # motion.Profile, if it accelerates
+        self.ends = None    # When each pulse of a profiled operation finishes, from its start
+        self.queue = deque()    # (goal_steps, dir) waiting in queue mode
+
+    def pulse_time(self):
+        return 2 * self.ms_del / 1000000
+
+    def set_profile(self, cruise_del, accel):
+        profile = clamp(self.id, Profile(cruise_del, accel))
+        self.profile = profile if profile.accel else None
+
+    def new_op(self, goal_steps, dir, now):
+        self.settle(now)
+        self.max_steps = int16(goal_steps * self.multiplier)
+        self.dir = dir
+        self.start = now
+        self.ends = None
+        if self.max_steps > 0:
+            # drive_motor runs while steps <= max_steps, then clear_op resets steps to 0 and it sneaks in one more
+            self.pulses = self.max_steps + 2
+            if self.profile is None:
+                self.end = now + (self.max_steps + 1) * self.pulse_time()
+            else:
+                self.ends = pulse_ends(self.max_steps, self.id, self.profile)
+                self.end = now + self.ends[self.max_steps]
+        else:
+            # Nothing to do, but steps <= max_steps still holds for a zero step move so it pulses once anyway
+            self.pulses = 1 if self.max_steps == 0 else 0
+            self.max_steps = 0
+            self.end = None
+
+    def done(self, now):
+        """ Pulses sent so far on the current operation """
+        if self.ends is not None:
+            return int(np.searchsorted(self.ends, now - self.start, side="right"))
+        return min(self.pulses, int((now - self.start) / self.pulse_time()))
+
+    def settle(self, now):
+        """ Credits the pulses sent so far to the position, and drops the operation if it's been interrupted """
+
+        if self.pulses:
+            done = self.done(now)
+            self.position += -done if self.dir == 1 else done
+        self.pulses = 0
+        self.max_steps = 0
+        self.end = None
+
+    def finish(self):
+        # clear_op. The stray pulse is still to come, so pulses keeps counting until the next settle()
+        self.max_steps = 0
+        self.end = None
+
+    def busy(self):
+        return self.max_steps != 0
+
+class Firmware():
+    """ interpreter.ino in simulated time. Times are in seconds. """
+
+    def __init__(self, baudrate=BAUDRATE, latency=0, loop_time=LOOP_TIME):
+        self.baudrate = baudrate
+        self.latency = latency
+        self.loop_time = loop_time
+
+        self.motors = {}
+        for name, id in (("shoulder1", 's'), ("shoulder2", 's'), ("elbow", 'e'), ("base", 'b')):
+            self.motors[name] = Motor(name, id, *STEPPERS[id])
+        self.servos = {'w': 90, 'r': 90, 'g': 90}
+
+        self.incoming = deque()     # (arrival time, byte) on the wire towards the robot
+        self.wire_in_free = 0
+        self.rx = deque()           # (arrival time, byte) in the serial receive buffer
+        self.outgoing = deque()     # (arrival time at the host, byte)
+        self.wire_out_free = 0
+        self.fw_free = 0            # When loop() is next free to do something
+
+        self.received = []          # receivedChars, minus the null terminator
+        self.frame = []
+        self.pending = None         # The line or frame waiting for interpret()
+        self.new_data = False
+        self.new_data_time = 0
+        self.binary_data = False
+        self.notify_at_end = False
+        self.queueing = False
+        self.deepest = 0            # Most moves ever waiting on one motor
+        self.homing = None          # When homing started, while it's going
+        self.homing_passes = 0      # Passes it takes until both switches close
+        self.homing_reported = 0    # Passes as of the last progress report
+        self.telemetry_period = 0   # Seconds between telemetry reports, 0 when they're off
+        self.telemetry_last = 0
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.bytes_dropped = 0
+        self.commands = 0
+        self.rejected = 0           # Lines parse_command() threw out
+        self.acks = 0
+        self.log = []               # (time, command) for everything interpreted
+        self.booted = 0             # When the sketch started, which millis() counts from
+        self.reboots = 0
+
+    # Host side
+
+    def receive(self, data, now):
+        """ Host writes data at time now. It arrives a byte at a time at the baudrate. """
+        for byte in data:
+            self.wire_in_free = max(self.wire_in_free, now) + transmit_time(1, self.baudrate)
+            self.incoming.append((self.wire_in_free + self.latency, byte))
+        self.bytes_in += len(data)
+
+    def transmit(self, now):
+        """ Returns everything the robot has sent that's reached the host by now """
+        data = bytearray()
+        while self.outgoing and self.outgoing[0][0] <= now:
+            data.append(self.outgoing.popleft()[1])
+        return bytes(data)
+
+    def next_output(self):
+        return self.outgoing[0][0] if self.outgoing else None
+
+    # Robot side
+
+    def write(self, data, now):
+        """ Serial.write. Blocks loop() if the transmit buffer is full. """
+
+        for byte in data:
+            self.wire_out_free = max(self.wire_out_free, now) + transmit_time(1, self.baudrate)
+            self.outgoing.append((self.wire_out_free + self.latency, byte))
+        self.bytes_out += len(data)
+        backlog = self.wire_out_free - now - TX_BUFFER_SIZE * transmit_time(1, self.baudrate)
+        if backlog > 0:
+            self.fw_free = max(self.fw_free, now + backlog)
+
+    def motors_idle(self):
+        return not any(motor.busy() or motor.queue for motor in self.motors.values()) and self.homing is None
+
+    def takes_next(self):
+        """ Whether loop() would run the instruction waiting now. Only a cancel gets through while homing. """
+        if self.homing is not None:
+            return not self.binary_data and self.pending[:1] == HOME_CANCEL[0]
+        return not self.notify_at_end and not self.queues_full()
+
+    def next_event(self):
+        """ Returns (time, handler) for whatever happens next, or (None, None) if we're waiting on the host """
+
+        events = []
+        if self.incoming:
+            events.append((self.incoming[0][0], self.arrive))
+        if self.rx and not self.new_data:
+            events.append((max(self.fw_free, self.rx[0][0]), self.consume))
+        if self.new_data and self.takes_next():
+            events.append((max(self.fw_free, self.new_data_time), self.execute))
+        if self.homing is not None:
+            events.append((max(self.fw_free, self.homing_due()), self.run_homing))
+        if self.telemetry_period:
+            events.append((max(self.fw_free, self.telemetry_last + self.telemetry_period), self.report_telemetry))
+        ends = [motor.end for motor in self.motors.values() if motor.end is not None]
+        if ends:
+            events.append((min(ends), self.motor_done))
+        if not events:
+            return None, None
+        return min(events, key=lambda event: event[0])
+
+    def advance(self, until):
+        """ Runs the firmware up to time until """
+        while True:
+            t, handler = self.next_event()
+            if handler is None or t > until:
+                return
+            handler(t)
+
+    def reboot(self, t):
+        """ The board resets, like an Uno does when a USB port is opened. Everything in RAM is gone, anything on the wire is lost
+            and the bootloader eats whatever arrives for BOOT_TIME, but the steppers stay where they got to.
+        """
+
+        positions = self.positions(t)
+        counters = (self.bytes_in, self.bytes_out, self.bytes_dropped, self.commands, self.rejected, self.log, self.deepest, self.reboots)
+        self.__init__(self.baudrate, self.latency, self.loop_time)
+        for name, position in positions.items():
+            self.motors[name].position = position
+        self.bytes_in, self.bytes_out, self.bytes_dropped, self.commands, self.rejected, self.log, self.deepest, self.reboots = counters
+        self.reboots += 1
+        self.booted = self.fw_free = self.wire_in_free = self.wire_out_free = t + BOOT_TIME
+
+    def arrive(self, t):
+        arrival, byte = self.incoming.popleft()
+        if arrival < self.booted:
+            self.bytes_dropped += 1     # The bootloader had it
+        elif len(self.rx) < RX_BUFFER_SIZE:
+            self.rx.append((arrival, byte))
+        else:
+            self.bytes_dropped += 1
+
+    def consume(self, t):
+        """ One pass of read() """
+
+        byte = self.rx.popleft()[1]
+        self.fw_free = t + self.loop_time
+        c = chr(byte)
+
+        if self.frame or (not self.received and byte & BINARY_FLAG):
+            self.frame.append(byte)
+            if len(self.frame) == FRAME_SIZE:
+                frame, self.frame = self.frame, []
+                if c in (END_MARKER, HARD_END_MARKER):
+                    self.binary_data = True
+                    self.line_ready(t, frame)
+        elif c not in (END_MARKER, HARD_END_MARKER):
+            if len(self.received) > BUFFER_SIZE - 2:
+                self.received[BUFFER_SIZE - 2] = c      # ndx sticks at numChars - 2 and that character keeps getting overwritten
+            else:
+                self.received.append(c)
+        else:
+            del self.received[BUFFER_SIZE - 2:]         # Which is also where the end marker lands
+            self.received.append(c)
+            line, self.received = "".join(self.received), []
+            self.line_ready(t, line)
+
+    def line_ready(self, t, data):
+        self.new_data = True
+        self.new_data_time = t
+        self.pending = data
+        if self.takes_next():
+            self.execute(t)     # Same trip round loop() as the read that finished it
+
+    def execute(self, t):
+        t = max(t, self.fw_free - self.loop_time)
+        self.fw_free = max(self.fw_free, t + self.loop_time)
+        self.new_data = False
+        if self.homing is not None:
+            self.finish_homing(t, HOMING_CANCELLED)
+            self.check_ack(t)
+            return
+        if self.binary_data:
+            self.binary_data = False
+            self.run_frame(self.pending, t)
+        else:
+            self.interpret(self.pending, t)
+        self.next_ops(t)
+        self.check_ack(t)
+
+    def run_frame(self, frame, t):
+        if chr(frame[-1]) == HARD_END_MARKER:
+            self.notify_at_end = True
+        joint = frame[0] & ~BINARY_FLAG
+        if joint >= len(BINARY_JOINTS):
+            return
+        packed = frame[1] << 8 | frame[2]
+        command = "%s_%s_%s_%s" % (BINARY_JOINTS[joint], packed >> 1, packed & 1, chr(frame[-1]))
+        self.run_instruction(BINARY_JOINTS[joint], packed >> 1, packed & 1, t, command)
+
+    def interpret(self, line, t):
+        """ interpret(text, length) """
+
+        accepted, command = parse_command(line)
+        if command.notify:
+            self.notify_at_end = True
+        if not accepted:
+            self.rejected += 1
+            return
+
+        if command.identifier == 'm':
+            for joint, angle, dir in command.moves:
+                self.run_instruction(joint, angle, dir, t, line)
+        elif command.identifier == 'a':
+            self.run_profile(command, t, line)
+        elif command.identifier == 'q':
+            if command.fields > 1:
+                self.queueing = command.moves[0][1] != 0
+            self.write(("Q %s %s %s %s\r\n" % ((QUEUE_SIZE if self.queueing else 0,) + tuple(
+                len(self.motors[name].queue) for name in ("shoulder1", "elbow", "base")))).encode(), t)
+        elif command.identifier == 't':
+            if command.fields > 1:
+                period = command.moves[0][1]
+                self.telemetry_period = max(period, TELEMETRY_MIN_PERIOD) / 1000 if period else 0
+            self.report_telemetry(t)
+        else:
+            joint, angle, dir = command.moves[0]
+            self.run_instruction(command.identifier, angle, dir, t, line)
+
+    def run_profile(self, command, t, line):
+        self.commands += 1
+        self.log.append((t, line))
+        id, cruise, accel = command.moves[0]
+        for motor in self.motors.values():
+            if motor.id == id:
+                motor.set_profile(cruise, accel)
+
+    def run_instruction(self, identifier, angle, dir, t, command):
+        self.commands += 1
+        self.log.append((t, command))
+
+        if identifier == 'Z':
+            self.start_homing(t)
+        elif identifier == 'g':
+            self.servos['g'] = 0 if self.servos['g'] > 40 else 180
+        elif identifier == '?':
+            self.write(("%s %s %s\r\n" % (IDENTITY, self.acks % 0x10000, int((t - self.booted) * 1000))).encode(), t)
+
+        steps = c_steps(angle)
+        if identifier == 's':
+            self.start_move(self.motors["shoulder1"], steps, dir, t)
+            self.start_move(self.motors["shoulder2"], steps, dir, t)
+        elif identifier == 'e':
+            self.start_move(self.motors["elbow"], steps, dir, t)
+        elif identifier == 'b':
+            self.start_move(self.motors["base"], steps, dir, t)
+        elif identifier in "wr":
+            self.servos[identifier] = max(0, min(180, angle)) if angle < 200 else angle
+        if identifier == 'g':
+            self.servos['g'] = 180  # run_instruction writes 180 straight after grab(), so the claw always ends up shut
+
+    def start_move(self, motor, steps, dir, t):
+        if self.queueing:
+            motor.queue.append((steps, dir))
+            self.deepest = max(self.deepest, len(motor.queue))
+        else:
+            motor.queue.clear()
+            motor.new_op(steps, dir, t)
+
+    def queues_full(self):
+        return any(len(motor.queue) >= QUEUE_SIZE for motor in self.motors.values())
+
+    def next_ops(self, t):
+        """ Starts the next queued move on every motor that's finished, with a credit for each. The shoulders count once. """
+
+        for name in ("shoulder1", "elbow", "base"):
+            motor = self.motors[name]
+            if motor.queue and not motor.busy():
+                motor.new_op(*motor.queue.popleft(), t)
+                if name == "shoulder1":
+                    shoulder2 = self.motors["shoulder2"]
+                    shoulder2.new_op(*shoulder2.queue.popleft(), t)
+                self.write(CREDIT, t)
+
+    def start_homing(self, t):
+        """ start_homing(). The shoulders and elbow stop what they were doing, and run_homing() takes over a pass at a time. """
+
+        shoulder, elbow = self.motors["shoulder1"], self.motors["elbow"]
+        for motor in (shoulder, self.motors["shoulder2"], elbow):
+            motor.settle(t)
+            motor.queue.clear()
+        self.homing = t
+        self.homing_passes = max(shoulder.position, elbow.position, 0)
+        self.homing_reported = 0
+
+    def homing_period(self):
+        return self.motors["shoulder1"].ms_del / 1000000
+
+    def homing_due(self):
+        """ When run_homing() next has something to say: a progress report, or that it's over """
+        report = self.homing_reported + HOMING_REPORT_PASSES
+        if report <= min(self.homing_passes, HOMING_LIMIT):
+            return self.homing + (report - 1) * self.homing_period()    # Reported as that pass starts
+        return self.homing + min(self.homing_passes, HOMING_LIMIT) * self.homing_period()
+
+    def run_homing(self, t):
+        report = self.homing_reported + HOMING_REPORT_PASSES
+        if report <= min(self.homing_passes, HOMING_LIMIT):
+            self.homing_reported = report
+            self.write(("H %s %s\r\n" % (HOMING_RUNNING, report)).encode(), t)
+        else:
+            self.finish_homing(t, HOMING_DONE if self.homing_passes <= HOMING_LIMIT else HOMING_GAVE_UP)
+            self.check_ack(t)
+
+    def finish_homing(self, t, code):
+        """ finish_homing(). The joints got as far back as the passes so far took them. """
+
+        passes = min(self.homing_passes, HOMING_LIMIT, int((t - self.homing) / self.homing_period()) + 1)
+        for name in ("shoulder1", "shoulder2", "elbow"):
+            motor = self.motors[name]
+            motor.position = motor.position - passes if motor.position > passes else min(motor.position, 0)
+        self.homing = None
+        self.write(("H %s %s\r\n" % (code, passes)).encode(), t)
+
+    def report_telemetry(self, t):
+        """ report_telemetry(). Every trip round loop() takes loop_time here, so there's no jitter to report. """
+
+        positions = self.positions(t)
+        loops = int((t - self.telemetry_last) / self.loop_time)
+        loop_us = int(self.loop_time * 1000000) if loops else 0
+        switches = (1 if positions["shoulder1"] <= 0 else 0) | (2 if positions["elbow"] <= 0 else 0)
+        fields = ((int(t * 1000), self.commands) + tuple(positions[name] for name in ("shoulder1", "elbow", "base"))
+                  + tuple(len(self.motors[name].queue) for name in ("shoulder1", "elbow", "base")) + (loops, loop_us, loop_us, loop_us, switches))
+        self.write(("T %s\r\n" % " ".join(str(field) for field in fields)).encode(), t)
+        self.telemetry_last = t
+
+    def motor_done(self, t):
+        for motor in self.motors.values():
+            if motor.end is not None and motor.end <= t:
+                motor.finish()
+        self.next_ops(t)
+        self.check_ack(t)
+
+    def check_ack(self, t):
+        if self.notify_at_end and self.motors_idle():
+            t = max(t, self.fw_free - self.loop_time)
+            self.write(b'0', t)
+            self.notify_at_end = False
+            self.acks += 1
+            self.fw_free = max(self.fw_free, t + self.loop_time)    # Anything held back runs on the next trip round loop()
+
+    def positions(self, now):
+        """ Pulses away from the limit switch for every motor, counting moves still in progress """
+        positions = {}
+        for name, motor in self.motors.items():
+            position = motor.position
+            if motor.pulses:
+                done = motor.done(now)
+                position += -done if motor.dir == 1 else done
+            positions[name] = position
+        return positions
+
+    def stats(self):
+        return {"bytes_in": self.bytes_in, "bytes_out": self.bytes_out, "bytes_dropped": self.bytes_dropped,
+                "commands": self.commands, "rejected": self.rejected, "acks": self.acks, "deepest": self.deepest, "reboots": self.reboots}
+
+class SimulatedSerial():
+    """ Enough of serial.Serial for the GUI, CLI and executor, backed by a Firmware running against the wall clock.
+
+        speed runs the robot that many times faster than real time, baudrate included, which is handy for benchmarks.
+    """
+
+    def __init__(self, firmware=None, speed=1.0, timeout=None):
+        self.firmware = firmware or Firmware()
+        self.speed = speed
+        self.timeout = timeout
+        self.start = time.monotonic()
+        # write() wakes read() up, so it never sleeps through the ack to a command it didn't know had been sent
+        self.lock = threading.Condition()
+        self.is_open = True
+
+    def now(self):
+        return (time.monotonic() - self.start) * self.speed
+
+    def write(self, data):
+        with self.lock:
+            now = self.now()
+            self.firmware.advance(now)
+            self.firmware.receive(bytes(data), now)
+            self.lock.notify_all()
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        with self.lock:
+            now = self.now()
+            self.firmware.advance(now)
+            return sum(1 for t, byte in self.firmware.outgoing if t <= now)
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        data = bytearray()
+        with self.lock:
+            while True:
+                now = self.now()
+                self.firmware.advance(now)
+                while len(data) < size and self.firmware.outgoing and self.firmware.outgoing[0][0] <= now:
+                    data.append(self.firmware.outgoing.popleft()[1])
+                if len(data) >= size:
+                    return bytes(data)
+                # Sleep until the firmware next has something to do, or until write() gives it something
+                wait = None
+                for t in (self.firmware.next_output(), self.firmware.next_event()[0]):
+                    if t is not None:
+                        wait = max(0, (t - now) / self.speed) if wait is None else min(wait, max(0, (t - now) / self.speed))
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return bytes(data)
+                    wait = remaining if wait is None else min(wait, remaining)
+                self.lock.wait(wait)
+
+    def close(self):
+        self.is_open = False
+
+def serve_pty(firmware=None, speed=1.0, link=None, running=lambda: True):
+    """ Runs a Firmware on a pseudo terminal until running() goes false. Prints the port to open. """
+
+    import tty     # Not on Windows, where SimulatedSerial still works
+
+    firmware = firmware or Firmware()
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    port = os.ttyname(slave)
+    if link:
+        if os.path.islink(link):
+            os.remove(link)
+        os.symlink(port, link)
+    print("Simulated S.A.M listening on %s" % (link or port))
+
+    start = time.monotonic()
+    now = lambda: (time.monotonic() - start) * speed
+    try:
+        while running():
+            t = now()
+            firmware.advance(t)
+            data = firmware.transmit(t)
+            if data:
+                os.write(master, data)
+
+            wait = 0.05
+            for event in (firmware.next_output(), firmware.next_event()[0]):
+                if event is not None:
+                    wait = min(wait, max(0, (event - t) / speed))
+            readable, _, _ = select.select([master], [], [], wait)
+            if readable:
+                try:
+                    data = os.read(master, 1024)
+                except OSError:
+                    continue    # Nobody has the port open right now
+                firmware.receive(data, now())
+    finally:
+        if link and os.path.islink(link):
+            os.remove(link)
+        os.close(master)
+        os.close(slave)
+
+def serve_tcp(firmware=None, speed=1.0, port=7777, running=lambda: True, drop_every=None, reset_on_reconnect=False):
+    """ Runs a Firmware behind a TCP socket, one client at a time, for transport.py's socket:// backend.
+
+        Like a bluetooth module, the robot carries on regardless when the client goes away and anything it says meanwhile is lost.
+        drop_every hangs up on the client after that many seconds connected, to exercise reconnecting.
+        reset_on_reconnect reboots the firmware whenever a client connects after the first, like reopening a USB port does to an Uno.
+    """
+
+    import socket
+
+    firmware = firmware or Firmware()
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("127.0.0.1", port))
+    server.listen(1)
+    print("Simulated S.A.M listening on socket://localhost:%s" % port, flush=True)
+
+    start = time.monotonic()
+    now = lambda: (time.monotonic() - start) * speed
+    client = None
+    connected_at = None
+    drops = 0
+    try:
+        while running():
+            t = now()
+            firmware.advance(t)
+            data = firmware.transmit(t)
+            if data and client is not None:
+                try:
+                    client.sendall(data)
+                except OSError:
+                    client.close()
+                    client = None
+
+            if client is not None and drop_every and time.monotonic() - connected_at > drop_every:
+                client.close()
+                client = None
+                drops += 1
+
+            wait = 0.05
+            for event in (firmware.next_output(), firmware.next_event()[0]):
+                if event is not None:
+                    wait = min(wait, max(0, (event - t) / speed))
+            readable, _, _ = select.select([client or server], [], [], wait)
+            if not readable:
+                continue
+            if client is None:
+                client, address = server.accept()
+                if reset_on_reconnect and connected_at is not None:
+                    firmware.reboot(now())
+                connected_at = time.monotonic()
+                continue
+            try:
+                data = client.recv(1024)
+            except OSError:
+                data = b""
+            if data:
+                firmware.receive(data, now())
+            else:
+                client.close()
+                client = None
+    finally:
+        if client is not None:
+            client.close()
+        server.close()
+    return drops
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a simulated S.A.M on a pseudo terminal, or a TCP port with --tcp")
+    parser.add_argument("--link", help="Symlink the pseudo terminal here, e.g. /tmp/ttySAM")
+    parser.add_argument("--tcp", type=int, help="Listen on this TCP port instead, for socket://localhost:PORT")
+    parser.add_argument("--drop-every", type=float, help="With --tcp, hang up on the client after this many seconds")
+    parser.add_argument("--reset-on-reconnect", action="store_true", help="With --tcp, reset the board whenever a client connects again, like a USB port does")
+    parser.add_argument("--speed", type=float, default=1.0, help="Run this many times faster than real time")
+    parser.add_argument("--latency", type=float, default=0, help="One way link latency in seconds, 0.02 is about right for bluetooth")
+    parser.add_argument("--baudrate", type=int, default=BAUDRATE)
+    args = parser.parse_args()
+
+    firmware = Firmware(baudrate=args.baudrate, latency=args.latency)
+    try:
+        if args.tcp:
+            serve_tcp(firmware, speed=args.speed, port=args.tcp, drop_every=args.drop_every, reset_on_reconnect=args.reset_on_reconnect)
+        else:
+            serve_pty(firmware, speed=args.speed, link=args.link)
+    except KeyboardInterrupt:
+        print(firmware.stats())
+
+if __name__ == "__main__":
+    main()
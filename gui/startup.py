@@ -0,0 +1,45 @@
+"""
+    Startup timing for the GUI
+
+    Records how long after launch the window first drew and the robot was connected, prints it,
+    and appends it to ~/.cache/sam/startup.jsonl so slow starts can be compared over time.
+"""
+
+import json, os, threading, time
+
+LOG = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "sam", "startup.jsonl")
+
+class StartupTimer():
+    """ Marks are seconds since started, which should be taken before the heavy imports. Only the first of each name counts. """
+
+    def __init__(self, started, log=LOG):
+        self.started = started
+        self.log = log
+        self.marks = {}
+        self.lock = threading.Lock()
+        self.saved = False
+
+    def mark(self, name):
+        with self.lock:
+            if name not in self.marks:
+                self.marks[name] = time.monotonic() - self.started
+
+    def report(self):
+        with self.lock:
+            return "Startup: " + ", ".join("%s %.3fs" % (name, seconds) for name, seconds in self.marks.items())
+
+    def save(self, **extra):
+        """ Prints the marks so far and appends them to the log. Only does anything the first time. """
+
+        with self.lock:
+            if self.saved:
+                return
+            self.saved = True
+            record = dict(self.marks, time=time.time(), **extra)
+        print(self.report())
+        try:
+            os.makedirs(os.path.dirname(self.log), exist_ok=True)
+            with open(self.log, "a") as file:
+                file.write(json.dumps(record) + "\n")
+        except OSError as e:
+            print("Couldn't save startup times: %s" % e)
@@ -0,0 +1,10 @@
+"""
+    Small helpers for the numbers the executor, telemetry and tracing report
+"""
+
+def percentile(values, fraction):
+    """ The value fraction of the way through values, or None if there aren't any """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
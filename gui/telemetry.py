@@ -0,0 +1,116 @@
+"""
+    Telemetry from the robot, and the live numbers worked out from it
+
+    Robots with CAPABILITY_TELEMETRY send a line like this every so often, once they've been sent protocol.telemetry_mode():
+
+        T 52310 118 402 -12 0 0 1 0 1630 18 412 24 1
+
+    That's millis(), instructions run since power on, shoulder, elbow and base pulses away from their switches, moves queued
+    on each, then the trips round loop() since the last report with the shortest, longest and mean in us, and which limit
+    switches are closed (1 for the shoulder, 2 for the elbow). parse_telemetry() decodes one.
+
+    Monitor puts those together with what the host sees: commands sent per second and how long acks take to come back,
+    as a histogram. The GUI shows it in its telemetry panel, and robot-cli puts it in its stats:
+
+        python gui/robot-cli.py scripts/weird.sams --simulate 20 --telemetry 250 --stats -
+"""
+
+import bisect, threading, time
+from collections import deque, namedtuple
+
+from protocol import TELEMETRY_PREFIX
+from stats import percentile
+
+DEFAULT_PERIOD = 250    # ms between reports when nobody says otherwise
+RATE_WINDOW = 5         # Seconds of sent commands the host's rate is worked out over
+LATENCY_BINS = (0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)    # Upper edges of the ack round trip histogram in seconds, plus one more for anything slower
+LATENCY_SAMPLES = 1000  # Round trips kept for the percentiles
+
+# pulses and queued are {id: value} for s, e and b, and switches is the ids of the closed ones
+Telemetry = namedtuple("Telemetry", "millis commands pulses queued loops loop_min loop_max loop_mean switches")
+
+def parse_telemetry(line):
+    """ Turns a T line into a Telemetry, or None if it isn't one """
+
+    fields = line.split()
+    if len(fields) != 14 or fields[0] != TELEMETRY_PREFIX:
+        return None
+    try:
+        values = [int(field) for field in fields[1:]]
+    except ValueError:
+        return None
+    switches = "".join(id for bit, id in ((1, 's'), (2, 'e')) if values[12] & bit)
+    return Telemetry(values[0], values[1], dict(zip("seb", values[2:5])), dict(zip("seb", values[5:8])),
+                     values[8], values[9], values[10], values[11], switches)
+
+def bin_labels():
+    """ A short label for each histogram bin """
+    label = lambda seconds: "%gs" % seconds if seconds >= 1 else "%gms" % (seconds * 1000)
+    return [label(edge) for edge in LATENCY_BINS] + [">" + label(LATENCY_BINS[-1])]
+
+class Monitor():
+    """ Keeps the live numbers. The executor feeds it from the script thread while the GUI reads it, so it's locked. """
+
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.sent_at = deque()      # When each command in the last window seconds went out
+        self.histogram = [0] * (len(LATENCY_BINS) + 1)
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.acks = 0
+        self.latest = None          # Newest Telemetry
+        self.reports = 0
+        self.robot_rate = None      # Instructions the robot ran per second between the last two reports
+        self.loop_worst = 0         # Longest trip round loop() in any report
+
+    def sent(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.sent_at.append(now)
+            self.expire(now)
+
+    def expire(self, now):
+        # Must be called with the lock held
+        while self.sent_at and self.sent_at[0] < now - self.window:
+            self.sent_at.popleft()
+
+    def acked(self, latency):
+        """ Seconds from sending a command to getting its ack """
+        with self.lock:
+            self.acks += 1
+            self.latencies.append(latency)
+            self.histogram[bisect.bisect_left(LATENCY_BINS, latency)] += 1
+
+    def report(self, telemetry):
+        with self.lock:
+            # millis() starts again if the robot does, so only trust it going forwards
+            if self.latest is not None and telemetry.millis > self.latest.millis:
+                self.robot_rate = (telemetry.commands - self.latest.commands) * 1000 / (telemetry.millis - self.latest.millis)
+            self.latest = telemetry
+            self.reports += 1
+            self.loop_worst = max(self.loop_worst, telemetry.loop_max)
+
+    def snapshot(self, now=None):
+        """ Everything as a dict, for the panel or for dumping to JSON. Round trips are in seconds and loop() times in us. """
+
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.expire(now)
+            latencies = sorted(self.latencies)
+            latest = self.latest
+            return {
+                "host_rate": len(self.sent_at) / self.window,
+                "robot_rate": self.robot_rate,
+                "acks": self.acks,
+                "latency_p50": percentile(latencies, 0.5),
+                "latency_p90": percentile(latencies, 0.9),
+                "latency_p99": percentile(latencies, 0.99),
+                "histogram": list(self.histogram),
+                "reports": self.reports,
+                "loop_mean": latest.loop_mean if latest else None,
+                "loop_jitter": latest.loop_max - latest.loop_min if latest and latest.loops else None,
+                "loop_worst": self.loop_worst,
+                "pulses": latest.pulses if latest else None,
+                "queued": latest.queued if latest else None,
+                "switches": latest.switches if latest else None,
+            }
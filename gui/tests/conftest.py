@@ -0,0 +1,118 @@
+"""
+    The gui modules import each other by name, the way they're run from gui/, so put that on the path
+
+        python -m pytest -q gui/tests
+"""
+
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import time
+
+import pytest
+
+from link import SerialReader, identify
+from simulator import SimulatedSerial
+from transport import Transport
+
+SPEED = 20      # How much faster than real time the simulated robot runs
+
+class Link():
+    """ One connection to a simulated robot that outlives it, the way the robot outlives a bluetooth link """
+
+    def __init__(self, bench):
+        self.bench = bench
+        self.robot = bench.robot
+        self.timeout = None
+        self.broken = False
+
+    def check(self):
+        if self.broken:
+            raise OSError("link dropped")
+
+    def write(self, data):
+        self.check()
+        if self.bench.before_write is not None:
+            self.bench.before_write(data)
+            self.check()
+        if self.bench.deaf:
+            return len(data)
+        return self.robot.write(data)
+
+    def read(self, size=1):
+        self.check()
+        self.robot.timeout = self.timeout
+        return self.robot.read(size)
+
+    @property
+    def in_waiting(self):
+        self.check()
+        return self.robot.in_waiting
+
+    def close(self):
+        self.broken = True
+
+class Bench():
+    """ A Transport and SerialReader on a SimulatedSerial, with a link the test can drop """
+
+    def __init__(self, speed=SPEED):
+        self.robot = SimulatedSerial(speed=speed)
+        self.firmware = self.robot.firmware
+        self.link = None
+        self.down = False
+        self.deaf = False           # Writes go nowhere
+        self.before_write = None    # Called with each write's data before it goes out
+        self.ser = Transport(self.connect, name="sim", patience=10)
+        self.reader = SerialReader(self.ser)
+        self.reader.start()
+        self.identity = identify(self.ser, self.reader)
+
+    def connect(self):
+        if self.down:
+            raise OSError("robot unreachable")
+        self.link = Link(self)
+        return self.link
+
+    def drop(self, settle=0, lose_replies=False, reset=False):
+        """ Breaks the link and keeps it down for settle seconds, long enough for the robot to finish what it has.
+            lose_replies throws away everything it said meanwhile, and reset reboots it.
+        """
+        self.down = True
+        self.link.close()
+        time.sleep(settle)
+        with self.robot.lock:
+            now = self.robot.now()
+            self.firmware.advance(now)
+            if lose_replies:
+                self.firmware.outgoing.clear()
+            if reset:
+                self.firmware.reboot(now)
+        self.down = False
+
+    def drop_at(self, write, **kwargs):
+        """ Drops the link just before the write'th write from now goes out, losing it """
+        writes = [0]
+        def before_write(data):
+            writes[0] += 1
+            if writes[0] == write:
+                self.before_write = None
+                self.drop(**kwargs)
+        self.before_write = before_write
+
+    def executed(self):
+        """ Every move and servo command the robot ran, in order, once it's got through everything it was sent.
+            Commands without an ack could still be on their way when a script finishes.
+        """
+        assert identify(self.ser, self.reader) is not None
+        return [command for t, command in self.firmware.log if command[:1] in "sebwrg"]
+
+    def close(self):
+        self.reader.stop()
+        self.ser.close()
+
+@pytest.fixture
+def bench():
+    bench = Bench()
+    yield bench
+    bench.close()
@@ -0,0 +1,86 @@
+import time
+
+from executor import ScriptExecutor
+from protocol import wants_ack
+
+TIMEOUT = 10     # So a test that goes wrong fails rather than hangs
+
+SCRIPT = ["s_5_1_N", "e_5_0_N", "b_5_1_N", "s_5_0_N", "e_5_1_N", "b_5_0_N", "w_80_0_n", "w_100_0_n"] * 4
+
+def subsequence(short, long):
+    remaining = iter(long)
+    return all(any(item == other for other in remaining) for item in short)
+
+def test_runs_everything_once(bench):
+    executor = ScriptExecutor(bench.ser, bench.reader, window=4, timeout=TIMEOUT)
+    assert executor.run(SCRIPT)
+    assert bench.executed() == SCRIPT
+    assert not executor.timed_out
+    assert executor.acked == sum(1 for command in SCRIPT if wants_ack(command))
+
+def test_window_limits_commands_in_flight(bench):
+    for window in (1, 3):
+        outstanding = []
+        def before_write(data):
+            if data.decode().endswith("N"):
+                outstanding.append(sent[0] - bench.reader.ack_count)
+                sent[0] += 1
+        sent = [bench.reader.ack_count]
+        bench.before_write = before_write
+        executor = ScriptExecutor(bench.ser, bench.reader, window=window, timeout=TIMEOUT)
+        assert executor.run(SCRIPT)
+        assert max(outstanding) == window - 1
+
+def test_wide_window_fits_the_receive_buffer(bench):
+    # The byte budget holds it back once what's in flight would overflow the robot's 32 byte buffer
+    executor = ScriptExecutor(bench.ser, bench.reader, window=32, timeout=TIMEOUT)
+    assert executor.run(SCRIPT)
+    assert bench.firmware.bytes_dropped == 0
+    assert bench.executed() == SCRIPT
+
+def test_ack_timeout(bench):
+    bench.deaf = True
+    executor = ScriptExecutor(bench.ser, bench.reader, timeout=0.3)
+    started = time.monotonic()
+    assert not executor.run(SCRIPT)
+    assert executor.timed_out
+    assert time.monotonic() - started < 2
+
+def test_starting_doesnt_ask_the_robot_anything(bench):
+    # Everything it needs came from the identify when it connected, so a deaf robot still gets the script straight away
+    bench.deaf = True
+    writes = []
+    bench.before_write = lambda data: writes.append(data.decode())
+    ScriptExecutor(bench.ser, bench.reader, timeout=0.2).run(SCRIPT[:1])
+    assert writes == [SCRIPT[0]]
+
+def test_reconnect_replays_what_never_arrived(bench):
+    bench.drop_at(6)
+    executor = ScriptExecutor(bench.ser, bench.reader, window=4, timeout=TIMEOUT)
+    assert executor.run(SCRIPT)
+    assert executor.resyncs == 1
+    assert executor.resets == 0
+    assert bench.executed() == SCRIPT
+
+def test_reconnect_counts_acks_lost_with_the_link(bench):
+    # Down long enough for everything in flight to finish, with the acks for it lost
+    bench.drop_at(6, settle=0.3, lose_replies=True)
+    executor = ScriptExecutor(bench.ser, bench.reader, window=4, timeout=TIMEOUT)
+    assert executor.run(SCRIPT)
+    assert executor.resyncs == 1
+    assert executor.lost_acks > 0
+    assert executor.resets == 0
+    assert bench.executed() == SCRIPT
+
+def test_reset_replays_everything_in_flight(bench):
+    bench.drop_at(6, settle=0.3, lose_replies=True, reset=True)
+    executor = ScriptExecutor(bench.ser, bench.reader, window=4, timeout=TIMEOUT)
+    assert executor.run(SCRIPT)
+    assert executor.resets == 1
+    assert executor.lost_acks == 0
+    assert executor.replayed > 0
+    assert bench.firmware.reboots == 1
+    # What was in flight ran before the reset and again after it
+    assert len(bench.executed()) == len(SCRIPT) + executor.replayed
+    assert subsequence(SCRIPT, bench.executed())
+    assert not executor.timed_out
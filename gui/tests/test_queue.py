@@ -0,0 +1,50 @@
+from conftest import Bench
+from executor import ScriptExecutor
+from motion import profile_commands
+from protocol import END_MARKER, parse_queue_report, queue_mode
+from simulator import QUEUE_SIZE
+
+TIMEOUT = 10
+# Long runs on one joint, which go without waiting for acks in queue mode and need more room than one queue has
+SCRIPT = ["s_5_1_N"] * 12 + ["e_5_0_N"] * 12 + ["b_5_1_N", "s_5_0_N", "w_80_0_n"] * 2
+
+def start_queueing(bench):
+    bench.ser.write(queue_mode(True).encode())
+    line = bench.reader.wait_for_line(lambda line: parse_queue_report(line) is not None, 1)
+    assert line is not None
+    return parse_queue_report(line)[0]
+
+def test_queue_credits_keep_the_queues_from_overflowing(bench):
+    size = start_queueing(bench)
+    assert size == QUEUE_SIZE
+    executor = ScriptExecutor(bench.ser, bench.reader, window=4, timeout=TIMEOUT, queue_size=size)
+    assert executor.run(SCRIPT)
+    # Held moves followed by another on the same joint go with n instead, see queue_ahead()
+    assert [command[:-1] for command in bench.executed()] == [command[:-1] for command in SCRIPT]
+    assert bench.firmware.deepest <= QUEUE_SIZE
+    assert bench.firmware.bytes_dropped == 0
+    # Held moves on the same joint went without waiting on each other, counted off by credits instead
+    assert executor.acked < sum(1 for command in SCRIPT if command.endswith("N"))
+    assert executor.credits > 0
+    assert executor.credit_waits > 0
+
+def test_reset_restores_queue_mode_and_setup():
+    # In real time, since telling a reset from its millis() needs the robot's clock to run at the same speed as ours.
+    # Moves sent ahead in queue mode don't get acks to count, so that's all there is to go on here.
+    bench = Bench(speed=1)
+    try:
+        setup = profile_commands(terminator=END_MARKER)
+        for command in setup:
+            bench.ser.write(command.encode())
+        size = start_queueing(bench)
+        bench.drop_at(4, settle=0.3, lose_replies=True, reset=True)
+        executor = ScriptExecutor(bench.ser, bench.reader, window=4, timeout=TIMEOUT, queue_size=size, setup=setup)
+        assert executor.run(["s_5_1_N"] * 6 + ["e_5_0_N"] * 6)
+        assert executor.resets == 1
+        assert bench.firmware.reboots == 1
+        assert bench.firmware.queueing
+        assert all(motor.profile is not None for motor in bench.firmware.motors.values())
+        assert bench.firmware.deepest <= QUEUE_SIZE
+        assert bench.firmware.bytes_dropped == 0
+    finally:
+        bench.close()
@@ -0,0 +1,110 @@
+import io, os, time
+
+import pytest
+
+import sams
+from sams import Script, ScriptError, parse_stream
+
+def write(path, text):
+    with open(path, "w") as file:
+        file.write(text)
+    return str(path)
+
+def test_commands_split_on_terminators(tmp_path):
+    path = write(tmp_path / "a.sams", "s_54_1_Nb_10_0_N\ngN\n  e_5_1_n  Zn")
+    assert list(Script(path, cache_dir=None)) == ["s_54_1_N", "b_10_0_N", "gN", "e_5_1_n", "Zn"]
+
+def test_lone_terminators_are_skipped():
+    assert [command for command, read in parse_stream(io.StringIO("s_1_1_N\nn\n"))] == ["s_1_1_N"]
+
+def test_chunks_split_mid_command():
+    text = "s_54_1_N" * 100
+    assert [command for command, read in parse_stream(io.StringIO(text), chunk_size=5)] == ["s_54_1_N"] * 100
+
+def test_malformed_command(tmp_path):
+    with pytest.raises(ScriptError):
+        list(Script(write(tmp_path / "a.sams", "s_1_1_Nq_x_N"), cache_dir=None))
+
+def test_unterminated_command(tmp_path):
+    with pytest.raises(ScriptError):
+        list(Script(write(tmp_path / "a.sams", "s_1_1_Ns_2_1_"), cache_dir=None))
+
+def test_gives_up_early_without_terminators():
+    class Counting(io.StringIO):
+        reads = 0
+        def read(self, size=-1):
+            Counting.reads += 1
+            return super().read(size)
+    with pytest.raises(ScriptError):
+        list(parse_stream(Counting("x" * 1000000), chunk_size=1024))
+    assert Counting.reads == 1
+
+def test_whitespace_inside_a_command_is_allowed():
+    text = "s_54_1_N" + " " * 100 + "\n" * 100 + "b_10_0_N"
+    assert [command for command, read in parse_stream(io.StringIO(text), chunk_size=16)] == ["s_54_1_N", "b_10_0_N"]
+
+def test_cache_hit(tmp_path):
+    path = write(tmp_path / "a.sams", "s_1_1_N\nb_2_0_N\n")
+    cache = str(tmp_path / "cache")
+    script = Script(path, cache_dir=cache)
+    assert not script.cached()
+    assert list(script) == ["s_1_1_N", "b_2_0_N"]
+    again = Script(path, cache_dir=cache)
+    assert again.cached()
+    # Runs off the compiled copy now, not the source
+    os.remove(path)
+    assert list(again) == ["s_1_1_N", "b_2_0_N"]
+    assert again.progress() == 1
+
+def test_cache_invalidated_by_changes(tmp_path):
+    path = write(tmp_path / "a.sams", "s_1_1_N\n")
+    cache = str(tmp_path / "cache")
+    list(Script(path, cache_dir=cache))
+    write(path, "s_1_1_N\nb_2_0_N\n")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+    script = Script(path, cache_dir=cache)
+    assert not script.cached()
+    assert list(script) == ["s_1_1_N", "b_2_0_N"]
+    assert Script(path, cache_dir=cache).cached()
+
+def test_no_cache_from_a_partial_read(tmp_path):
+    path = write(tmp_path / "a.sams", "s_1_1_N\nb_2_0_N\n")
+    cache = tmp_path / "cache"
+    commands = iter(Script(path, cache_dir=str(cache)))
+    next(commands)
+    commands.close()
+    assert not Script(path, cache_dir=str(cache)).cached()
+    assert os.listdir(cache) == []
+
+def test_no_cache_from_a_bad_script(tmp_path):
+    path = write(tmp_path / "a.sams", "s_1_1_N\nb_2_0_")
+    cache = tmp_path / "cache"
+    with pytest.raises(ScriptError):
+        list(Script(path, cache_dir=str(cache)))
+    assert os.listdir(cache) == []
+
+def test_runs_at_once_share_the_cache(tmp_path):
+    path = write(tmp_path / "a.sams", "".join("s_%s_1_N\n" % i for i in range(1, 50)))
+    cache = str(tmp_path / "cache")
+    first, second = iter(Script(path, cache_dir=cache)), iter(Script(path, cache_dir=cache))
+    together = list(zip(first, second))
+    list(first), list(second)
+    assert all(a == b for a, b in together)
+    assert os.listdir(cache) == [os.path.basename(Script(path, cache_dir=cache).cache_path)]
+    assert list(Script(path, cache_dir=cache)) == [a for a, b in together]
+
+def test_cache_pruned_to_the_most_recently_used(tmp_path):
+    cache = str(tmp_path / "cache")
+    paths = [write(tmp_path / ("%s.sams" % i), "s_%s_1_N\n" % (i + 1)) for i in range(3)]
+    list(Script(paths[0], cache_dir=cache))
+    time.sleep(0.01)
+    list(Script(paths[1], cache_dir=cache))
+    time.sleep(0.01)
+    list(Script(paths[0], cache_dir=cache))    # A hit, so 0 is newer than 1 now
+    time.sleep(0.01)
+    list(Script(paths[2], cache_dir=cache))
+    sams.prune(cache, 2)
+    assert Script(paths[0], cache_dir=cache).cached()
+    assert not Script(paths[1], cache_dir=cache).cached()
+    assert Script(paths[2], cache_dir=cache).cached()
@@ -0,0 +1,144 @@
+"""
+    Where the time goes for each command
+
+    With tracing on, every command the executor or the GUI sends gets a timestamp at the end of each stage:
+
+        queued  taken from the script and waiting for room in the window. Commands from the controls skip this.
+        encode  turned into bytes
+        write   inside ser.write(), or Transport.send() on a connection that can reconnect
+        wire    on its way to the robot at the baudrate. This is an estimate, the OS doesn't say when the bytes really go.
+        robot   from reaching the robot to its ack reaching the reader thread, so it counts the ack's trip back too
+        ack     from the reader thread seeing the ack to the executor dealing with it
+
+    Commands that don't ask for an ack stop after wire. The robot used to echo every command as it started on it,
+    which would have split robot in two, but it doesn't any more (see protocol.TELEMETRY).
+
+    Traces are saved in Chrome's trace event format, for chrome://tracing or https://ui.perfetto.dev, and
+    summarised as a table with the spread of each stage and its share of the total:
+
+        python gui/robot-cli.py scripts/weird.sams --simulate 1 --trace /tmp/weird.json
+        SAM_TRACE=/tmp/gui.json python gui/robot-gui.py
+        python gui/tracing.py /tmp/weird.json
+
+    Nothing is traced unless one of those asks for it. Everything that would record something checks for a Tracer
+    first, so with tracing off that check is all it costs.
+"""
+
+import argparse, json, sys, threading, time
+from collections import deque
+
+from protocol import BAUDRATE, transmit_time
+from stats import percentile
+
+STAGES = ("queued", "encode", "write", "wire", "robot", "ack")
+CATEGORY = "command"
+
+class Tracer():
+    """ Records the stages of every command sent. Times are time.monotonic(). The GUI sends from more than one thread, so it's locked. """
+
+    def __init__(self, baudrate=BAUDRATE):
+        self.baudrate = baudrate
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.records = []           # [command, then when each stage ended, None for the ones it didn't go through]
+        self.spans = []             # (name, start, end) for whole scripts
+        self.awaiting = deque()     # Records of commands sent with N, in the order their acks will come back
+        self.wire_free = 0          # When the bytes written so far should all be out
+
+    def sent(self, command, size, queued, encoding, writing, written, wants_ack):
+        """ command has gone out as size bytes. queued is when it was taken from a script, or None, encoding when it started
+            being encoded, writing when it started being written and written when the write returned.
+        """
+        with self.lock:
+            start = max(self.wire_free, writing)
+            self.wire_free = max(written, start + transmit_time(size, self.baudrate))
+            record = [command, queued, encoding, writing, written, self.wire_free, None, None]
+            self.records.append(record)
+            if wants_ack:
+                self.awaiting.append(record)
+
+    def acked(self, arrived, handled):
+        """ The oldest command still waiting on an ack has it. arrived is when the reader thread saw it, None if it was lost with the link. """
+        with self.lock:
+            if not self.awaiting:
+                return
+            record = self.awaiting.popleft()
+            record[6] = handled if arrived is None else arrived
+            record[7] = handled
+
+    def span(self, name, start, end=None):
+        with self.lock:
+            self.spans.append((name, start, time.monotonic() if end is None else end))
+
+    def events(self):
+        """ The trace as a list of Chrome trace events. Each command is an async slice with one nested inside it per stage. """
+
+        us = lambda t: round((t - self.started) * 1000000, 1)
+        events = [{"name": "process_name", "ph": "M", "pid": 1, "args": {"name": "S.A.M host"}}]
+        with self.lock:
+            for name, start, end in self.spans:
+                events.append({"name": name, "cat": "script", "ph": "X", "pid": 1, "tid": 1, "ts": us(start), "dur": us(end) - us(start)})
+            for id, record in enumerate(self.records):
+                command, times = record[0], record[1:]
+                ended = [t for t in times if t is not None]
+                events.append({"name": command, "cat": CATEGORY, "ph": "b", "id": id, "pid": 1, "tid": 1, "ts": us(ended[0])})
+                previous = None
+                for stage, t in zip(("start",) + STAGES, times):
+                    if t is None:
+                        continue
+                    if previous is not None:
+                        events.append({"name": stage, "cat": CATEGORY, "ph": "b", "id": id, "pid": 1, "tid": 1, "ts": us(previous)})
+                        events.append({"name": stage, "cat": CATEGORY, "ph": "e", "id": id, "pid": 1, "tid": 1, "ts": us(t)})
+                    previous = t
+                events.append({"name": command, "cat": CATEGORY, "ph": "e", "id": id, "pid": 1, "tid": 1, "ts": us(ended[-1])})
+        return events
+
+    def save(self, filename):
+        with open(filename, "w") as file:
+            json.dump({"traceEvents": self.events(), "displayTimeUnit": "ms"}, file)
+
+    def table(self):
+        return table(self.events())
+
+def durations(events):
+    """ Seconds spent in each stage, {stage: [seconds, ...]}, from a list of trace events """
+
+    begun = {}
+    spent = {stage: [] for stage in STAGES}
+    for event in events:
+        if event.get("cat") != CATEGORY or event["name"] not in spent:
+            continue
+        key = (event["id"], event["name"])
+        if event["ph"] == "b":
+            begun[key] = event["ts"]
+        elif event["ph"] == "e" and key in begun:
+            spent[event["name"]].append((event["ts"] - begun.pop(key)) / 1000000)
+    return spent
+
+def table(events):
+    """ Count, mean, p50, p90 and max of each stage in ms, and how much of all the time traced it took """
+
+    spent = durations(events)
+    total = sum(sum(values) for values in spent.values()) or 1
+    rows = ["%-8s %7s %9s %9s %9s %9s %7s" % ("stage", "count", "mean", "p50", "p90", "max", "share")]
+    for stage in STAGES:
+        values = spent[stage]
+        if not values:
+            continue
+        rows.append("%-8s %7d %7.2fms %7.2fms %7.2fms %7.2fms %6.1f%%" % (
+            stage, len(values), sum(values) / len(values) * 1000, percentile(values, 0.5) * 1000, percentile(values, 0.9) * 1000,
+            max(values) * 1000, sum(values) / total * 100))
+    return "\n".join(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("trace", help="A trace saved by robot-cli --trace or SAM_TRACE")
+    args = parser.parse_args()
+
+    with open(args.trace) as file:
+        trace = json.load(file)
+    # Chrome takes either a bare list of events or an object with them in traceEvents
+    print(table(trace["traceEvents"] if isinstance(trace, dict) else trace))
+
+if __name__ == "__main__":
+    sys.exit(main())
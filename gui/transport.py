@@ -0,0 +1,245 @@
+"""
+    A serial link that puts itself back together
+
+    Transport looks like a serial.Serial to everything else, but when the port underneath goes away (a bluetooth link drops,
+    a cable gets bumped) it reopens it on a background thread with exponential backoff rather than letting the exception
+    kill whoever was using it. Reads and writes made while it's down wait for it to come back, up to `patience` seconds.
+
+    The backend is just a function that opens a fresh connection, so anything pyserial can open works:
+        /dev/ttyACM0, COM3        a real port
+        /tmp/ttySAM               the simulator on a pseudo terminal (simulator.py --link)
+        socket://localhost:7777   the simulator over TCP (simulator.py --tcp 7777), handy for testing drops
+        sim://                    the simulator in this process
+
+    generation goes up by one every time it reconnects. The executor watches it to know when to resync and replay
+    whatever the robot hadn't acked, see ScriptExecutor.resync.
+"""
+
+import threading, time
+
+import serial
+
+from protocol import BAUDRATE
+
+BACKOFF_START = 0.05    # Seconds before the first retry, doubling each time
+BACKOFF_MAX = 2.0
+PATIENCE = 60           # Seconds to keep trying before giving up on the link
+
+class LinkDown(serial.SerialException):
+    pass
+
+class LinkReset(serial.SerialException):
+    """ The link was reopened since the caller last looked, so whatever they were about to send might be out of order """
+
+def opener(url, baudrate=BAUDRATE):
+    """ Returns a function that opens a new connection to url each time it's called """
+
+    if url.startswith("sim://"):
+        from simulator import SimulatedSerial
+        return SimulatedSerial
+    return lambda: serial.serial_for_url(url, baudrate)
+
+class Transport():
+    """ Enough of serial.Serial for the reader, executor and GUI, on top of a backend that gets reopened when it fails.
+
+        open is a function returning a new connection, see opener(). connection is an already open one to start with.
+    """
+
+    def __init__(self, open, connection=None, name=None, patience=PATIENCE):
+        self.open = open
+        self.name = name
+        self.patience = patience
+        self.condition = threading.Condition()
+        self.connection = connection
+        self.generation = 0
+        self.closed = False
+        self.reconnecting = False
+        self._timeout = None
+        self._write_timeout = None
+
+        self.reconnects = 0
+        self.failures = 0       # Errors that sent us off reconnecting
+        self.last_error = None
+        self.down_since = None
+        self.downtime = 0       # Seconds spent reconnecting, not counting the current outage
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.last_read = None   # When the robot last sent us anything
+        self.started = time.monotonic()
+
+        if self.connection is None:
+            self.connection = self.open()
+        self.apply_timeouts(self.connection)
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self._timeout = value
+        with self.condition:
+            if self.connection is not None:
+                self.connection.timeout = value
+
+    @property
+    def write_timeout(self):
+        return self._write_timeout
+
+    @write_timeout.setter
+    def write_timeout(self, value):
+        self._write_timeout = value
+        with self.condition:
+            if self.connection is not None and hasattr(self.connection, "write_timeout"):
+                self.connection.write_timeout = value
+
+    @property
+    def is_open(self):
+        return not self.closed
+
+    def apply_timeouts(self, connection):
+        connection.timeout = self._timeout
+        if hasattr(connection, "write_timeout"):
+            connection.write_timeout = self._write_timeout
+
+    def connected(self):
+        return self.connection is not None and not self.closed
+
+    def call(self, method, *args, wait=None, generation=None):
+        """ Calls method on the connection, reconnecting and trying again if it fails. wait caps how long to wait for the link.
+            With generation, raises LinkReset instead of going ahead on any other connection than that one.
+        """
+
+        deadline = time.monotonic() + (self.patience if wait is None else wait)
+        while True:
+            with self.condition:
+                while self.connection is None:
+                    if self.closed:
+                        raise LinkDown("%s is closed" % self.name)
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self.reconnecting:
+                        raise LinkDown("%s is down: %s" % (self.name, self.last_error))
+                    self.condition.wait(remaining)
+                if generation is not None and generation != self.generation:
+                    raise LinkReset("%s was reconnected" % self.name)
+                connection, current = self.connection, self.generation
+            try:
+                return getattr(connection, method)(*args)
+            except Exception as e:
+                if self.closed:
+                    raise LinkDown("%s is closed" % self.name)
+                # Another thread closing the connection under us can fail in all sorts of ways
+                if not isinstance(e, (serial.SerialException, OSError)) and self.connection is connection:
+                    raise
+                self.lost(current, e)
+
+    def lost(self, generation, error):
+        """ Drops the connection from `generation` and starts reconnecting, unless someone else already has """
+
+        with self.condition:
+            if generation != self.generation or self.connection is None:
+                return
+            print("Lost %s: %s. Reconnecting." % (self.name, error))
+            self.failures += 1
+            self.last_error = error
+            self.down_since = time.monotonic()
+            connection, self.connection = self.connection, None
+            self.reconnecting = True
+        try:
+            connection.close()
+        except Exception:
+            pass
+        threading.Thread(target=self.reconnect, daemon=True).start()
+
+    def reconnect(self):
+        delay = BACKOFF_START
+        give_up = time.monotonic() + self.patience
+        while not self.closed and time.monotonic() < give_up:
+            time.sleep(delay)
+            try:
+                connection = self.open()
+            except (serial.SerialException, OSError) as e:
+                self.last_error = e
+                delay = min(delay * 2, BACKOFF_MAX)
+                continue
+            self.apply_timeouts(connection)
+            with self.condition:
+                self.connection = connection
+                self.generation += 1
+                self.reconnects += 1
+                self.downtime += time.monotonic() - self.down_since
+                self.down_since = None
+                self.reconnecting = False
+                self.condition.notify_all()
+            print("Reconnected to %s" % self.name)
+            return
+
+        with self.condition:
+            self.reconnecting = False
+            self.condition.notify_all()
+        print("Gave up reconnecting to %s: %s" % (self.name, self.last_error))
+
+    def write(self, data):
+        written = self.call("write", data)
+        self.bytes_out += len(data)
+        return written
+
+    def send(self, data, generation):
+        """ Writes data only if the link is still the one from generation, otherwise raises LinkReset """
+        written = self.call("write", data, generation=generation)
+        self.bytes_out += len(data)
+        return written
+
+    def read(self, size=1):
+        try:
+            data = self.call("read", size, wait=self._timeout)
+        except LinkDown:
+            if self.reconnecting:
+                return b""  # Still trying, behave like a read that timed out
+            raise
+        if data:
+            self.bytes_in += len(data)
+            self.last_read = time.monotonic()
+        return data
+
+    @property
+    def in_waiting(self):
+        connection = self.connection
+        if connection is None:
+            return 0
+        try:
+            return connection.in_waiting
+        except (serial.SerialException, OSError):
+            return 0    # The next read will notice
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            connection, self.connection = self.connection, None
+            self.condition.notify_all()
+        if connection is not None:
+            connection.close()
+
+    def health(self):
+        """ Link health for the GUI and CLI """
+
+        now = time.monotonic()
+        if self.closed:
+            state = "closed"
+        elif self.connection is not None:
+            state = "up"
+        elif self.reconnecting:
+            state = "reconnecting"
+        else:
+            state = "down"
+        return {
+            "state": state,
+            "reconnects": self.reconnects,
+            "failures": self.failures,
+            "downtime": self.downtime + (now - self.down_since if self.down_since is not None else 0),
+            "uptime": now - self.started,
+            "since_last_read": None if self.last_read is None else now - self.last_read,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "last_error": None if self.last_error is None else str(self.last_error),
+        }
@@ -0,0 +1,77 @@
+"""
+    Rate limited UI updates
+
+    The script thread used to queue a GLib idle callback for every progress tick, and every command redrew the history list.
+    That floods the GTK main loop and the window stutters. Instead, updates go through a UIPump, which applies them
+    at most `fps` times a second. Value updates (progress, status text) keep only the latest value between frames,
+    and list updates (history) are handed over in one batch.
+"""
+
+import threading, time
+
+DEFAULT_FPS = 30
+
+class UIPump():
+    """ Coalesces UI updates from any thread. timeout_add is GLib.timeout_add, or anything with the same signature. """
+
+    def __init__(self, timeout_add, fps=DEFAULT_FPS):
+        self.timeout_add = timeout_add
+        self.interval = 1 / fps
+        self.lock = threading.Lock()
+        self.values = {}        # key -> (function, args). Only the latest one gets applied.
+        self.batches = {}       # key -> (function, [items]). function gets called once with every item.
+        self.scheduled = False
+        self.last_flush = 0
+
+        self.submitted = 0      # Updates handed to the pump
+        self.dropped = 0        # Value updates that were replaced before they were ever shown
+        self.merged = 0         # List updates that got folded into another item's redraw
+        self.flushes = 0        # Times we actually touched the UI
+
+    def set(self, key, function, *args):
+        """ Calls function(*args) on the next frame, replacing anything queued under the same key """
+
+        with self.lock:
+            self.submitted += 1
+            if key in self.values:
+                self.dropped += 1
+            self.values[key] = (function, args)
+            self.schedule()
+
+    def append(self, key, function, item):
+        """ Adds item to the batch under key. On the next frame function gets called once with a list of the whole batch. """
+
+        with self.lock:
+            self.submitted += 1
+            if key in self.batches:
+                self.merged += 1
+                self.batches[key][1].append(item)
+            else:
+                self.batches[key] = (function, [item])
+            self.schedule()
+
+    def schedule(self):
+        # Must be called with the lock held
+        if self.scheduled:
+            return
+        self.scheduled = True
+        delay = max(0, self.interval - (time.monotonic() - self.last_flush))
+        self.timeout_add(int(delay * 1000), self.flush)
+
+    def flush(self):
+        with self.lock:
+            values, self.values = self.values, {}
+            batches, self.batches = self.batches, {}
+            self.scheduled = False
+            self.last_flush = time.monotonic()
+            self.flushes += 1
+
+        for function, items in batches.values():
+            function(items)
+        for function, args in values.values():
+            function(*args)
+        return False    # One shot, so GLib doesn't call us again
+
+    def stats(self):
+        with self.lock:
+            return {"submitted": self.submitted, "dropped": self.dropped, "merged": self.merged, "flushes": self.flushes}
@@ -0,0 +1,139 @@
+// Parses text instructions without Strings. interpret() used to build Strings, slice them with substring() and loop to
+// sizeof(input_str), and the heap churn ran inside the same loop() that times every pulse.
+//
+// An instruction is _ separated fields, then an optional _ and the end marker (n, or N for an ack):
+//   x                    a bare identifier like g, Z or ?, anything after its first character is ignored
+//   x_angle_dir          a move or servo write, the same
+//   m_j_angle_dir...     a batch of up to five moves on different joints, j one of sebwr
+//   aj_cruise_accel      an acceleration profile for stepper j, one of seb
+// Numbers are one to five digits and nothing else. Angles go up to 32767, directions are 0 or 1, profile numbers go up to 65535.
+// Anything else is rejected whole, rather than half run like it used to be.
+// gui/fuzz.py checks every decision this makes against a reference decoder, and gui/simulator.py has a Python copy.
+
+#include "command.h"
+
+static const char batch_joints[] = "sebwr";
+static const char profile_joints[] = "seb";
+
+static uint8_t is_one_of(char c, const char *set) {
+  for (; *set; set++) {
+    if (*set == c) {
+      return 1;
+    }
+  }
+  return 0;
+}
+
+static uint8_t parse_number(const char *text, uint8_t length, uint16_t limit, uint16_t *value) {
+  uint32_t total = 0;
+  uint8_t i;
+  if (length == 0 || length > 5) {
+    return 0;
+  }
+  for (i = 0; i < length; i++) {
+    if (text[i] < '0' || text[i] > '9') {
+      return 0;
+    }
+    total = total * 10 + (text[i] - '0');
+  }
+  if (total > limit) {
+    return 0;
+  }
+  *value = (uint16_t)total;
+  return 1;
+}
+
+uint8_t parse_command(const char *text, uint8_t length, Command *command) {
+  uint8_t starts[COMMAND_MAX_FIELDS];
+  uint8_t lengths[COMMAND_MAX_FIELDS];
+  uint8_t fields = 0;
+  uint8_t start = 0;
+  uint8_t i, j;
+  char end;
+
+  command->identifier = '\0';
+  command->notify = 0;
+  command->fields = 0;
+  command->moves = 0;
+  if (length == 0) {
+    return 0;
+  }
+  end = text[length - 1];
+  if (end != 'n' && end != 'N') {
+    return 0;
+  }
+  command->notify = end == 'N';
+  length--;
+  if (length > 0 && text[length - 1] == '_') {
+    length--;
+  }
+  if (length == 0 || text[0] == '_') {
+    return 0;
+  }
+
+  // Split on _ by remembering where each field is, rather than copying them out
+  for (i = 0; i <= length; i++) {
+    if (i == length || text[i] == '_') {
+      if (fields == COMMAND_MAX_FIELDS) {
+        return 0;
+      }
+      starts[fields] = start;
+      lengths[fields] = i - start;
+      fields++;
+      start = i + 1;
+    }
+  }
+  command->identifier = text[0];
+  command->fields = fields;
+
+  if (command->identifier == 'm') {
+    if (lengths[0] != 1 || fields < 4 || (fields - 1) % 3 != 0) {
+      return 0;
+    }
+    for (i = 1; i < fields; i += 3) {
+      char joint = text[starts[i]];
+      if (lengths[i] != 1 || !is_one_of(joint, batch_joints)) {
+        return 0;
+      }
+      for (j = 0; j < command->moves; j++) {
+        if (command->joints[j] == joint) {
+          return 0;     // A second move would only cut the first one short
+        }
+      }
+      if (!parse_number(text + starts[i + 1], lengths[i + 1], COMMAND_MAX_ANGLE, &command->angles[command->moves])
+          || !parse_number(text + starts[i + 2], lengths[i + 2], 1, &command->dirs[command->moves])) {
+        return 0;
+      }
+      command->joints[command->moves] = joint;
+      command->moves++;
+    }
+    return 1;
+  }
+
+  if (command->identifier == 'a') {
+    if (lengths[0] != 2 || fields != 3 || !is_one_of(text[1], profile_joints)) {
+      return 0;
+    }
+    command->joints[0] = text[1];
+    if (!parse_number(text + starts[1], lengths[1], COMMAND_MAX_VALUE, &command->angles[0])
+        || !parse_number(text + starts[2], lengths[2], COMMAND_MAX_VALUE, &command->dirs[0])) {
+      return 0;
+    }
+    command->moves = 1;
+    return 1;
+  }
+
+  command->joints[0] = command->identifier;
+  command->angles[0] = 0;
+  command->dirs[0] = 0;
+  if (fields == 3) {
+    if (!parse_number(text + starts[1], lengths[1], COMMAND_MAX_ANGLE, &command->angles[0])
+        || !parse_number(text + starts[2], lengths[2], 1, &command->dirs[0])) {
+      return 0;
+    }
+  } else if (fields != 1) {
+    return 0;
+  }
+  command->moves = 1;
+  return 1;
+}
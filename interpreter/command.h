@@ -0,0 +1,35 @@
+// Parser for text instructions. Plain C with no Arduino calls in it, so gui/fuzz.py can build it on the host too.
+
+#ifndef COMMAND_H
+#define COMMAND_H
+
+#include <stdint.h>
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+#define COMMAND_MAX_MOVES 5     // More than a batch can fit in 31 characters
+#define COMMAND_MAX_FIELDS (1 + 3 * COMMAND_MAX_MOVES)
+#define COMMAND_MAX_ANGLE 32767 // Angles end up in an int
+#define COMMAND_MAX_VALUE 65535 // Profile numbers end up in an unsigned int
+
+typedef struct {
+  char identifier;    // First character, which says what to do
+  uint8_t notify;     // 1 if it ended in N and wants an ack, whether or not it made sense
+  uint8_t fields;     // How many _ separated fields it had. 1 for bare ones like g, ? and qn.
+  uint8_t moves;      // Entries in the arrays below. One for everything but batches.
+  char joints[COMMAND_MAX_MOVES];       // Joint each move is for. The identifier itself outside batches and profiles.
+  uint16_t angles[COMMAND_MAX_MOVES];   // Angle, or a profile's cruise_del
+  uint16_t dirs[COMMAND_MAX_MOVES];     // Direction, or a profile's acceleration
+} Command;
+
+// Parses length characters of text, end marker included, into command. Returns 1 if it's a valid instruction and 0 if not.
+// Nothing is allocated and text isn't touched, so it's safe to run in between pulses.
+uint8_t parse_command(const char *text, uint8_t length, Command *command);
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif
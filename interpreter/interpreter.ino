@@ -1,9 +1,12 @@
 // This code just interprets instructions from the GUI and drives the motors according to them. All the heavy lifting gets done at Python level.
 
 #include <Servo.h>
+#include "command.h"
 
 const byte numChars = 32;       // 32 character limit, shouldn't be a problem. Will refine down later.
 char receivedChars[numChars];   // Serial data is stored as an char array
+byte receivedLength = 0;        // Characters in it, end marker included
+Command command;                // What interpret() makes of it. Kept around so parsing never allocates.
 
 boolean newData = false;  // When we finish reading a string of instructions, this variable gets set to true
 
@@ -13,7 +16,48 @@ char endMarker = 'n'; // This character goes at the end of an instruction string
 char hardEndMarker = 'N'; // Used for scripting 
 char rc;              // Currently recieved character
 
+// Binary instructions are a fixed 4 bytes: [0x80 | joint][angle high][angle low | dir][end marker]
+// The top bit is never set on the first character of a text instruction, so we can take both.
+const byte binaryFlag = 0x80;
+const byte frameSize = 4;
+const char binaryJoints[] = "sebwrgZ"; // Joint is the index into this string. Must match BINARY_JOINTS in protocol.py
+byte frame[frameSize];
+byte frameNdx = 0;
+boolean binaryData = false; // Set alongside newData when the instruction waiting is a binary frame
+
+const char identity[] = "SAM 9 BMAQHT"; // Reply to ?, version number then capabilities. B = binary instructions, M = batches of moves, A = acceleration profiles, Q = queue mode, H = homing reports, T = telemetry
+unsigned int acksSent = 0;  // Goes on the end of the reply to ?, so the GUI can tell whether any acks got lost while the link was down
+
 const float phase_angle = 0.9; // All stepper motors in this design have an angle of 1.8 degrees between steps.
+const unsigned int min_del = 500; // Shortest pulse half period a profile can ask for. Has to stay well clear of the time round loop().
+
+const byte queueSize = 8;   // Moves each motor can have waiting in queue mode. The GUI reads it from the Q reply.
+boolean queueing = false;   // q_1_0n turns queue mode on: a move waits for the one before it on the same motor instead of cutting it short
+
+// Homing runs a pass at a time from loop(), so serial keeps getting read and the GUI hears how it's going.
+// Every homingReport passes, and once it's over, we print H <code> <passes so far>. Nothing else runs until then, except a cancel (xn).
+const byte homingDone = 0;
+const byte homingRunning = 1;
+const byte homingCancelled = 2;
+const byte homingGaveUp = 3;        // homingLimit passes and the switches still aren't closed
+const unsigned int homingReport = 50;
+const unsigned int homingLimit = 20000;
+const char cancelMarker = 'x';
+boolean homing = false;
+boolean homingHigh = false;         // Whether the pulse lines are up, half way through a pass
+unsigned int homingPasses = 0;
+unsigned long homingNext = 0;       // micros() when the next half of a pass is due
+
+// Instructions used to be echoed back as they were run, which doubled the traffic on the link and nothing read it.
+// Instead t_250_0n sends a T line every 250ms, t_0_0n stops them and tn sends one now. See report_telemetry() for what's in it.
+const unsigned int telemetryMinPeriod = 100;  // ms. A report is around 50 bytes, so at 9600 baud this already takes half the link.
+unsigned int telemetryPeriod = 0;   // ms between reports, 0 when they're off
+unsigned long telemetryLast = 0;    // millis() at the last report
+unsigned long commandsRun = 0;      // Instructions run since power on, counting each move in a batch
+unsigned long loops = 0;            // Trips round loop() since the last report, and how long they took in us
+unsigned int loopMin = 0xFFFF;
+unsigned int loopMax = 0;
+unsigned long loopTotal = 0;
 
 int current_ms;
 int prev_ms;
@@ -28,6 +72,7 @@ class StepperOperation {
     int steps;
     int DIR;
     int current_del;
+    unsigned int del;   // Half period of the pulse in progress, in us
 };
 
 class StepperMotor {
@@ -36,26 +81,101 @@ class StepperMotor {
     int DIR; 
     int ms_del; // The amount of time in ms to wait between steps
     int multiplier;
+    unsigned int cruise_del;  // Half period once a move is up to speed
+    unsigned int accel;       // Pulses/s/s to get there. 0 means every pulse is ms_del, like it always was.
+    unsigned long ramp_steps; // Steps from either end of a move before it's up to speed
+    long position;            // Pulses sent away from the limit switch since power on, or since homing found it
     StepperOperation current_op;
+    int queued_steps[queueSize];  // Ring buffer of moves waiting their turn in queue mode
+    byte queued_dir[queueSize];
+    byte queue_head;
+    byte queue_count;
+    void queue_op(int goal_steps, int dir);
+    boolean next_op();
     void new_op(int goal_steps, int dir);
     void clear_op();
     void drive_motor();
+    void set_profile(unsigned int cruise, unsigned int acceleration);
+    unsigned int step_delay(int step);
     uint8_t limit_pin;
 };
 
+unsigned long isqrt(unsigned long x) {
+  // Integer square root, a bit at a time. Exact, so the host can work out the same timings (see motion.py).
+  unsigned long root = 0;
+  unsigned long bit = 1UL << 30;
+  while (bit > x) {
+    bit >>= 2;
+  }
+  while (bit != 0) {
+    if (x >= root + bit) {
+      x -= root + bit;
+      root = (root >> 1) + bit;
+    } else {
+      root >>= 1;
+    }
+    bit >>= 2;
+  }
+  return root;
+}
+
+void StepperMotor::set_profile(unsigned int cruise, unsigned int acceleration) {
+  // Speed up from ms_del to cruise at a constant acceleration, and slow down the same way at the other end
+  cruise_del = constrain(cruise, min_del, (unsigned int)ms_del);
+  accel = acceleration;
+  unsigned long start = 500000UL / ms_del;  // Pulses per second
+  unsigned long top = 500000UL / cruise_del;
+  ramp_steps = accel ? (top * top - start * start) / (2UL * accel) + 1 : 0;
+}
+
+unsigned int StepperMotor::step_delay(int step) {
+  // v * v = v0 * v0 + 2 * accel * k, where k is how many steps we are from the nearer end of the move.
+  // Speeds are in 16ths of a pulse per second, or the rounding makes the ramp lurch at low speeds.
+  if (accel == 0) {
+    return ms_del;
+  }
+  long k = min((long)step, (long)current_op.max_steps - step);
+  if (k < 0) {
+    k = 0;
+  }
+  if ((unsigned long)k >= ramp_steps) {
+    return cruise_del;
+  }
+  unsigned long start = 500000UL / ms_del;
+  unsigned long d = 8000000UL / isqrt(256UL * (start * start + 2UL * accel * k));
+  return d < cruise_del ? cruise_del : d;
+}
+
 void StepperMotor::new_op(int goal_steps, int dir) {
   current_op.steps = 0;
   current_op.max_steps = goal_steps * multiplier;
   current_op.DIR = dir; // HIGH = 1 = forward, LOW = 0 = backward
+  current_op.del = step_delay(0);
+}
+
+void StepperMotor::queue_op(int goal_steps, int dir) {
+  // loop() doesn't take new instructions while a queue is full, so there's always room
+  byte tail = (queue_head + queue_count) % queueSize;
+  queued_steps[tail] = goal_steps;
+  queued_dir[tail] = dir;
+  queue_count++;
+}
+
+boolean StepperMotor::next_op() {
+  // Starts the next move in the queue once the last one has finished. Returns true if it did.
+  if (queue_count == 0 || current_op.max_steps != 0) {
+    return false;
+  }
+  new_op(queued_steps[queue_head], queued_dir[queue_head]);
+  queue_head = (queue_head + 1) % queueSize;
+  queue_count--;
+  return true;
 }
 
 void StepperMotor::clear_op() {
   current_op.steps = 0;
   current_op.max_steps = 0;
-  if (notifyAtEnd) {
-    Serial.write('0');
-    notifyAtEnd = false;
-  }
+  current_op.del = ms_del;
 }
 
 void StepperMotor::drive_motor() {
@@ -69,12 +189,14 @@ void StepperMotor::drive_motor() {
       if (current_op.current_del <= dt * 2) {                             // Start step. We multiply this by 2 because we add to the current_del at the end of every loop no matter what. It's clumsy, but faster than altering the code to stop doing that.
         digitalWrite(DIR, current_op.DIR);   // Set Direction
         digitalWrite(PUL,HIGH);             // Send pulse
-      } else if (current_op.current_del > ms_del - 50 && current_op.current_del < ms_del + 50) {  // Wait ms_del microseconds. Average dt is between 18 and 30us, so we have a safety range here so we never skip a step (hopefully)
-        digitalWrite(PUL,LOW);              // Finish pulse
-      } else if (current_op.current_del > (ms_del * 2) - 50 && current_op.current_del < (ms_del * 2) + 50) { // Wait another ms_del microseconds
+      } else if (current_op.current_del >= 2 * current_op.del) { // Wait another del microseconds
         // Reset in preperation for next pulse
         current_op.current_del = 0;
         current_op.steps ++; 
+        position += current_op.DIR ? -1 : 1;  // HIGH heads for the limit switch
+        current_op.del = step_delay(current_op.steps);
+      } else if (current_op.current_del >= current_op.del) {  // Wait del microseconds. These used to be +-50us windows, which a slow trip round loop() could jump right over and stall the motor for good.
+        digitalWrite(PUL,LOW);              // Finish pulse
       }
       current_op.current_del += dt;
     } else if (current_op.max_steps != 0) {
@@ -96,21 +218,64 @@ Servo wrist1;   // Big servo in the wrist
 Servo wrist2;   // Smaller servo in the wrist
 Servo claw;     // Micro servo controlling the claw
 
+bool motors_idle() {
+  return shoulder1.current_op.max_steps == 0 && shoulder2.current_op.max_steps == 0 && elbow.current_op.max_steps == 0 && base.current_op.max_steps == 0
+    && shoulder1.queue_count == 0 && elbow.queue_count == 0 && base.queue_count == 0 && !homing;
+}
+
+bool queues_full() {
+  return shoulder1.queue_count == queueSize || elbow.queue_count == queueSize || base.queue_count == queueSize;
+}
+
+void start_move(StepperMotor &motor, int steps, int dir) {
+  if (queueing) {
+    motor.queue_op(steps, dir);
+  } else {
+    motor.queue_count = 0;  // Anything left waiting from queue mode would only start once this is done, which nobody asked for
+    motor.new_op(steps, dir);
+  }
+}
+
+void report_queue() {
+  // Q <moves each motor can queue, 0 when queue mode is off> <moves waiting on the shoulders> <elbow> <base>
+  Serial.print("Q ");
+  Serial.print(queueing ? queueSize : 0);
+  Serial.print(' ');
+  Serial.print(shoulder1.queue_count);
+  Serial.print(' ');
+  Serial.print(elbow.queue_count);
+  Serial.print(' ');
+  Serial.println(base.queue_count);
+}
+
 void read() {
   // This function reads a whole string of serial input rather than single characters. Adapted from stackoverflow.
   if (Serial.available() > 0 && newData == false) {
     rc = Serial.read();               // Fetch latest character
 
-    if (rc != endMarker && rc != hardEndMarker) {
+    if (frameNdx > 0 || (ndx == 0 && ((byte)rc & binaryFlag))) {
+      // Binary frames are fixed size, so count bytes rather than looking for the end marker. The angle bytes could be anything.
+      frame[frameNdx] = rc;
+      frameNdx++;
+      if (frameNdx == frameSize) {
+        frameNdx = 0;
+        if (rc == endMarker || rc == hardEndMarker) {
+          binaryData = true;
+          newData = true;
+        } // Otherwise we've lost a byte somewhere. Drop the frame and wait for the next one to resync.
+      }
+    }
+    else if (rc != endMarker && rc != hardEndMarker) {
       receivedChars[ndx] = rc;        
       ndx++;
-      if (ndx >= numChars) {
-        ndx = numChars - 1;
+      if (ndx >= numChars - 1) {
+        ndx = numChars - 2;           // Leave room for the end marker and the null terminator
       }
     }
     else {
-      receivedChars[ndx] = 'N';
+      receivedChars[ndx] = rc;            // Keep the end marker so interpret() knows whether to ack
       receivedChars[ndx + 1] = '\0';      // Terminate the string
+      receivedLength = ndx + 1;
       ndx = 0;
       newData = true;                 // NEW DATA
     }
@@ -125,48 +290,33 @@ void grab() {
   }
 }
 
-int interpret(String input_str) {
-  // Takes the output string from the GUI program and interprets it as instructions
-  // Then, creates a new StepperOperation and assigns it to the relevant StepperMotor
-
-  if (input_str[input_str.length()-1] == 'N') {
-    input_str = input_str.substring(0, input_str.length()-2);
-    notifyAtEnd = true;
-  }
+void run_instruction(char identifier, int angle, int DIR) {
+  // Creates a new StepperOperation and assigns it to the relevant StepperMotor, or moves the relevant servo
+  commandsRun++;
 
   // Handle single character commands
-  if (input_str[0] == 'Z') {
-    reset();
-  } else if (input_str[0] == 'g') {
+  if (identifier == 'Z') {
+    start_homing();
+  } else if (identifier == 'g') {
     grab();
+  } else if (identifier == '?') {
+    Serial.print(identity);
+    Serial.print(' ');
+    Serial.print(acksSent);
+    Serial.print(' ');
+    Serial.println(millis());  // Starts from 0 again when the board resets, so the GUI can tell it forgot everything
   }
 
-  char identifier = input_str[0]; // Single character at the start of the instructions that indicates the motor / pair of motors / stepper to drive
-
-  // Isolate the angle, the second segment, from the instructions by looping through until we find an _
-  char c;
-  String n;
-  for (int i = 2; i < sizeof(input_str); i++) {
-    c = input_str[i];
-    if (c != '_') {
-      n += c;
-    } else {
-      break;
-    }
-  } 
-
-  int angle = n.toInt();
   int steps = (angle / phase_angle)/2;  // Calculate the necessary steps to achieve the necessary angle.
-  int DIR = input_str.substring(input_str.length()-2, input_str.length()-1).toInt(); // Second to last segment of the instructions indicates the direction
 
   if (identifier == 's') {        // Shoulder
-    // Reset the current_op of the relevant motors
-    shoulder1.new_op(steps, DIR);  
-    shoulder2.new_op(steps, DIR);    
+    // Reset the current_op of the relevant motors, or queue it up behind it
+    start_move(shoulder1, steps, DIR);
+    start_move(shoulder2, steps, DIR);
   } else if (identifier == 'e') { // Elbow
-    elbow.new_op(steps, DIR); 
+    start_move(elbow, steps, DIR);
   } else if (identifier == 'b') {
-    base.new_op(steps, DIR);
+    start_move(base, steps, DIR);
   } else if (identifier == 'w') { // Big wrist servo
     wrist1.write(angle);
   } else if (identifier == 'r') { // Small wrist servo
@@ -174,25 +324,183 @@ int interpret(String input_str) {
   } else if (identifier == 'g') {
     claw.write(180);
   }
-  return 1;
 }
 
-void reset() {
-  while (digitalRead(shoulder1.limit_pin) || digitalRead(elbow.limit_pin)) {
-    if (digitalRead(shoulder1.limit_pin)) {
-      digitalWrite(shoulder1.DIR, HIGH);
-      digitalWrite(shoulder1.PUL, HIGH);
-      digitalWrite(shoulder2.DIR, HIGH);
-      digitalWrite(shoulder2.PUL, HIGH);
+void run_frame() {
+  // Unpacks a binary frame. No String juggling needed.
+  if (frame[frameSize - 1] == hardEndMarker) {
+    notifyAtEnd = true;
+  }
+  byte joint = frame[0] & ~binaryFlag;
+  if (joint >= sizeof(binaryJoints) - 1) {
+    return;
+  }
+  unsigned int packed = ((unsigned int)frame[1] << 8) | frame[2];
+  run_instruction(binaryJoints[joint], packed >> 1, packed & 1);
+}
+
+void run_profile() {
+  // as_2500_400 gives the shoulders a profile that cruises at 2500us and gets there at 400 pulses/s/s. as_0_0 turns it off again.
+  commandsRun++;
+  if (command.joints[0] == 's') {
+    shoulder1.set_profile(command.angles[0], command.dirs[0]);
+    shoulder2.set_profile(command.angles[0], command.dirs[0]);
+  } else if (command.joints[0] == 'e') {
+    elbow.set_profile(command.angles[0], command.dirs[0]);
+  } else if (command.joints[0] == 'b') {
+    base.set_profile(command.angles[0], command.dirs[0]);
+  }
+}
+
+int interpret(const char *text, byte length) {
+  // Takes the output string from the GUI program and interprets it as instructions. See command.c for what makes sense.
+  int ok = parse_command(text, length, &command);
+
+  // N means the GUI is running a script and wants an ack once we're done, even if it sent us nonsense
+  if (command.notify) {
+    notifyAtEnd = true;
+  }
+  if (!ok) {
+    return 0;
+  }
+
+  if (command.identifier == 'm') {
+    // m_s_54_1_b_10_0 starts every move in the list on the same trip round loop(), so the joints move together.
+    // The ack waits for all of them like it does for everything else.
+    for (byte i = 0; i < command.moves; i++) {
+      run_instruction(command.joints[i], command.angles[i], command.dirs[i]);
     }
-    if (digitalRead(elbow.limit_pin)) {
-      digitalWrite(elbow.DIR, HIGH);
-      digitalWrite(elbow.PUL, HIGH);
+  } else if (command.identifier == 'a') {
+    run_profile();
+  } else if (command.identifier == 'q') {
+    if (command.fields > 1) { // qn only asks
+      queueing = command.angles[0] != 0;
     }
-    delayMicroseconds(shoulder1.ms_del);
+    report_queue();
+  } else if (command.identifier == 't') {
+    if (command.fields > 1) { // tn only asks
+      telemetryPeriod = command.angles[0] == 0 ? 0 : max((unsigned int)command.angles[0], telemetryMinPeriod);
+    }
+    report_telemetry();
+  } else {
+    run_instruction(command.identifier, command.angles[0], command.dirs[0]);
+  }
+  return 1;
+}
+
+void report_telemetry() {
+  // T <millis> <instructions run> <shoulder pulses> <elbow> <base> <moves queued on the shoulders> <elbow> <base>
+  //   <trips round loop()> <shortest in us> <longest> <mean> <limit switches closed, 1 for the shoulder and 2 for the elbow>
+  // The loop() timings start again after every report.
+  Serial.print("T ");
+  Serial.print(millis());
+  Serial.print(' ');
+  Serial.print(commandsRun);
+  Serial.print(' ');
+  Serial.print(shoulder1.position);
+  Serial.print(' ');
+  Serial.print(elbow.position);
+  Serial.print(' ');
+  Serial.print(base.position);
+  Serial.print(' ');
+  Serial.print(shoulder1.queue_count);
+  Serial.print(' ');
+  Serial.print(elbow.queue_count);
+  Serial.print(' ');
+  Serial.print(base.queue_count);
+  Serial.print(' ');
+  Serial.print(loops);
+  Serial.print(' ');
+  Serial.print(loops ? loopMin : 0);
+  Serial.print(' ');
+  Serial.print(loopMax);
+  Serial.print(' ');
+  Serial.print(loops ? loopTotal / loops : 0);
+  Serial.print(' ');
+  Serial.println((digitalRead(shoulder1.limit_pin) ? 0 : 1) | (digitalRead(elbow.limit_pin) ? 0 : 2));
+  telemetryLast = millis();
+  loops = 0;
+  loopMin = 0xFFFF;
+  loopMax = 0;
+  loopTotal = 0;
+}
+
+void report_homing(byte code) {
+  Serial.print("H ");
+  Serial.print(code);
+  Serial.print(' ');
+  Serial.println(homingPasses);
+}
+
+void start_homing() {
+  // Whatever was moving stops where it is, it would only fight the homing pulses
+  shoulder1.clear_op();
+  shoulder2.clear_op();
+  elbow.clear_op();
+  shoulder1.queue_count = 0;
+  shoulder2.queue_count = 0;
+  elbow.queue_count = 0;
+  homing = true;
+  homingHigh = false;
+  homingPasses = 0;
+  homingNext = micros();
+}
+
+void finish_homing(byte code) {
+  digitalWrite(elbow.PUL, LOW);
+  digitalWrite(shoulder1.PUL, LOW);
+  digitalWrite(shoulder2.PUL, LOW);
+  homing = false;
+  if (code == homingDone) {
+    // Both switches are closed, so this is where positions count from
+    shoulder1.position = 0;
+    shoulder2.position = 0;
+    elbow.position = 0;
+  }
+  report_homing(code);
+}
+
+void run_homing() {
+  // One pulse of ms_del per pass on each joint that isn't on its switch yet, high for the first half and low for the second
+  if (!homing || (long)(micros() - homingNext) < 0) {
+    return;
+  }
+  homingNext += shoulder1.ms_del / 2;
+  if (homingHigh) {
     digitalWrite(elbow.PUL, LOW);
     digitalWrite(shoulder1.PUL, LOW);
     digitalWrite(shoulder2.PUL, LOW);
+    homingHigh = false;
+    return;
+  }
+
+  boolean shoulder_out = digitalRead(shoulder1.limit_pin);
+  boolean elbow_out = digitalRead(elbow.limit_pin);
+  if (!shoulder_out && !elbow_out) {
+    finish_homing(homingDone);
+    return;
+  }
+  if (homingPasses >= homingLimit) {
+    finish_homing(homingGaveUp);
+    return;
+  }
+  if (shoulder_out) {
+    digitalWrite(shoulder1.DIR, HIGH);
+    digitalWrite(shoulder1.PUL, HIGH);
+    digitalWrite(shoulder2.DIR, HIGH);
+    digitalWrite(shoulder2.PUL, HIGH);
+    shoulder1.position--;
+    shoulder2.position--;
+  }
+  if (elbow_out) {
+    digitalWrite(elbow.DIR, HIGH);
+    digitalWrite(elbow.PUL, HIGH);
+    elbow.position--;
+  }
+  homingHigh = true;
+  homingPasses++;
+  if (homingPasses % homingReport == 0) {
+    report_homing(homingRunning);
   }
   // TODO: Add base here when the base limit switch actually exists
 }
@@ -245,6 +553,12 @@ void setup() {
   wrist2.attach(4);
   wrist2.write(90);
   claw.attach(3);
+
+  // No acceleration until the host asks for it
+  shoulder1.set_profile(shoulder1.ms_del, 0);
+  shoulder2.set_profile(shoulder2.ms_del, 0);
+  base.set_profile(base.ms_del, 0);
+  elbow.set_profile(elbow.ms_del, 0);
 }
 
 void loop() {
@@ -252,18 +566,57 @@ void loop() {
   prev_ms = current_ms;
   current_ms = micros();
   dt = current_ms - prev_ms;
+  loops++;
+  loopMin = min(loopMin, (unsigned int)dt);
+  loopMax = max(loopMax, (unsigned int)dt);
+  loopTotal += dt;
 
   read(); // Read serial data from gui.
-  if (newData==true) {
-    Serial.println(receivedChars);
-    interpret(receivedChars);
+  if (newData == true && homing) {
+    // Only a cancel gets through while homing. Anything else waits its turn, and so does a cancel behind it.
+    if (!binaryData && receivedChars[0] == cancelMarker) {
+      finish_homing(homingCancelled);
+      newData = false;
+    }
+  } else if (newData==true && notifyAtEnd == false && !queues_full()) {  // Scripted instructions run one after the other, so hold on to the next one until the last has finished. The GUI queues the rest up in the serial buffer.
+    if (binaryData) {
+      run_frame();
+      binaryData = false;
+    } else {
+      interpret(receivedChars, receivedLength);
+    }
     newData = false;
   }
 
   //Serial.println(digitalRead(A0));
 
+  run_homing();
   shoulder1.drive_motor();
   shoulder2.drive_motor();
   elbow.drive_motor();
   base.drive_motor();
+
+  // Queue mode: motors that have finished start on the next move waiting. The GUI gets a + for each, the shoulders counting once.
+  if (shoulder1.next_op()) {
+    shoulder2.next_op();
+    Serial.write('+');
+  }
+  if (elbow.next_op()) {
+    Serial.write('+');
+  }
+  if (base.next_op()) {
+    Serial.write('+');
+  }
+
+  // Ack once everything has stopped moving. Servo and single character instructions finish straight away.
+  if (notifyAtEnd && motors_idle()) {
+    Serial.write('0');
+    acksSent++;
+    notifyAtEnd = false;
+  }
+
+  if (telemetryPeriod && millis() - telemetryLast >= telemetryPeriod) {
+    report_telemetry();
+    current_ms = micros();  // Or the time it took to print would show up as the next trip round loop()
+  }
 }
\ No newline at end of file